@@ -0,0 +1,495 @@
+"""
+In-process fakes for the pyVmomi objects used by run.py and for
+qubesadmin, driven by a virtual clock so that a whole CI run can be
+replayed in well under a second.
+
+Every fake operation advances the clock by a configurable latency, which
+is booked as time spent working. Every time.sleep() in the code under
+test advances it too, booked as time spent idle. Both are attributed to
+whichever pipeline stage is running at the time.
+"""
+import json
+import sys
+import types
+from datetime import datetime, timedelta, timezone
+
+# Latencies in (virtual) seconds
+DEFAULT_LATENCIES = {
+    # Any guest operations or inventory API call
+    "api_call": 0.05,
+    # Uploading or downloading a file through the guest file transfer URL
+    "file_transfer": 0.5,
+    # Posting a commit status to Github
+    "github_api": 0.3,
+    "revert": 20,
+    "power_on": 5,
+    "power_off": 3,
+    # From power on until VMware Tools report that the guest is up
+    "boot": 90,
+    # From ShutdownGuest until the VM is powered off
+    "guest_shutdown": 20,
+    "create_snapshot": 30,
+    "remove_snapshot": 15,
+    # Guest programs: anything not listed below takes 'program'
+    "program": 1,
+    "begin.py": 3600,
+    "qubesctl": 1200,
+    "updatecheck.py": 120,
+    # Qubes domains shutting down in dom0
+    "domain_shutdown": 8,
+}
+
+
+class VirtualClock:
+    """
+    Stands in for the time module in the code under test.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.stages = ["orchestration"]
+        self.accounts = {}
+
+    def advance(self, seconds, kind):
+        self.now += seconds
+        stage = self.stages[-1]
+        account = self.accounts.setdefault(stage, {"idle": 0.0, "working": 0.0})
+        account[kind] += seconds
+
+    def work(self, seconds):
+        self.advance(seconds, "working")
+
+    def sleep(self, seconds):
+        self.advance(seconds, "idle")
+
+    def time(self):
+        return 1_700_000_000 + self.now
+
+    def monotonic(self):
+        return self.now
+
+    def enter(self, stage):
+        self.stages.append(stage)
+
+    def leave(self):
+        self.stages.pop()
+
+
+class FileNotFound(Exception):
+    pass
+
+
+def install_fake_modules(clock, latencies):
+    """
+    Register fake pyVim, pyVmomi, certifi and requests modules, so that
+    run.py can be imported without them and talks to our fakes instead.
+    """
+    vim = types.SimpleNamespace()
+    vim.fault = types.SimpleNamespace(FileNotFound=FileNotFound)
+    vim.vm = types.SimpleNamespace()
+    vim.vm.guest = types.SimpleNamespace()
+    vim.vm.guest.NamePasswordAuthentication = lambda **kwargs: kwargs
+    vim.vm.guest.FileManager = types.SimpleNamespace(FileAttributes=lambda: {})
+    vim.vm.guest.ProcessManager = types.SimpleNamespace(ProgramSpec=lambda **kwargs: kwargs)
+    vim.vm.GuestInfo = types.SimpleNamespace(ToolsStatus=types.SimpleNamespace(toolsOk="toolsOk"))
+    vim.VirtualMachine = FakeVM
+    vim.HostSystem = FakeHost
+    vim.PerformanceManager = types.SimpleNamespace(QuerySpec=lambda **kwargs: kwargs, MetricId=lambda **kwargs: kwargs)
+
+    pyvmomi = types.ModuleType("pyVmomi")
+    pyvmomi.vim = vim
+    pyvim = types.ModuleType("pyVim")
+    connect = types.ModuleType("pyVim.connect")
+    connect.SmartConnect = lambda **kwargs: FakeServiceInstance.current
+    connect.Disconnect = lambda si: None
+    task = types.ModuleType("pyVim.task")
+
+    def wait_for_task(t):
+        clock.work(t.latency)
+        t.complete()
+        return "success"
+
+    task.WaitForTask = wait_for_task
+
+    certifi = types.ModuleType("certifi")
+    certifi.where = lambda: None
+
+    requests = types.ModuleType("requests")
+    requests.exceptions = types.SimpleNamespace(RequestException=Exception, HTTPError=Exception)
+
+    def put(url, data=None, **kwargs):
+        clock.work(latencies["file_transfer"])
+        vm, path = FakeFileManager.transfers.pop(url)
+        vm.files[path] = data
+        return FakeResponse(200)
+
+    def get(url, **kwargs):
+        clock.work(latencies["file_transfer"])
+        vm, path = FakeFileManager.transfers.pop(url)
+        return FakeResponse(200, vm.files[path])
+
+    class Session:
+        def post(self, url, **kwargs):
+            clock.work(latencies["github_api"])
+            return FakeResponse(201)
+
+        def get(self, url, **kwargs):
+            clock.work(latencies["github_api"])
+            return FakeResponse(200)
+
+    requests.put = put
+    requests.get = get
+    requests.post = lambda url, **kwargs: Session().post(url)
+    requests.Session = Session
+
+    sys.modules.update({
+        "pyVmomi": pyvmomi,
+        "pyVim": pyvim,
+        "pyVim.connect": connect,
+        "pyVim.task": task,
+        "certifi": certifi,
+        "requests": requests,
+    })
+
+
+class FakeSSL:
+    """
+    Stands in for the ssl module in run.py, as there is nothing to verify.
+    """
+
+    PROTOCOL_TLS_CLIENT = None
+
+    class SSLContext:
+        def __init__(self, protocol):
+            pass
+
+        def load_verify_locations(self, cafile=None):
+            pass
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b""):
+        self.status_code = status_code
+        self.content = content
+        self.text = content.decode("utf-8") if isinstance(content, bytes) else content
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeTask:
+    def __init__(self, latency, on_complete=None):
+        self.latency = latency
+        self.on_complete = on_complete
+        self.info = types.SimpleNamespace(state="success", error=None)
+
+    def complete(self):
+        if self.on_complete:
+            self.on_complete()
+            self.on_complete = None
+
+
+class FakeSnapshotTree:
+    def __init__(self, vm, name, created, memory=False):
+        self.name = name
+        self.createTime = created
+        self.childSnapshotList = []
+        self.snapshot = FakeSnapshot(vm, self, memory)
+
+
+class FakeSnapshot:
+    def __init__(self, vm, tree, memory):
+        self.vm = vm
+        self.tree = tree
+        self.memory = memory
+
+    def RevertToSnapshot_Task(self):
+        def revert():
+            self.vm.current = self.tree
+            self.vm.files = {}
+            self.vm.set_power("poweredOn" if self.memory else "poweredOff")
+        return FakeTask(self.vm.latencies["revert"], revert)
+
+    def RemoveSnapshot_Task(self, removeChildren=False):
+        return FakeTask(self.vm.latencies["remove_snapshot"], lambda: self.vm.remove_snapshot(self.tree))
+
+
+class FakeHost:
+    def __init__(self, name):
+        self.name = name
+        self.vm = []
+        # The highest disk latency the performance manager reports, in ms
+        self.disk_latency = 5
+
+    @property
+    def summary(self):
+        # The hypervisor's own use, plus that of each running VM
+        running = [vm.summary.quickStats for vm in self.vm if vm.power_state == "poweredOn"]
+        return types.SimpleNamespace(
+            quickStats=types.SimpleNamespace(
+                overallCpuUsage=1000 + sum(stats.overallCpuUsage for stats in running),
+                overallMemoryUsage=16384 + sum(stats.guestMemoryUsage for stats in running),
+            ),
+            hardware=types.SimpleNamespace(cpuMhz=2000, numCpuCores=16, memorySize=128 * 1024 ** 3),
+        )
+
+
+class FakePerformanceManager:
+    def __init__(self, clock, latencies):
+        self.clock = clock
+        self.latencies = latencies
+        self.perfCounter = [
+            types.SimpleNamespace(
+                key=1,
+                groupInfo=types.SimpleNamespace(key="disk"),
+                nameInfo=types.SimpleNamespace(key="maxTotalLatency"),
+                rollupType="latest",
+            )
+        ]
+
+    def QueryPerf(self, querySpec):
+        self.clock.work(self.latencies["api_call"])
+        return [
+            types.SimpleNamespace(value=[types.SimpleNamespace(value=[spec["entity"].disk_latency])])
+            for spec in querySpec
+        ]
+
+
+class FakeVM:
+    def __init__(self, name, clock, latencies, host=None):
+        self.name = name
+        self.clock = clock
+        self.latencies = latencies
+        self.config = types.SimpleNamespace(uuid=f"uuid-{name}")
+        self.files = {}
+        self.power_state = "poweredOff"
+        self.powered_on_at = None
+        self.shutdown_at = None
+        self.host = host
+        # What updatecheck.py finds: everything needs updating unless a
+        # scenario says otherwise
+        self.updates = ["dom0", "fedora-40", "debian-12"]
+        base = FakeSnapshotTree(self, "update_base", datetime.now(timezone.utc) - timedelta(days=1))
+        self.roots = [base]
+        self.current = base
+
+    def set_power(self, state):
+        self.power_state = state
+        self.shutdown_at = None
+        self.powered_on_at = self.clock.now if state == "poweredOn" else None
+
+    @property
+    def runtime(self):
+        if self.shutdown_at is not None and self.clock.now >= self.shutdown_at:
+            self.set_power("poweredOff")
+        return types.SimpleNamespace(
+            powerState=self.power_state, host=self.host, consolidationNeeded=False, connectionState="connected"
+        )
+
+    @property
+    def summary(self):
+        on = self.power_state == "poweredOn"
+        return types.SimpleNamespace(
+            quickStats=types.SimpleNamespace(
+                overallCpuUsage=6000 if on else 0,
+                guestMemoryUsage=24576 if on else 0,
+                balloonedMemory=0,
+                swappedMemory=0,
+            ),
+            config=types.SimpleNamespace(memorySizeMB=32768),
+        )
+
+    @property
+    def guest(self):
+        ready = (
+            self.runtime.powerState == "poweredOn"
+            and self.clock.now - self.powered_on_at >= self.latencies["boot"]
+        )
+        return types.SimpleNamespace(toolsStatus="toolsOk" if ready else "toolsNotRunning")
+
+    @property
+    def snapshot(self):
+        return types.SimpleNamespace(rootSnapshotList=self.roots, currentSnapshot=self.current.snapshot)
+
+    @property
+    def layoutEx(self):
+        # One delta disk for each snapshot between the base disk and now
+        depth = len(self.snapshot_path(self.roots))
+        chain = [types.SimpleNamespace(fileKey=[n]) for n in range(depth + 1)]
+        files = [types.SimpleNamespace(key=n, size=1024 ** 3) for n in range(depth + 1)]
+        return types.SimpleNamespace(disk=[types.SimpleNamespace(chain=chain)], file=files)
+
+    def snapshot_path(self, trees):
+        for tree in trees:
+            if tree is self.current:
+                return [tree]
+            path = self.snapshot_path(tree.childSnapshotList)
+            if path:
+                return [tree] + path
+        return []
+
+    def ConsolidateVMDisks_Task(self):
+        return FakeTask(self.latencies["remove_snapshot"])
+
+    def PowerOnVM_Task(self):
+        return FakeTask(self.latencies["power_on"], lambda: self.set_power("poweredOn"))
+
+    def PowerOffVM_Task(self):
+        return FakeTask(self.latencies["power_off"], lambda: self.set_power("poweredOff"))
+
+    def ShutdownGuest(self):
+        self.clock.work(self.latencies["api_call"])
+        self.shutdown_at = self.clock.now + self.latencies["guest_shutdown"]
+
+    def CreateSnapshot(self, name, description, memory, quiesce):
+        def create():
+            tree = FakeSnapshotTree(self, name, datetime.now(timezone.utc), memory)
+            self.current.childSnapshotList.append(tree)
+            self.current = tree
+        return FakeTask(self.latencies["create_snapshot"], create)
+
+    def remove_snapshot(self, tree, parents=None):
+        for parent in parents or self.roots:
+            if tree in parent.childSnapshotList:
+                parent.childSnapshotList.remove(tree)
+                parent.childSnapshotList.extend(tree.childSnapshotList)
+                return
+            self.remove_snapshot(tree, parent.childSnapshotList)
+
+
+class FakeProcessManager:
+    def __init__(self, clock, latencies):
+        self.clock = clock
+        self.latencies = latencies
+        self.processes = {}
+        self.next_pid = 1000
+
+    def StartProgramInGuest(self, vm, creds, spec):
+        self.clock.work(self.latencies["api_call"])
+        arguments = spec.get("arguments", "")
+        duration = self.latencies["program"]
+        for program in ["begin.py", "qubesctl", "updatecheck.py"]:
+            if program in arguments:
+                duration = self.latencies[program]
+
+        # Play the part of runner.py and friends in the guest
+        def finish():
+            if "tee /home/user/.logfile" in arguments:
+                vm.files["/home/user/.logfile"] = arguments.split()[0].encode("utf-8")
+            if "begin.py" in arguments:
+                log_file = vm.files.get("/home/user/.logfile", b"log").decode("utf-8")
+                vm.files[f"/home/user/{log_file}"] = b"INFO:Step finished\n"
+                vm.files["/home/user/.sdci-done"] = b"success"
+            if "updatecheck.py" in arguments:
+                vm.files["/home/user/.updatecheck.json"] = json.dumps(
+                    {"updates": vm.updates, "up_to_date": [], "unknown": [], "seconds": self.latencies["updatecheck.py"]}
+                ).encode("utf-8")
+
+        self.next_pid += 1
+        self.processes[self.next_pid] = (self.clock.now + duration, finish)
+        return self.next_pid
+
+    def ListProcessesInGuest(self, vm, creds, pids):
+        self.clock.work(self.latencies["api_call"])
+        finishes_at, finish = self.processes[pids[0]]
+        if self.clock.now >= finishes_at:
+            finish()
+            return [types.SimpleNamespace(exitCode=0)]
+        return [types.SimpleNamespace(exitCode=None)]
+
+
+class FakeFileManager:
+    # Outstanding transfer URLs, shared with the fake requests module
+    transfers = {}
+
+    def __init__(self, clock, latencies):
+        self.clock = clock
+        self.latencies = latencies
+
+    def InitiateFileTransferToGuest(self, vm, creds, path, attributes, size, overwrite):
+        self.clock.work(self.latencies["api_call"])
+        url = f"https://*:443/guestFile?id={len(self.transfers)}-{path}"
+        self.transfers[url.replace("*", "esxi.example")] = (vm, path)
+        return url
+
+    def InitiateFileTransferFromGuest(self, vm, creds, path):
+        self.clock.work(self.latencies["api_call"])
+        if path not in vm.files:
+            raise FileNotFound(path)
+        url = f"https://*:443/guestFile?id={len(self.transfers)}-{path}"
+        self.transfers[url.replace("*", "esxi.example")] = (vm, path)
+        return types.SimpleNamespace(url=url)
+
+
+class FakeServiceInstance:
+    # The instance SmartConnect hands out
+    current = None
+
+    def __init__(self, clock, latencies, vm_names):
+        self.clock = clock
+        self.latencies = latencies
+        host = FakeHost("esxi.example")
+        self.vms = [FakeVM(name, clock, latencies, host) for name in vm_names]
+        host.vm = self.vms
+        self.content = types.SimpleNamespace(
+            guestOperationsManager=types.SimpleNamespace(
+                processManager=FakeProcessManager(clock, latencies),
+                fileManager=FakeFileManager(clock, latencies),
+            ),
+            viewManager=types.SimpleNamespace(CreateContainerView=self.create_container_view),
+            perfManager=FakePerformanceManager(clock, latencies),
+            rootFolder=types.SimpleNamespace(
+                childEntity=[
+                    types.SimpleNamespace(
+                        name="datacenter",
+                        vmFolder=types.SimpleNamespace(childEntity=self.vms),
+                        hostFolder=types.SimpleNamespace(
+                            childEntity=[types.SimpleNamespace(host=[host])]
+                        ),
+                    )
+                ]
+            ),
+        )
+        FakeServiceInstance.current = self
+
+    def RetrieveContent(self):
+        self.clock.work(self.latencies["api_call"])
+        return self.content
+
+    def create_container_view(self, container, types_wanted, recursive):
+        self.clock.work(self.latencies["api_call"])
+        objects = []
+        if FakeVM in types_wanted:
+            objects.extend(self.vms)
+        if FakeHost in types_wanted:
+            objects.extend({vm.host.name: vm.host for vm in self.vms}.values())
+        return types.SimpleNamespace(view=objects, Destroy=lambda: None)
+
+
+class FakeDomain:
+    def __init__(self, name, clock, latencies):
+        self.name = name
+        self.klass = "AppVM"
+        self.tags = ["sd-workstation"]
+        self.clock = clock
+        self.latencies = latencies
+        self.stops_at = None
+
+    def is_running(self):
+        return self.stops_at is None or self.clock.now < self.stops_at
+
+    def shutdown(self, force=False):
+        self.clock.work(self.latencies["api_call"])
+        self.stops_at = self.clock.now + self.latencies["domain_shutdown"]
+
+
+def install_fake_qubesadmin(clock, latencies, domain_names):
+    """
+    Register a fake qubesadmin module whose Qubes() has the given
+    running domains, all tagged for SecureDrop Workstation.
+    """
+    domains = [FakeDomain(name, clock, latencies) for name in domain_names]
+    qubesadmin = types.ModuleType("qubesadmin")
+    qubesadmin.Qubes = lambda: types.SimpleNamespace(domains=domains)
+    sys.modules["qubesadmin"] = qubesadmin
+    return domains
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Benchmark the orchestration overhead of run.py and runner.py against
+in-process fakes of vSphere and qubesadmin.
+
+For each scenario, reports how much (virtual) wall-clock time each
+pipeline stage spends working (in API calls, tasks and guest programs
+the fakes model) and how much it spends idle (in time.sleep), and
+appends the results to bench/results.jsonl so that runs can be compared
+over time with --compare.
+"""
+import argparse
+import configparser
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_FILE = os.path.join(BENCH_DIR, "results.jsonl")
+
+sys.path.insert(0, BENCH_DIR)
+# As if run.py had been run directly, for its imports of its neighbours
+sys.path.insert(1, REPO_DIR)
+import fakes  # noqa: E402
+
+# CiRunner methods we attribute time to. Anything else is 'orchestration'
+# (finding a VM, reverting it and so on).
+STAGES = [
+    "startup",
+    "shutdown",
+    "check_updates",
+    "apply_updates",
+    "store_files_in_dom0",
+    "run_ci",
+    "collect_results",
+    "take_snapshot",
+    "remove_old_snapshots",
+    "maintain",
+]
+
+SCENARIOS = ["ci", "nightly", "nightly_no_updates", "save", "save_no_updates", "maintain", "runner_shutdown"]
+
+
+def parse_args():
+    """
+    Handle CLI args.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=SCENARIOS,
+        help="Scenario to run, can be given more than once. Defaults to all of them.",
+    )
+    parser.add_argument(
+        "--latency",
+        action="append",
+        default=[],
+        metavar="NAME=SECONDS",
+        help=f"Override a fake latency. Known latencies: {', '.join(fakes.DEFAULT_LATENCIES)}",
+    )
+    parser.add_argument(
+        "--vms",
+        default=2,
+        type=int,
+        action="store",
+        help="Number of fake Qubes VMs",
+    )
+    parser.add_argument(
+        "--label",
+        default="",
+        action="store",
+        help="Label to store with the results",
+    )
+    parser.add_argument(
+        "--compare",
+        default=False,
+        action="store_true",
+        help="Compare the two most recent stored results for each scenario instead of running",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def instrument(cls, clock, stages):
+    """
+    Wrap the given methods of a class so that time advanced while they
+    run is booked against them.
+    """
+    for stage in stages:
+        original = getattr(cls, stage)
+
+        def wrapper(self, *args, _original=original, _stage=stage, **kwargs):
+            clock.enter(_stage)
+            try:
+                return _original(self, *args, **kwargs)
+            finally:
+                clock.leave()
+
+        setattr(cls, stage, wrapper)
+
+
+def prepare_home(work_dir, vm_names):
+    """
+    Write the config file and a copy of the files run.py uploads into a
+    scratch directory.
+    """
+    config = configparser.ConfigParser()
+    config["ESXi"] = {"server": "esxi.example", "username": "ci", "password": "ci"}
+    config["Qubes"] = {"username": "user", "password": "user"}
+    config["RateLimit"] = {"state_file": os.path.join(work_dir, ".sdci-ratelimit.json")}
+    for name in vm_names:
+        config[f"uuid-{name}"] = {"snapshot": "update_base"}
+    with open(os.path.join(work_dir, ".esx.ini"), "w") as c:
+        config.write(c)
+
+    for directory in ["dom0", "sd-dev"]:
+        shutil.copytree(os.path.join(REPO_DIR, directory), os.path.join(work_dir, directory))
+    shutil.copy(os.path.join(REPO_DIR, "viewer.html"), work_dir)
+    for secret in [".sdci-ghp.txt", ".slack-webhook.txt"]:
+        with open(os.path.join(work_dir, "sd-dev", secret), "w") as f:
+            f.write("https://example.com/token\n")
+    os.makedirs(os.path.join(work_dir, "reports"))
+
+
+def run_orchestrator(scenario, latencies, vm_count):
+    clock = fakes.VirtualClock()
+    fakes.install_fake_modules(clock, latencies)
+    vm_names = [f"Qubes_4.2_{i}" for i in range(vm_count)]
+    si = fakes.FakeServiceInstance(clock, latencies, vm_names)
+    if scenario.endswith("_no_updates"):
+        for vm in si.vms:
+            vm.updates = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        prepare_home(work_dir, vm_names)
+        os.environ["HOME"] = work_dir
+        run = load_module("run", os.path.join(REPO_DIR, "run.py"))
+        run.CURRENT_DIR = work_dir
+        run.REPORTS_DIR = os.path.join(work_dir, "reports")
+        run.MAINTENANCE_DIR = os.path.join(work_dir, ".sdci-maintenance")
+        run.JOBS_DIR = os.path.join(work_dir, ".sdci-jobs")
+        run.time = clock
+        run.ssl = fakes.FakeSSL
+        sys.modules["delivery"].time = clock
+        sys.modules["ratelimit"].time = clock
+        # No syslog in the benchmark
+        logging.getLogger("run").handlers = [logging.NullHandler()]
+        logging.getLogger("run").propagate = False
+
+        instrument(run.CiRunner, clock, STAGES)
+        ci = run.CiRunner()
+        context = json.dumps({"commit": "0" * 40, "author": "bench", "message": "bench", "reason": "bench"})
+        if scenario == "ci":
+            result = ci.main("4.2", context)
+        elif scenario in ("nightly", "nightly_no_updates"):
+            result = ci.main("4.2", context, update=True)
+        elif scenario in ("save", "save_no_updates"):
+            result = ci.save("4.2", False, True)
+        else:
+            result = ci.maintain("4.2")
+    return clock, result
+
+
+def run_runner_shutdown(latencies, domain_count=8):
+    clock = fakes.VirtualClock()
+    fakes.install_fake_qubesadmin(clock, latencies, [f"sd-vm-{i}" for i in range(domain_count)])
+    runner = load_module("runner", os.path.join(REPO_DIR, "dom0", "runner.py"))
+    runner.time = clock
+    instrument(runner.QubesCI, clock, ["shutdown_sd_vms"])
+
+    # Skip __init__, which expects to be running in dom0
+    ci = runner.QubesCI.__new__(runner.QubesCI)
+    ci.logging = logging.getLogger("bench-runner")
+    ci.logging.addHandler(logging.NullHandler())
+    ci.logging.propagate = False
+    ci.status = "success"
+    ci.shutdown_sd_vms()
+    return clock, ci.status
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def report(record):
+    print(f"\n{record['scenario']} ({record['result']}), {record['total']:.0f}s in total")
+    print(f"  {'stage':<24}{'working':>12}{'idle':>12}{'idle %':>9}")
+    for stage, account in sorted(record["stages"].items(), key=lambda item: -sum(item[1].values())):
+        total = account["working"] + account["idle"]
+        idle_pct = 100 * account["idle"] / total if total else 0
+        print(f"  {stage:<24}{account['working']:>11.1f}s{account['idle']:>11.1f}s{idle_pct:>8.0f}%")
+
+
+def compare():
+    if not os.path.exists(RESULTS_FILE):
+        print("No stored results yet")
+        return
+    by_scenario = {}
+    with open(RESULTS_FILE, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            by_scenario.setdefault(record["scenario"], []).append(record)
+
+    for scenario, records in by_scenario.items():
+        if len(records) < 2:
+            continue
+        before, after = records[-2], records[-1]
+        print(f"\n{scenario}: {before['commit']} {before['label']} -> {after['commit']} {after['label']}")
+        print(f"  total {before['total']:.0f}s -> {after['total']:.0f}s ({after['total'] - before['total']:+.0f}s)")
+        for stage in sorted(set(before["stages"]) | set(after["stages"])):
+            old = before["stages"].get(stage, {"working": 0, "idle": 0})
+            new = after["stages"].get(stage, {"working": 0, "idle": 0})
+            print(
+                f"  {stage:<24} working {new['working'] - old['working']:+8.1f}s"
+                f"  idle {new['idle'] - old['idle']:+8.1f}s"
+            )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.compare:
+        compare()
+        sys.exit(0)
+
+    latencies = dict(fakes.DEFAULT_LATENCIES)
+    for override in args.latency:
+        name, _, value = override.partition("=")
+        if name not in latencies:
+            sys.exit(f"Unknown latency {name}")
+        latencies[name] = float(value)
+
+    for scenario in args.scenario or SCENARIOS:
+        if scenario == "runner_shutdown":
+            clock, result = run_runner_shutdown(latencies)
+        else:
+            clock, result = run_orchestrator(scenario, latencies, args.vms)
+        record = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "label": args.label,
+            "scenario": scenario,
+            "result": str(result),
+            "latencies": latencies,
+            "total": clock.now,
+            "stages": clock.accounts,
+        }
+        report(record)
+        with open(RESULTS_FILE, "a") as f:
+            f.write(json.dumps(record) + "\n")
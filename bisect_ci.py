@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import git
+import glob
+import json
+import logging
+import os
+import subprocess
+import tempfile
+from datetime import datetime
+from engine import Engine
+from run import CiRunner, StatusDelivery, CURRENT_DIR, REPORTS_DIR
+
+REPO_URL = "https://github.com/freedomofpress/securedrop-workstation.git"
+
+# Build statuses that say whether a commit is good or bad. Anything else
+# (an error, a cancel) tells us nothing about the commit, so it is skipped.
+GOOD = ["success"]
+BAD = ["failure", "timeout"]
+
+
+def parse_args():
+    """
+    Handle CLI args.
+    """
+    parser = argparse.ArgumentParser(description="Find the commit that broke CI, testing several commits at once")
+    parser.add_argument(
+        "--version",
+        required=True,
+        action="store",
+        help="Qubes version to test on",
+    )
+    parser.add_argument(
+        "--bad",
+        required=True,
+        action="store",
+        help="A commit that fails, e.g from a failed nightly",
+    )
+    parser.add_argument(
+        "--good",
+        action="store",
+        help="A commit that passes. Defaults to the last commit of --branch that passed its nightly on --version.",
+    )
+    parser.add_argument(
+        "--branch",
+        default="main",
+        action="store",
+        help="Branch to clone, which must contain both commits",
+    )
+    parser.add_argument(
+        "--ways",
+        default=0,
+        type=int,
+        action="store",
+        help="How many commits to test at once in each round. Defaults to the number of VMs for --version.",
+    )
+    parser.add_argument(
+        "--snapshot",
+        default=False,
+        action="store",
+        help="Snapshot to revert each VM to, as for run.py",
+    )
+    parser.add_argument(
+        "--update",
+        default=False,
+        action="store_true",
+        help="Apply updates before testing each commit, as nightlies do",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def last_good_nightly(branch, version):
+    """
+    Return the commit of the most recent nightly of a branch that passed
+    on a Qubes version, from the summaries nightlies.py writes, or None.
+    """
+    for path in sorted(glob.glob(os.path.join(REPORTS_DIR, "nightly-*.json")), reverse=True):
+        try:
+            with open(path, "r") as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for entry in summary:
+            if entry["branch"] == branch and entry["version"] == version and entry["result"] in GOOD:
+                return entry["commit"]
+    return None
+
+
+def pick(candidates, ways):
+    """
+    Choose up to `ways` commits that split a list of candidates as evenly
+    as possible into ways + 1 parts.
+    """
+    if len(candidates) <= ways:
+        return list(candidates)
+    return [candidates[len(candidates) * i // (ways + 1)] for i in range(1, ways + 1)]
+
+
+class Bisect:
+    def __init__(self, ci, version, commits, ways, snapshot_name=False, update=False, merged=None):
+        """
+        A k-way bisection of a run of commits, oldest first, whose first
+        is known to be good and whose last is known to be bad. Each commit
+        is the first parent of the next, and `merged` gives the commits
+        that each merge among them brought in.
+
+        Each round tests `ways` commits spread evenly between the last
+        good commit and the first bad one, all at once on their own VMs
+        through one engine.py Engine, which cuts the range to about a
+        (ways + 1)th of its size per round rather than a half. Commits
+        whose builds neither pass nor fail are skipped.
+        """
+        self.ci = ci
+        self.version = version
+        self.commits = commits
+        self.ways = ways
+        self.snapshot_name = snapshot_name
+        self.update = update
+        self.merged = merged or {}
+        self.results = {commits[0]["commit"]: "success", commits[-1]["commit"]: "failure"}
+        self.rounds = []
+
+    def bounds(self):
+        """
+        Return the indexes of the last good commit before the first bad one,
+        and of that first bad one.
+        """
+        bad = min(i for i, c in enumerate(self.commits) if self.results.get(c["commit"]) in BAD)
+        good = max(i for i, c in enumerate(self.commits[:bad]) if self.results.get(c["commit"]) in GOOD)
+        return good, bad
+
+    def candidates(self):
+        """
+        The commits between the bounds that are still worth testing.
+        """
+        good, bad = self.bounds()
+        return [c for c in self.commits[good + 1:bad] if c["commit"] not in self.results]
+
+    async def test_round(self, engine, picked):
+        tasks = [
+            engine.build(self.version, context, self.snapshot_name, self.update)
+            for context in picked
+        ]
+        statuses = await asyncio.gather(*tasks, return_exceptions=True)
+        for context, status in zip(picked, statuses):
+            if isinstance(status, Exception):
+                logging.info(f"Testing {context['commit']} failed: {status}")
+                status = "error"
+            self.results[context["commit"]] = status
+        return statuses
+
+    async def run(self):
+        engine = Engine(self.ci)
+        while True:
+            candidates = self.candidates()
+            if not candidates:
+                break
+            picked = pick(candidates, self.ways)
+            logging.info(
+                f"Round {len(self.rounds) + 1}: {len(candidates)} commits left, "
+                f"testing {', '.join(c['commit'][:8] for c in picked)}"
+            )
+            await self.test_round(engine, picked)
+            self.rounds.append({c["commit"]: self.results[c["commit"]] for c in picked})
+
+    def report(self):
+        """
+        Log and return what we found: the first bad commit, and any skipped
+        commits just before it that could be the culprit instead. If the
+        first bad commit is a merge, the culprit is one of the commits it
+        brought in, or the merge itself.
+        """
+        good, bad = self.bounds()
+        first_bad = self.commits[bad]
+        untested = [c["commit"] for c in self.commits[good + 1:bad]]
+        summary = {
+            "version": self.version,
+            "good": self.commits[good]["commit"],
+            "first_bad": first_bad["commit"],
+            "author": first_bad["author"],
+            "message": first_bad["message"].split("\n")[0],
+            "could_also_be": untested,
+            "merged": self.merged.get(first_bad["commit"], []),
+            "rounds": self.rounds,
+        }
+        logging.info(f"First bad commit on Qubes {self.version}: {first_bad['commit']} {summary['message']}")
+        if summary["merged"]:
+            logging.info(f"It is a merge, of these commits: {' '.join(summary['merged'])}")
+        if untested:
+            logging.info(f"Builds of these commits before it didn't finish, so it could be one of them: {' '.join(untested)}")
+        return summary
+
+
+def list_commits(branch, good, bad):
+    """
+    Clone the repo and return the commits on the first-parent history of
+    bad since good, oldest first and starting with good, as --context
+    dicts, along with the commits each merge among them brought in.
+
+    Bisecting the commits of merged branches as well would put them in
+    one line with the branch, which they were not in, so the first bad
+    commit found might not be the one that broke it. Following the first
+    parent only, a merged branch that broke the build shows up as its
+    merge. Returns no commits if good is not on that history.
+    """
+    with tempfile.TemporaryDirectory() as repo_working_dir:
+        subprocess.check_call(["git", "clone", "--branch", branch, REPO_URL, repo_working_dir])
+        repo = git.Repo(repo_working_dir)
+        good = repo.commit(good).hexsha
+        shas = repo.git.rev_list("--reverse", "--first-parent", f"{good}..{bad}").split()
+        if not shas or repo.commit(shas[0]).parents[0].hexsha != good:
+            return [], {}
+        commits = []
+        merged = {}
+        for sha in [good] + shas:
+            commit = repo.commit(sha)
+            commits.append({
+                "commit": commit.hexsha,
+                "author": commit.author.name,
+                "message": commit.message,
+                "reason": "bisect",
+            })
+            if len(commit.parents) > 1:
+                brought_in = repo.git.rev_list("--reverse", sha, f"^{sha}^1").split()
+                merged[commit.hexsha] = [c for c in brought_in if c != commit.hexsha]
+    return commits, merged
+
+
+def notify(summary):
+    text = (
+        f"First bad commit on Qubes {summary['version']}: {summary['first_bad']} by {summary['author']}: "
+        f"{summary['message']}"
+    )
+    if summary["merged"]:
+        text += f" (a merge of {len(summary['merged'])} commits, one of which is likely the culprit)"
+    if summary["could_also_be"]:
+        text += f" (or one of {len(summary['could_also_be'])} commits before it that couldn't be tested)"
+    delivery = StatusDelivery(
+        logging.getLogger(__name__),
+        os.path.join(CURRENT_DIR, "sd-dev/.sdci-ghp.txt"),
+        os.path.join(CURRENT_DIR, "sd-dev/.slack-webhook.txt"),
+    )
+    delivery.slack({
+        "attachments": [
+            {
+                "color": "danger",
+                "pretext": f"SDW CI bisect found the first bad commit after {len(summary['rounds'])} rounds",
+                "text": text,
+                "fallback": text,
+            }
+        ]
+    })
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    good = args.good or last_good_nightly(args.branch, args.version)
+    if not good:
+        raise SystemExit(f"No nightly of {args.branch} has passed on Qubes {args.version}, give --good")
+    commits, merged = list_commits(args.branch, good, args.bad)
+    if len(commits) < 2 or not commits[-1]["commit"].startswith(args.bad):
+        raise SystemExit(f"{good} is not on the first-parent history of {args.bad} on {args.branch}")
+
+    ci = CiRunner()
+    # Leave the commit statuses of the old commits we build alone
+    ci.statuses = False
+    ways = args.ways or ci.count_vms(args.version)
+    if ways < 1:
+        raise SystemExit(f"There are no VMs for Qubes {args.version}")
+
+    bisect = Bisect(ci, args.version, commits, ways, args.snapshot, args.update, merged)
+    asyncio.run(bisect.run())
+    summary = bisect.report()
+
+    name = f"bisect-{summary['first_bad'][:8]}-{args.version}-{datetime.now().strftime('%Y%m%d%H%M%S')}.json"
+    with open(os.path.join(REPORTS_DIR, name), "w") as f:
+        json.dump(summary, f, indent=4)
+    notify(summary)
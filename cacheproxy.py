@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import http.client
+import json
+import logging
+import os
+import re
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import SysLogHandler
+from urllib.parse import urlsplit
+
+# Package files never change once published under a given name, so
+# they can be served from the cache forever. Everything else (repo
+# metadata such as repomd.xml, Release, InRelease, Packages) has to
+# be revalidated upstream once it is older than the metadata TTL.
+IMMUTABLE_RE = re.compile(r"\.(rpm|drpm|deb|udeb)$")
+
+# HTTPS repositories are requested from us over plain HTTP as
+# http://HTTPS///<host>/<path> (as apt-cacher-ng does), so that we can
+# cache them, and we fetch them from https://<host>/<path>.
+HTTPS_HOST = "https"
+HTTPS_PREFIX = "http://HTTPS///"
+
+# Mirror lists that dnf picks a mirror from. The mirrors in them are
+# rewritten to go through us too.
+MIRROR_LIST_RE = re.compile(r"(metalink|mirrorlist)")
+
+# Hosts (and their subdomains) of the HTTPS repositories that the VMs use,
+# which are the only ones we tunnel CONNECT requests to, and only on 443
+ALLOWED_HOSTS = [
+    "qubes-os.org",
+    "fedoraproject.org",
+    "debian.org",
+    "freedom.press",
+    "securedrop.org",
+]
+CONNECT_PORT = 443
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    """
+    Handle CLI args.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--listen",
+        default="127.0.0.1",
+        action="store",
+        help="Address to listen on, which should be the bastion's address on the network the VMs are on",
+    )
+    parser.add_argument(
+        "--port",
+        default=3142,
+        type=int,
+        action="store",
+        help="Port to listen on",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default="/var/cache/sdci-packages",
+        action="store",
+        help="Directory to store cached packages and metadata in",
+    )
+    parser.add_argument(
+        "--max-size",
+        default=20480,
+        type=int,
+        action="store",
+        help="Maximum size of the cache in MB, least recently used entries are evicted beyond it",
+    )
+    parser.add_argument(
+        "--metadata-ttl",
+        default=300,
+        type=int,
+        action="store",
+        help="Seconds before repository metadata is revalidated upstream",
+    )
+    parser.add_argument(
+        "--allow-host",
+        default=[],
+        action="append",
+        help="Another host (and its subdomains) that HTTPS can be tunnelled to. Can be given more than once.",
+    )
+    parser.add_argument(
+        "--offline",
+        default=False,
+        action="store_true",
+        help="Serve only from the cache and never contact upstream mirrors",
+    )
+    args = parser.parse_args()
+    return args
+
+
+class PackageCache:
+    def __init__(self, cache_dir, max_size, metadata_ttl):
+        """
+        Set up the on-disk cache. Each entry is stored as a data file plus
+        a small JSON file holding the URL, headers and fetch time.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.metadata_ttl = metadata_ttl
+        self.lock = threading.Lock()
+        # Bytes of package and metadata files in the cache, kept up to date
+        # as entries are stored and evicted
+        self.size = 0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "revalidated": 0,
+            "evictions": 0,
+            "bytes_from_cache": 0,
+            "bytes_from_upstream": 0,
+        }
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def paths(self, url):
+        """
+        Return the data and metadata paths for a URL.
+        """
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        directory = os.path.join(self.cache_dir, key[:2])
+        return os.path.join(directory, key), os.path.join(directory, f"{key}.json")
+
+    def lookup(self, url, offline):
+        """
+        Return the cached metadata for a URL if the entry can be served
+        without going upstream, otherwise None.
+        """
+        data_path, meta_path = self.paths(url)
+        try:
+            with open(meta_path, "r") as m:
+                meta = json.load(m)
+            fresh = time.time() - meta["fetched"] < self.metadata_ttl
+            if offline or fresh or IMMUTABLE_RE.search(urlsplit(url).path):
+                # Bump the access time, which is what eviction orders by
+                os.utime(data_path)
+                return meta
+        except (OSError, ValueError, KeyError, TypeError):
+            # Not cached, evicted under us, or a corrupt entry: a miss
+            pass
+        return None
+
+    def store(self, url, tmp_path, headers):
+        """
+        Move a completed download into the cache and evict old entries
+        if we went over the size limit.
+        """
+        data_path, meta_path = self.paths(url)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        size = os.path.getsize(tmp_path)
+        # Readers don't take the lock, so they must only ever see a whole file
+        fd, tmp_meta_path = tempfile.mkstemp(prefix="tmp", dir=os.path.dirname(meta_path))
+        with os.fdopen(fd, "w") as m:
+            json.dump({"url": url, "fetched": time.time(), "headers": headers}, m)
+        with self.lock:
+            replaced = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+            os.replace(tmp_path, data_path)
+            os.replace(tmp_meta_path, meta_path)
+            self.size += size - replaced
+            over = self.size > self.max_size
+        if over:
+            self.evict()
+
+    def entries(self):
+        """
+        Return (last used, size, path) for every entry in the cache.
+        """
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json") or name.startswith("tmp"):
+                    continue
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                entries.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+        return entries
+
+    def scan(self):
+        """
+        Work out the size of what is already in the cache, at startup.
+        """
+        with self.lock:
+            self.size = sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_size.
+        Only called once the running total says it doesn't, so walking the
+        cache to find the oldest entries is rare.
+        """
+        with self.lock:
+            entries = sorted(self.entries())
+            while self.size > self.max_size and entries:
+                _, size, path = entries.pop(0)
+                logger.debug(f"Evicting {path} from the package cache")
+                os.remove(path)
+                if os.path.exists(f"{path}.json"):
+                    os.remove(f"{path}.json")
+                self.size -= size
+                self.stats["evictions"] += 1
+
+    def count(self, stat, amount=1):
+        with self.lock:
+            self.stats[stat] += amount
+
+    def report(self):
+        """
+        Return the cache statistics, including the hit rate.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        requests_seen = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / requests_seen, 3) if requests_seen else 0.0
+        return stats
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    """
+    A forward HTTP proxy that caches GET responses from package
+    repositories, including HTTPS ones requested as
+    http://HTTPS///<host>/<path>. HTTPS (CONNECT) requests can't be
+    cached and are simply tunnelled through, unless we are offline.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Headers we keep from upstream when replaying a cached response
+    KEEP_HEADERS = ["Content-Type", "Last-Modified", "ETag"]
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_stats(self):
+        body = json.dumps(self.server.cache.report(), indent=4).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_cached(self, url, meta, head_only=False):
+        """
+        Send a cached entry, and return False (having sent nothing) if it
+        was evicted since it was looked up.
+        """
+        data_path, _ = self.server.cache.paths(url)
+        try:
+            f = open(data_path, "rb")
+        except FileNotFoundError:
+            return False
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            self.server.cache.count("hits")
+            self.send_response(200)
+            for name, value in meta["headers"].items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(size))
+            self.send_header("X-Cache", "HIT")
+            self.end_headers()
+            if not head_only:
+                shutil.copyfileobj(f, self.wfile)
+                self.server.cache.count("bytes_from_cache", size)
+        return True
+
+    def do_GET(self, head_only=False):
+        if not self.path.startswith("http://"):
+            # Requests made directly to us rather than through us
+            if self.path == "/stats":
+                self.send_stats()
+            else:
+                self.send_error(404)
+            return
+
+        url = self.path
+        cache = self.server.cache
+        meta = cache.lookup(url, self.server.offline)
+        if meta and self.send_cached(url, meta, head_only):
+            return
+
+        if self.server.offline:
+            cache.count("misses")
+            self.send_error(504, "Not in cache and running in offline mode")
+            return
+
+        parts = urlsplit(url)
+        if parts.hostname == HTTPS_HOST:
+            parts = urlsplit(f"https://{url[len(HTTPS_PREFIX):]}")
+            conn = http.client.HTTPSConnection(parts.hostname, parts.port or 443, timeout=60)
+        else:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+        try:
+            conn.request("GET", path, headers={"Host": parts.netloc, "User-Agent": self.headers.get("User-Agent", "")})
+            resp = conn.getresponse()
+        except OSError as e:
+            # Upstream is unreachable, so fall back to whatever we have
+            meta = cache.lookup(url, offline=True)
+            if meta and self.send_cached(url, meta, head_only):
+                logger.debug(f"Upstream error for {url}, served stale copy: {e}")
+            else:
+                cache.count("misses")
+                self.send_error(502, f"Upstream error: {e}")
+            return
+
+        if resp.status != 200:
+            # Pass redirects, 404s etc straight through without caching them
+            body = resp.read()
+            cache.count("misses")
+            self.send_response(resp.status)
+            for name, value in resp.getheaders():
+                if name.lower() not in ["transfer-encoding", "connection", "content-length"]:
+                    self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if not head_only:
+                self.wfile.write(body)
+            conn.close()
+            return
+
+        if cache.lookup(url, offline=True):
+            cache.count("revalidated")
+        cache.count("misses")
+
+        headers = {name: resp.getheader(name) for name in self.KEEP_HEADERS if resp.getheader(name)}
+        if MIRROR_LIST_RE.search(parts.path):
+            self.send_mirror_list(url, resp, headers, head_only)
+            conn.close()
+            return
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        length = resp.getheader("Content-Length")
+        if length:
+            self.send_header("Content-Length", length)
+        else:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.send_header("X-Cache", "MISS")
+        self.end_headers()
+
+        # Stream to the client and into a temporary file at the same time
+        fd, tmp_path = tempfile.mkstemp(prefix="tmp", dir=cache.cache_dir)
+        received = 0
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                while True:
+                    chunk = resp.read(65536)
+                    if not chunk:
+                        break
+                    tmp.write(chunk)
+                    received += len(chunk)
+                    if not head_only:
+                        self.wfile.write(chunk)
+            cache.count("bytes_from_upstream", received)
+            if length is None or int(length) == received:
+                cache.store(url, tmp_path, headers)
+        finally:
+            conn.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def send_mirror_list(self, url, resp, headers, head_only):
+        """
+        Send and cache a mirror list with its HTTPS mirrors rewritten to
+        come through us, so that the packages dnf then fetches from them
+        are cached too.
+        """
+        body = resp.read()
+        self.server.cache.count("bytes_from_upstream", len(body))
+        body = body.replace(b"https://", HTTPS_PREFIX.encode("utf-8"))
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Cache", "MISS")
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+        fd, tmp_path = tempfile.mkstemp(prefix="tmp", dir=self.server.cache.cache_dir)
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(body)
+        self.server.cache.store(url, tmp_path, headers)
+
+    def do_HEAD(self):
+        self.do_GET(head_only=True)
+
+    def do_CONNECT(self):
+        if self.server.offline:
+            self.send_error(504, "Tunnelling is not available in offline mode")
+            return
+
+        host, _, port = self.path.rpartition(":")
+        if not self.server.allowed(host, port):
+            logger.debug(f"Refusing to tunnel to {self.path}")
+            self.send_error(403, "Tunnelling is only allowed to package repositories")
+            return
+        try:
+            upstream = socket.create_connection((host, CONNECT_PORT), timeout=60)
+        except OSError as e:
+            self.send_error(502, f"Upstream error: {e}")
+            return
+
+        self.send_response(200, "Connection established")
+        self.end_headers()
+        self.close_connection = True
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, errored = select.select(sockets, [], sockets, 60)
+                if errored or not readable:
+                    break
+                for s in readable:
+                    data = s.recv(65536)
+                    if not data:
+                        return
+                    (upstream if s is self.connection else self.connection).sendall(data)
+        finally:
+            upstream.close()
+
+
+class CacheProxy(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cache, offline, allowed_hosts=ALLOWED_HOSTS):
+        super().__init__(address, ProxyHandler)
+        self.cache = cache
+        self.offline = offline
+        self.allowed_hosts = [host.lower().strip(".") for host in allowed_hosts]
+
+    def allowed(self, host, port):
+        """
+        Whether a CONNECT request can be tunnelled, so that we aren't an
+        open relay: only to port 443 of the allowed hosts.
+        """
+        if port != str(CONNECT_PORT):
+            return False
+        host = host.lower().rstrip(".")
+        return any(host == allowed or host.endswith(f".{allowed}") for allowed in self.allowed_hosts)
+
+
+def log_stats(cache, interval=600):
+    """
+    Periodically write the cache statistics to syslog.
+    """
+    while True:
+        time.sleep(interval)
+        logger.debug(f"Package cache stats: {json.dumps(cache.report())}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    logger.setLevel(logging.DEBUG)
+    handler = SysLogHandler(facility=SysLogHandler.LOG_DAEMON, address="/dev/log")
+    handler.setFormatter(logging.Formatter("ws-ci-cache: %(message)s"))
+    logger.addHandler(handler)
+
+    cache = PackageCache(args.cache_dir, args.max_size * 1024 * 1024, args.metadata_ttl)
+    cache.scan()
+    cache.evict()
+    threading.Thread(target=log_stats, args=(cache,), daemon=True).start()
+
+    server = CacheProxy((args.listen, args.port), cache, args.offline, ALLOWED_HOSTS + args.allow_host)
+    mode = "offline" if args.offline else "online"
+    logger.debug(f"Package cache listening on {args.listen}:{args.port} ({mode})")
+    server.serve_forever()
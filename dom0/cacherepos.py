@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Where dnf and apt read their repositories from
+REPO_FILES = (
+    "/etc/yum.repos.d/*.repo /etc/apt/sources.list "
+    "/etc/apt/sources.list.d/*.list /etc/apt/sources.list.d/*.sources"
+)
+
+# The package cache can only cache HTTPS repositories requested from it
+# as http://HTTPS///<host>/<path>
+HTTPS_PREFIX = "http://HTTPS///"
+
+# Neither dnf nor apt reads files with this suffix, so the originals can
+# sit next to the rewritten files until they are put back
+BACKUP = ".sdci-orig"
+
+# Run as root. Keeps a copy of each repository file that uses HTTPS and
+# rewrites it to go through the package cache. {extra} is more sed.
+REWRITE = (
+    "for f in " + REPO_FILES + "; do "
+    "[ -f \"$f\" ] && grep -q 'https://' \"$f\" && [ ! -e \"$f" + BACKUP + "\" ] || continue; "
+    "cp -p \"$f\" \"$f" + BACKUP + "\" && "
+    "sed -i -e 's|https://|" + HTTPS_PREFIX + "|g' {extra} \"$f\"; "
+    "done"
+)
+
+# Run as root. Puts the original repository files back.
+RESTORE = (
+    "for f in /etc/yum.repos.d/*" + BACKUP + " /etc/apt/*" + BACKUP + " /etc/apt/sources.list.d/*" + BACKUP + "; do "
+    "[ -f \"$f\" ] && mv \"$f\" \"${f%" + BACKUP + "}\"; "
+    "done; true"
+)
+
+
+def parse_args():
+    """
+    Handle CLI args.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--proxy",
+        action="store",
+        help="The package cache, as host:port",
+    )
+    parser.add_argument(
+        "--restore",
+        default=False,
+        action="store_true",
+        help="Put the original repository files back",
+    )
+    parser.add_argument(
+        "--targets",
+        default=None,
+        action="store",
+        help="Comma-separated dom0, templates and standalones (default: all of them)",
+    )
+    parser.add_argument(
+        "--parallel",
+        default=4,
+        type=int,
+        action="store",
+        help="How many templates and standalones to change at once",
+    )
+    args = parser.parse_args()
+    if not args.restore and not args.proxy:
+        parser.error("--proxy is required unless --restore is given")
+    return args
+
+
+class CacheRepos:
+    def __init__(self, proxy, restore, parallel):
+        """
+        Point the repositories of dom0 and the templates and standalones
+        at the package cache while updates are applied, and put them back
+        afterwards, so that the rewritten files never end up in a snapshot
+        or depend on the cache being there.
+
+        Templates and standalones download through the Qubes updates
+        proxy, which run.py chains to the cache. dom0 downloads through
+        the UpdateVM with dom0's repository files, so those also get the
+        cache as their proxy.
+        """
+        self.proxy = proxy
+        self.restore = restore
+        self.parallel = parallel
+
+    def script(self, extra=""):
+        return RESTORE if self.restore else REWRITE.format(extra=extra)
+
+    def dom0(self):
+        extra = f"-e '/^\\[.*\\]/a proxy=http://{self.proxy}'"
+        subprocess.run(["sudo", "sh", "-c", self.script(extra)], check=True)
+
+    def vm(self, name, was_running):
+        subprocess.run(
+            ["qvm-run", "--pass-io", "--no-gui", "-u", "root", name, self.script()],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=300,
+        )
+        # Leave things as we found them
+        if not was_running:
+            subprocess.run(["qvm-shutdown", "--wait", name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def vms(self, names):
+        import qubesadmin
+        targets = [
+            (vm.name, vm.is_running())
+            for vm in qubesadmin.Qubes().domains
+            if vm.klass in ("TemplateVM", "StandaloneVM") and (names is None or vm.name in names)
+        ]
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            list(executor.map(lambda target: self.vm(*target), targets))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    names = args.targets.split(",") if args.targets else None
+    repos = CacheRepos(args.proxy, args.restore, args.parallel)
+    if names is None or "dom0" in names:
+        repos.dom0()
+    if names is None or [name for name in names if name != "dom0"]:
+        repos.vms(names)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+REPO = "freedomofpress/securedrop-workstation"
+
+
+def parse_args():
+    """
+    Handle CLI args.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--vm",
+        default="dom0",
+        action="store",
+        help="Which set of checks to run (dom0 runs the sd-dev ones in sd-dev too)",
+    )
+    parser.add_argument(
+        "--min-free-gb",
+        default=5,
+        type=float,
+        action="store",
+        help="Minimum free disk space on each filesystem and storage pool",
+    )
+    args = parser.parse_args()
+    return args
+
+
+class Preflight:
+    def __init__(self, vm, min_free_gb):
+        """
+        Quick checks that a CI run has what it needs, so that we find
+        out in seconds rather than partway through the build.
+        """
+        self.vm = vm
+        self.min_free_gb = min_free_gb
+        self.results = []
+
+    def check(self, name, ok, detail=""):
+        self.results.append({"vm": self.vm, "check": name, "ok": bool(ok), "detail": detail})
+
+    def check_disk(self, path):
+        if not os.path.exists(path):
+            return
+        free_gb = shutil.disk_usage(path).free / 1024 ** 3
+        self.check(f"disk space on {path}", free_gb >= self.min_free_gb, f"{free_gb:.1f} GB free")
+
+    def check_file(self, path, executable=False):
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            self.check(f"{path} present", False, "missing or empty")
+        elif executable and not os.access(path, os.X_OK):
+            self.check(f"{path} present", False, "not executable")
+        else:
+            self.check(f"{path} present", True)
+
+    def check_url(self, name, url, headers=None):
+        request = urllib.request.Request(url, headers=headers or {}, method="GET")
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                self.check(name, True, f"HTTP {response.status}")
+        except urllib.error.HTTPError as e:
+            self.check(name, False, f"HTTP {e.code}")
+        except (urllib.error.URLError, OSError) as e:
+            self.check(name, False, str(e))
+
+    def dom0(self):
+        self.check_disk("/")
+        self.check_disk("/var/lib/qubes")
+        try:
+            import qubesadmin
+            for pool in qubesadmin.Qubes().pools.values():
+                if not pool.size:
+                    continue
+                free_gb = (pool.size - (pool.usage or 0)) / 1024 ** 3
+                self.check(f"space in storage pool {pool.name}", free_gb >= self.min_free_gb, f"{free_gb:.1f} GB free")
+        except Exception as e:
+            self.check("storage pools", False, str(e))
+
+        self.check_file("/home/user/runner.py", executable=True)
+        self.check_file("/home/user/.logfile")
+        self.check_file("/etc/qubes-rpc/qubes.SDCIRunner", executable=True)
+        policy = "/etc/qubes-rpc/policy/qubes.SDCIRunner"
+        try:
+            with open(policy, "r") as p:
+                rules = [line.split() for line in p if line.strip() and not line.startswith("#")]
+            self.check("qrexec policy allows sd-dev to start the runner", ["sd-dev", "dom0", "allow"] in rules)
+        except OSError as e:
+            self.check("qrexec policy allows sd-dev to start the runner", False, str(e))
+
+        # Run the sd-dev checks there, by feeding it this script
+        with open(os.path.abspath(__file__), "rb") as f:
+            source = f.read()
+        try:
+            p = subprocess.run(
+                [
+                    "qvm-run", "--pass-io", "--no-gui", "sd-dev",
+                    f"python3 - --vm sd-dev --min-free-gb {self.min_free_gb}",
+                ],
+                input=source,
+                capture_output=True,
+                timeout=90,
+            )
+            self.results.extend(json.loads(p.stdout))
+        except (subprocess.TimeoutExpired, ValueError) as e:
+            self.check("sd-dev responds", False, str(e))
+
+    def sd_dev(self):
+        self.check_disk("/")
+        self.check_disk("/home")
+        self.check_disk("/var/lib")
+        for path in ["/home/user/bin/begin.py", "/home/user/bin/status.py", "/home/user/bin/delivery.py"]:
+            self.check_file(path)
+
+        try:
+            with open("/home/user/context.json", "r") as c:
+                context = json.load(c)
+            self.check("context.json is valid", all(k in context for k in ["commit", "author", "message", "reason"]))
+        except (OSError, ValueError) as e:
+            self.check("context.json is valid", False, str(e))
+
+        self.check_url("network reaches github.com", "https://github.com")
+        try:
+            with open("/home/user/.sdci-ghp.txt", "r") as t:
+                token = t.read().strip()
+        except OSError:
+            token = ""
+        if token:
+            self.check_url(
+                "Github token is accepted",
+                f"https://api.github.com/repos/{REPO}",
+                {"Authorization": f"Bearer {token}"},
+            )
+        else:
+            self.check("Github token is accepted", False, "/home/user/.sdci-ghp.txt is missing or empty")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    started = time.monotonic()
+    preflight = Preflight(args.vm, args.min_free_gb)
+    if args.vm == "dom0":
+        preflight.dom0()
+    else:
+        preflight.sd_dev()
+        print(json.dumps(preflight.results))
+        sys.exit(0)
+
+    ok = all(r["ok"] for r in preflight.results)
+    summary = {"ok": ok, "seconds": round(time.monotonic() - started, 1), "checks": preflight.results}
+    with open("/home/user/.preflight.json", "w") as f:
+        json.dump(summary, f, indent=4)
+    for r in preflight.results:
+        print(f"{'ok' if r['ok'] else 'FAILED'}: {r['vm']}: {r['check']} {r['detail']}".rstrip())
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# dnf check-update (and so qubes-dom0-update --check-only) exits with this
+# when there are updates
+UPDATES_AVAILABLE = 100
+
+# Run as root in each template and standalone. Prints 100 if it has
+# updates, 0 if not, and nothing if it couldn't tell.
+CHECK_VM = (
+    "if command -v dnf >/dev/null; then dnf -q check-update >/dev/null 2>&1; echo $?; "
+    "elif apt-get -qq update >/dev/null 2>&1; then "
+    "if apt-get -s -q dist-upgrade | grep -q '^Inst '; then echo 100; else echo 0; fi; fi"
+)
+
+
+def parse_args():
+    """
+    Handle CLI args.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--parallel",
+        default=4,
+        type=int,
+        action="store",
+        help="How many templates and standalones to check at once",
+    )
+    args = parser.parse_args()
+    return args
+
+
+class UpdateCheck:
+    def __init__(self, parallel):
+        """
+        Find out whether dom0 and each template and standalone have
+        updates available, without installing anything, so that the
+        nightly updates only touch the ones that need it.
+        """
+        self.parallel = parallel
+        self.updates = []
+        self.up_to_date = []
+        self.unknown = []
+
+    def record(self, name, result):
+        if result == UPDATES_AVAILABLE:
+            self.updates.append(name)
+        elif result == 0:
+            self.up_to_date.append(name)
+        else:
+            self.unknown.append(name)
+
+    def dom0(self):
+        try:
+            p = subprocess.run(
+                ["sudo", "qubes-dom0-update", "--check-only"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=600,
+            )
+            self.record("dom0", p.returncode)
+        except subprocess.TimeoutExpired:
+            self.record("dom0", None)
+
+    def vm(self, name, was_running):
+        try:
+            p = subprocess.run(
+                ["qvm-run", "--pass-io", "--no-gui", "-u", "root", name, CHECK_VM],
+                capture_output=True,
+                timeout=600,
+            )
+            output = p.stdout.decode("utf-8", "replace").strip()
+            result = int(output) if output.isdigit() else None
+        except subprocess.TimeoutExpired:
+            result = None
+        # Leave things as we found them
+        if not was_running:
+            subprocess.run(["qvm-shutdown", "--wait", name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return name, result
+
+    def vms(self):
+        import qubesadmin
+        targets = [
+            (vm.name, vm.is_running())
+            for vm in qubesadmin.Qubes().domains
+            if vm.klass in ("TemplateVM", "StandaloneVM")
+        ]
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            for name, result in executor.map(lambda target: self.vm(*target), targets):
+                self.record(name, result)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    started = time.monotonic()
+    check = UpdateCheck(args.parallel)
+    check.dom0()
+    check.vms()
+
+    summary = {
+        "updates": sorted(check.updates),
+        "up_to_date": sorted(check.up_to_date),
+        "unknown": sorted(check.unknown),
+        "seconds": round(time.monotonic() - started, 1),
+    }
+    with open("/home/user/.updatecheck.json", "w") as f:
+        json.dump(summary, f, indent=4)
+    for key in ["updates", "up_to_date", "unknown"]:
+        print(f"{key}: {' '.join(summary[key]) or '-'}")
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from run import CiRunner
+
+
+def parse_args():
+    """
+    Handle CLI args.
+    """
+    parser = argparse.ArgumentParser(description="Run several CI builds from one process")
+    parser.add_argument(
+        "--version",
+        required=True,
+        action="append",
+        help="Qubes version to run the builds on. Can be given more than once to run each build on each version.",
+    )
+    parser.add_argument(
+        "--context",
+        required=True,
+        action="append",
+        help="JSON context of a build, as for run.py. Give it once per build.",
+    )
+    parser.add_argument(
+        "--update",
+        default=False,
+        action="store_true",
+        help="Apply updates before running each build",
+    )
+    args = parser.parse_args()
+    return args
+
+
+class Build:
+    def __init__(self, engine, version, context, snapshot_name=False, update=False, checkpoint=False, notify_queued=True):
+        """
+        One CI run in the engine. It has its own CiRunner, and so its own
+        VM and job state, but shares the engine's vSphere sessions.
+        """
+        self.version = version
+        self.context = context
+        self.commit = context["commit"]
+        self.snapshot_name = snapshot_name
+        self.update = update
+        self.checkpoint = checkpoint
+        self.notify_queued = notify_queued
+        self.runner = CiRunner(shared=engine.runner)
+        self.queued = datetime.now()
+        self.state = "queued"
+        self.canceled = False
+        self.task = None
+
+
+class Engine:
+    def __init__(self, runner=None):
+        """
+        Drives many CI runs from one process, with one vSphere session
+        per endpoint between them.
+
+        Waiting for a free VM is done on the event loop, so a queued build
+        costs a coroutine rather than a process with its own session. Once
+        a build has a VM, its blocking CiRunner calls run in a bounded
+        thread pool. max_builds limits how many builds have a VM at once,
+        and two more threads are kept for short calls such as picking VMs
+        and canceling builds. Builds only claim a VM once there is room
+        for them to run.
+        """
+        self.runner = runner or CiRunner()
+        config = self.runner.config
+        self.max_builds = config.getint("Engine", "max_builds", fallback=8)
+        self.poll = config.getfloat("Engine", "poll", fallback=60)
+        # By default, how long builds have been taking to start
+        self.give_up = config.getfloat("Engine", "give_up", fallback=0)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_builds + 2)
+        self.slots = asyncio.Semaphore(self.max_builds)
+        # Only one build picks a VM at a time, and VMs that have been
+        # picked stay claimed until their build finishes
+        self.picking = asyncio.Lock()
+        self.claimed = set()
+        self.builds = {}
+
+    async def call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def build(self, version, context, snapshot_name=False, update=False, checkpoint=False, notify_queued=True):
+        """
+        Run a build and return its final status, as CiRunner.main() does.
+        Unless notify_queued is off, because the caller already has, post
+        its queued status first.
+        """
+        build = Build(self, version, context, snapshot_name, update, checkpoint, notify_queued)
+        key = (build.commit, version)
+        if key in self.builds:
+            raise SystemError(f"{build.commit} is already building on Qubes {version}")
+        build.task = asyncio.current_task()
+        self.builds[key] = build
+        try:
+            return await self.run(build)
+        except asyncio.CancelledError:
+            if not build.canceled:
+                raise
+            build.runner.logger.debug(f"Canceled {build.commit} on Qubes {version} while it was queued")
+            await self.call(
+                build.runner.github_status,
+                build.commit,
+                "error",
+                "The build was canceled by an administrator",
+                None,
+                version,
+            )
+            return "canceled"
+        finally:
+            del self.builds[key]
+
+    async def run(self, build):
+        runner = build.runner
+        if build.notify_queued:
+            await self.call(runner.notify_github_queued, build.commit, build.version)
+
+        give_up = self.give_up or await self.call(runner.vm_wait, build.version)
+        start_time = time.monotonic()
+        while True:
+            picked = None
+            async with self.picking:
+                # Don't claim a VM we wouldn't have a thread to run the build on
+                if not self.slots.locked():
+                    picked = await self.call(runner.pick_vm, build.version, self.claimed)
+                if picked:
+                    self.claimed.add(picked[2].config.uuid)
+                    await self.slots.acquire()
+            if picked:
+                break
+            if time.monotonic() - start_time > give_up:
+                await self.call(runner.notify_github_gave_up, build.commit, build.version)
+                raise SystemError(f"Gave up waiting for a Qubes {build.version} VM for {build.commit}")
+            runner.logger.debug(
+                f"Couldn't find any VMs matching version {build.version} that are not in use "
+                f"for {build.commit}, sleeping for {self.poll:.0f} seconds"
+            )
+            await asyncio.sleep(self.poll)
+
+        endpoint, runner.content, runner.vm = picked
+        runner.use_endpoint(endpoint)
+        build.state = "running"
+        try:
+            return await self.call(
+                runner.run_on_vm,
+                build.version,
+                build.context,
+                build.snapshot_name,
+                build.update,
+                build.checkpoint,
+                build.queued,
+            )
+        finally:
+            self.slots.release()
+            self.claimed.discard(runner.vm.config.uuid)
+
+    async def cancel(self, commit, version):
+        """
+        Cancel a build. A queued one simply stops waiting; a running one
+        is canceled as run.py --cancel would, which frees its VM.
+
+        Returns False if there is no such build.
+        """
+        build = self.builds.get((commit, version))
+        if build is None:
+            return False
+        build.canceled = True
+        if build.state == "queued":
+            build.task.cancel()
+            return True
+        try:
+            await self.call(CiRunner(shared=self.runner).cancel, commit, version)
+        except SystemError as e:
+            # It is still reverting or booting, so it'll stop at its next wait
+            build.runner.logger.debug(f"Stopping {commit} on {build.runner.vm.name}: {e}")
+        build.runner.stopping.set()
+        return True
+
+    def summary(self):
+        running = [build for build in self.builds.values() if build.state == "running"]
+        return f"{len(running)} builds running, {len(self.builds) - len(running)} queued"
+
+
+async def run_builds(engine, versions, contexts, snapshot_name=False, update=False, checkpoint=False):
+    """
+    Run every build on every Qubes version at once, and return their
+    final statuses keyed by (commit, version). A build that raised (e.g
+    gave up waiting for a VM) counts as an error.
+    """
+    keys = [(context["commit"], version) for context in contexts for version in versions]
+    tasks = [
+        asyncio.create_task(engine.build(version, context, snapshot_name, update, checkpoint))
+        for context in contexts
+        for version in versions
+    ]
+    statuses = await asyncio.gather(*tasks, return_exceptions=True)
+    for (commit, version), status in zip(keys, statuses):
+        if isinstance(status, Exception):
+            engine.runner.logger.debug(f"Build of {commit} on Qubes {version} failed: {status}")
+    return {
+        key: "error" if isinstance(status, Exception) else status
+        for key, status in zip(keys, statuses)
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    engine = Engine()
+    contexts = [json.loads(context) for context in args.context]
+    statuses = asyncio.run(run_builds(engine, args.version, contexts, update=args.update))
+    for (commit, version), status in statuses.items():
+        print(f"{commit} on Qubes {version}: {status}")
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import git
 import json
 import logging
@@ -8,7 +9,16 @@ import os
 import re
 import subprocess
 import tempfile
+import time
 import yaml
+from datetime import datetime
+from engine import Engine
+from run import CiRunner, StatusDelivery, CURRENT_DIR, REPORTS_DIR
+from reports import load_flaky_db, flaky_ranking
+
+# How long we expect a nightly run to take, in minutes, used to order the
+# runs and to check that they fit in the nightly window.
+DEFAULT_EXPECTED_MINUTES = 90
 
 
 def parse_args():
@@ -18,18 +28,81 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--branch",
-        default="main",
-        required=True,
+        action="append",
+        help="Branch of SDW repo to check out. Can be given more than once."
+    )
+    parser.add_argument(
+        "--config",
+        action="store",
+        help="YAML file listing the branches (and optionally Qubes versions) to run nightlies for"
+    )
+    parser.add_argument(
+        "--window",
+        default=360,
+        type=int,
         action="store",
-        help="Branch of SDW repo to check out"
+        help="Minutes that all nightly runs should finish within"
     )
     args = parser.parse_args()
+    if not args.branch and not args.config:
+        parser.error("one of --branch or --config is required")
     return args
 
 
-def nightly(branch):
+def load_plan(args):
+    """
+    Build the list of branches to test from the CLI args and config file.
+
+    The config file looks like:
+
+        window: 360
+        branches:
+          - branch: main
+          - branch: release-1.0
+            qubes: ["4.2"]
+            expected_minutes: 120
+
+    Branches without a 'qubes' list use the version(s) in their
+    .github/workstation-ci.yml.
+    """
+    branches = [{"branch": branch} for branch in args.branch or []]
+    window = args.window
+    if args.config:
+        with open(args.config, "r") as c:
+            config = yaml.safe_load(c) or {}
+        window = config.get("window", window)
+        for entry in config.get("branches", []):
+            if isinstance(entry, str):
+                entry = {"branch": entry}
+            branches.append(entry)
+    return branches, window
+
+
+def parse_qubes_versions(yaml_data):
+    """
+    Return the Qubes version(s) listed under 'qubes' in a parsed
+    .github/workstation-ci.yml, which can be a single version or a list.
+    """
+    versions = yaml_data.get("qubes", [])
+    if not isinstance(versions, list):
+        versions = [versions]
+    valid = []
+    for version in versions:
+        version = str(version)
+        if re.match(r'^\d+\.\d+$', version):
+            valid.append(version)
+        else:
+            logging.info(f"Didn't recognise the qubes version {version} in the CI YAML file.")
+    return valid
+
+
+def branch_jobs(entry):
+    """
+    Clone a branch and return one job per Qubes version to test its HEAD on.
+    """
+    branch = entry["branch"]
     repo_url = "https://github.com/freedomofpress/securedrop-workstation.git"
-    logging.info(f"Running nightly SDW CI against branch {branch}")
+    logging.info(f"Preparing nightly SDW CI against branch {branch}")
 
     with tempfile.TemporaryDirectory() as repo_working_dir:
         # Clone the repo and check out this branch
@@ -48,47 +121,164 @@ def nightly(branch):
         # Get the commit message
         message = commit.message
 
-        # Check if 'qubes' attribute exists in the YAML data.
-        yaml_data = {}
-        ci_file = f"{repo_working_dir}/.github/workstation-ci.yml"
-        if os.path.exists(ci_file):
+        versions = entry.get("qubes")
+        if not versions:
+            # Check if 'qubes' attribute exists in the YAML data.
+            yaml_data = {}
+            ci_file = f"{repo_working_dir}/.github/workstation-ci.yml"
+            if not os.path.exists(ci_file):
+                logging.info(f"The CI YAML file {ci_file} does not exist.")
+                return []
             try:
                 with open(ci_file, "r") as y:
                     yaml_data = yaml.safe_load(y)
             except yaml.YAMLError as e:
                 logging.info(f"Error reading CI YAML file {ci_file}: {e}")
-                return
-
-            # If it does, run the CI.
-            if "qubes" in yaml_data:
-                qubes_version = yaml_data["qubes"]
-                if re.match(r'^\d+\.\d+$', qubes_version):
-                    context = {
-                        "commit": sha,
-                        "author": author,
-                        "message": message,
-                        "reason": "nightly"
-                    }
-                    subprocess.Popen([
-                        "/home/wscirunner/venv/bin/python",
-                        "/home/wscirunner/securedrop-workstation-ci/run.py",
-                        "--version",
-                        qubes_version,
-                        "--update",
-                        "--context",
-                        json.dumps(context)
-                    ],cwd="/home/wscirunner/securedrop-workstation-ci")
-                else:
-                    logging.info(f"Didn't recognise the qubes version in the YAML file {ci_file}.")
-                    return
-            else:
+                return []
+            if "qubes" not in yaml_data:
                 logging.info(f"The 'qubes' attribute does not exist in the YAML file {ci_file}.")
-                return
-        else:
-            logging.info(f"The CI YAML file {ci_file} does not exist.")
-            return
+                return []
+            versions = yaml_data["qubes"]
+
+    jobs = []
+    for qubes_version in parse_qubes_versions({"qubes": versions}):
+        jobs.append({
+            "branch": branch,
+            "version": qubes_version,
+            "expected_minutes": entry.get("expected_minutes", DEFAULT_EXPECTED_MINUTES),
+            "context": {
+                "commit": sha,
+                "author": author,
+                "message": message,
+                "reason": "nightly"
+            },
+        })
+    return jobs
+
+
+def check_window(jobs, capacity, window):
+    """
+    Estimate when the last job for each Qubes version finishes, given
+    the order we'll start them in and the number of VMs available, and
+    warn if that is past the end of the nightly window.
+    """
+    for version, slots in capacity.items():
+        finish_times = [0] * max(slots, 1)
+        for job in [j for j in jobs if j["version"] == version]:
+            # Each job goes to whichever VM frees up first
+            earliest = finish_times.index(min(finish_times))
+            finish_times[earliest] += job["expected_minutes"]
+        makespan = max(finish_times)
+        logging.info(f"Expecting Qubes {version} nightlies to take {makespan} minutes on {slots} VMs")
+        if makespan > window:
+            logging.info(f"Qubes {version} nightlies may not finish within the {window} minute window")
+
+
+async def run_job(engine, job, slots):
+    async with slots:
+        logging.info(f"Starting nightly for {job['branch']} on Qubes {job['version']}")
+        job["started"] = time.time()
+        try:
+            job["result"] = await engine.build(job["version"], job["context"], update=True)
+        except Exception as e:
+            logging.info(f"Nightly for {job['branch']} on Qubes {job['version']} failed: {e}")
+            job["result"] = "error"
+        job["minutes"] = round((time.time() - job["started"]) / 60)
+        logging.info(f"Nightly for {job['branch']} on Qubes {job['version']} finished: {job['result']}")
+
+
+def dispatch(ci, jobs, capacity):
+    """
+    Run the jobs, never running more at once for a Qubes version than
+    there are VMs for it, and wait for all of them to finish.
+
+    They all run in one engine.py Engine, sharing our vSphere session,
+    rather than in a run.py process each.
+    """
+    async def run_all():
+        engine = Engine(ci)
+        slots = {version: asyncio.Semaphore(count) for version, count in capacity.items()}
+        # Semaphores wake waiters in order, so the jobs still start longest first
+        await asyncio.gather(*(run_job(engine, job, slots[job["version"]]) for job in jobs))
+
+    asyncio.run(run_all())
+
+
+def summarize(jobs):
+    """
+    Write a combined summary of all the nightly runs, and post it to Slack.
+    """
+    summary = [
+        {
+            "branch": job["branch"],
+            "version": job["version"],
+            "commit": job["context"]["commit"],
+            "result": job.get("result", "not run"),
+            "minutes": job.get("minutes"),
+        }
+        for job in jobs
+    ]
+    date_name = datetime.now().strftime("%Y-%m-%d")
+    with open(os.path.join(REPORTS_DIR, f"nightly-{date_name}.json"), "w") as f:
+        json.dump(summary, f, indent=4)
+
+    lines = [
+        f"{s['branch']} on Qubes {s['version']} ({s['commit'][:8]}): {s['result']}, {s['minutes']} minutes"
+        for s in summary
+    ]
+    for line in lines:
+        logging.info(line)
+
+    # Keep an eye on the tests that are only passing thanks to retries
+    flaky = flaky_ranking(load_flaky_db(REPORTS_DIR))[:5]
+    if flaky:
+        lines.append("Flakiest tests in the last 30 days:")
+        lines.extend(f"{test} ({entry['flips']} flips)" for test, entry in flaky)
+
+    passed = all(s["result"] == "success" for s in summary)
+    delivery = StatusDelivery(
+        logging.getLogger(__name__),
+        os.path.join(CURRENT_DIR, "sd-dev/.sdci-ghp.txt"),
+        os.path.join(CURRENT_DIR, "sd-dev/.slack-webhook.txt"),
+    )
+    delivery.slack({
+        "attachments": [
+            {
+                "color": "good" if passed else "danger",
+                "pretext": f"SDW CI nightlies for {date_name}",
+                "text": "\n".join(lines),
+                "fallback": "\n".join(lines),
+            }
+        ]
+    })
+
+
+def nightlies(entries, window):
+    jobs = []
+    for entry in entries:
+        jobs.extend(branch_jobs(entry))
+    if not jobs:
+        logging.info("No nightly runs to do")
+        return
+
+    # Only run as many jobs at once for a version as there are VMs for it
+    ci = CiRunner()
+    capacity = {}
+    for version in set(job["version"] for job in jobs):
+        capacity[version] = ci.count_vms(version)
+        if capacity[version] == 0:
+            logging.info(f"There are no VMs for Qubes {version}, skipping its nightlies")
+    jobs = [job for job in jobs if capacity[job["version"]] > 0]
+
+    # Start the longest jobs first, so the short ones fill in the gaps at the end
+    jobs.sort(key=lambda job: job["expected_minutes"], reverse=True)
+    check_window(jobs, capacity, window)
+    dispatch(ci, jobs, capacity)
+    summarize(jobs)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     args = parse_args()
-    nightly(branch=args.branch)
+    entries, window = load_plan(args)
+    nightlies(entries, window)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import argparse
+import configparser
+import fcntl
+import json
+import os
+import time
+
+# How long a run can go without polling before we assume it died and
+# stop keeping a place in the queue for it
+STALE_AFTER = 30
+
+
+def parse_args():
+    """
+    Handle CLI args.
+    """
+    parser = argparse.ArgumentParser(description="Show the shared guest operations rate limiter's counters")
+    parser.add_argument(
+        "--reset",
+        default=False,
+        action="store_true",
+        help="Reset the counters after showing them",
+    )
+    args = parser.parse_args()
+    return args
+
+
+class GuestOpsLimiter:
+    def __init__(self, logger, state_file, run_id, rate=5.0, burst=10, poll=0.2):
+        """
+        A token bucket shared by every CiRunner on this host (whether in
+        separate run.py processes or in one webhook.py), so that together
+        they don't make more guest operations calls to hostd than it can
+        take.
+
+        The bucket lives in a JSON file, locked with flock while it is
+        read and updated. Runs waiting for a token are served in turn,
+        the one that was served longest ago first, so that a run polling
+        a long command can't starve one that is uploading files. A run
+        whose process has gone loses its place straight away, rather than
+        holding up the others until it goes stale.
+        """
+        self.logger = logger
+        self.state_file = state_file
+        self.run_id = run_id
+        self.rate = rate
+        self.burst = burst
+        self.poll = poll
+        self.reset()
+
+    def reset(self):
+        """
+        Reset the counters for this run. The totals for all runs are
+        kept in the state file.
+        """
+        self.calls = 0
+        self.throttled = 0
+        self.waited = 0.0
+
+    def acquire(self):
+        """
+        Block until this run may make a guest operations call.
+        """
+        if self.rate <= 0:
+            return
+        try:
+            waited = self.wait_for_token()
+        except BaseException:
+            # Don't keep a place in the queue that nobody will take
+            with StateFile(self.state_file) as state:
+                waiting = state["waiting"].get(self.run_id)
+                if waiting:
+                    waiting["count"] -= 1
+                    if waiting["count"] <= 0:
+                        del state["waiting"][self.run_id]
+            raise
+
+        self.calls += 1
+        if waited is not None:
+            self.throttled += 1
+            self.waited += waited
+
+    def wait_for_token(self):
+        """
+        Queue for a token and take it when it is our turn. Returns how
+        long we were throttled for, or None if we weren't.
+        """
+        start = time.monotonic()
+        throttled = False
+        while True:
+            with StateFile(self.state_file) as state:
+                # Timestamps in the state are shared between processes, so
+                # they are wall clock time
+                now = time.time()
+                self.refill(state, now)
+                waiting = state["waiting"]
+                waiting.setdefault(self.run_id, {"count": 0, "seen": now, "pid": os.getpid()})
+                if not throttled:
+                    waiting[self.run_id]["count"] += 1
+                waiting[self.run_id]["seen"] = now
+                for run_id in [r for r, w in waiting.items() if now - w["seen"] > STALE_AFTER or not alive(w.get("pid"))]:
+                    del waiting[run_id]
+                    state["last_served"].pop(run_id, None)
+
+                if state["tokens"] >= 1 and self.next_run(state) == self.run_id:
+                    state["tokens"] -= 1
+                    state["last_served"][self.run_id] = now
+                    waiting[self.run_id]["count"] -= 1
+                    if waiting[self.run_id]["count"] <= 0:
+                        del waiting[self.run_id]
+                    waited = time.monotonic() - start
+                    state["counters"]["calls"] += 1
+                    if throttled:
+                        state["counters"]["throttled"] += 1
+                        state["counters"]["waited"] += waited
+                    return waited if throttled else None
+                # Wait at least until the next token is due
+                delay = max((1 - state["tokens"]) / self.rate, self.poll)
+            throttled = True
+            time.sleep(delay)
+
+    def refill(self, state, now):
+        elapsed = max(now - state.get("updated", now), 0)
+        state["tokens"] = min(state.get("tokens", self.burst) + elapsed * self.rate, self.burst)
+        state["updated"] = now
+
+    def next_run(self, state):
+        """
+        The waiting run that was served longest ago (or never).
+        """
+        return min(
+            state["waiting"],
+            key=lambda run_id: (state["last_served"].get(run_id, 0), run_id),
+        )
+
+    def summary(self):
+        return (
+            f"{self.calls} guest operations calls, {self.throttled} throttled, "
+            f"{self.waited:.1f} seconds added by throttling"
+        )
+
+
+class StateFile:
+    """
+    Context manager giving exclusive access to the rate limiter's state,
+    which is written back to disk on exit.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = None
+        self.state = None
+
+    def __enter__(self):
+        self.lock_file = open(f"{self.path}.lock", "w")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self.state = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                try:
+                    self.state = json.load(f)
+                except json.JSONDecodeError:
+                    pass
+        self.state.setdefault("waiting", {})
+        self.state.setdefault("last_served", {})
+        self.state.setdefault("counters", {"calls": 0, "throttled": 0, "waited": 0.0})
+        return self.state
+
+    def __exit__(self, *exc):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        return False
+
+
+def alive(pid):
+    """
+    Whether a process is still running, if we know its pid.
+    """
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def state_file_from_config(config):
+    return config.get(
+        "RateLimit",
+        "state_file",
+        fallback=os.path.join(os.path.expanduser("~"), ".sdci-ratelimit.json"),
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.expanduser("~"), ".esx.ini"))
+    with StateFile(state_file_from_config(config)) as state:
+        counters = state["counters"]
+        print(f"Guest operations calls: {counters['calls']}")
+        print(f"Throttled calls: {counters['throttled']}")
+        print(f"Seconds added by throttling: {counters['waited']:.1f}")
+        print(f"Runs waiting now: {len(state['waiting'])}")
+        if args.reset:
+            state["counters"] = {"calls": 0, "throttled": 0, "waited": 0.0}
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+# Read the archive of CI logs that run.py copies into REPORTS_DIR.
+#
+# Log files are named by run.py as
+#
+#     <date>-<time>-<commit>-<vm name>-<snapshot>.log.txt
+#
+# where the date and time are when run.py started looking for a VM, and
+# runner.py writes a line for each step as it starts, then its output and
+# how it ended once it has:
+#
+#     INFO:[2024-05-01-10:00:00:000000] Running: make dev
+#     ...
+#     INFO:[2024-05-01-10:40:00:000000] Output of: make dev
+#     ...
+#     INFO:[2024-05-01-10:40:00:000000] Step finished: make dev
+#
+# Older logs have the output straight after the Running: line, and just
+# "Step finished" at the end.
+import argparse
+import csv
+import json
+import os
+import re
+import tempfile
+from datetime import datetime, timedelta
+
+# Where run.py publishes CI logs
+REPORTS_DIR = "/var/www/html/reports"
+# Where they can be seen, as linked to from commit statuses
+REPORTS_URL = "https://ws-ci-runner.securedrop.org"
+
+# The steps that read and write the most disk, used to compare runs on a VM
+# before and after its snapshot chain was maintained
+IO_STEPS = ["make dev", "make test"]
+
+# How many past runs a duration estimate needs before we trust it
+MIN_SAMPLES = 5
+
+REPORT_RE = re.compile(
+    r"^(?P<date>\d{4}-\d{2}-\d{2})-(?P<time>\d{12})-(?P<commit>[0-9a-f]{40})-"
+    r"(?P<vm>[^-]+)-(?P<snapshot>.+)\.log\.txt$"
+)
+LINE_RE = re.compile(r"\[(?P<timestamp>\d{4}-\d{2}-\d{2}-\d{2}:\d{2}:\d{2}:\d{6})\] (?P<message>.*)")
+VERSION_RE = re.compile(r"^Qubes_(\d+\.\d+)")
+
+# How runner.py reports the end of a step
+STEP_RESULTS = {
+    "Step finished": "success",
+    "Exception occurred during: ": "failure",
+    "Timed out after ": "timeout",
+    "Canceled during: ": "canceled",
+    # Killed because a stage running at the same time failed
+    "Stopped, as another stage failed, during: ": "stopped",
+    # 'make test' failed, but only in tests with a flaky history, which were retried
+    "Retrying flaky tests after: ": "retried",
+}
+
+# pytest's verbose result lines and short test summary lines, as logged by runner.py
+PYTEST_RESULT_RE = re.compile(r"\] (?P<test>\S+::\S+) (?P<outcome>PASSED|FAILED|ERROR)\b")
+PYTEST_SUMMARY_RE = re.compile(r"\] (?P<outcome>FAILED|ERROR) (?P<test>\S+::\S+)")
+RETRY_RE = re.compile(r"\] Flaky test (?P<outcome>passed|failed again) on retry: (?P<test>\S+)")
+
+
+def parse_args():
+    """
+    Handle CLI args.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--reports",
+        default=REPORTS_DIR,
+        action="store",
+        help="Directory of CI logs",
+    )
+    parser.add_argument(
+        "--maintenance",
+        default=False,
+        action="store_true",
+        help="Compare CI runs on each VM before and after its snapshot chain was maintained",
+    )
+    parser.add_argument(
+        "--flaky",
+        default=False,
+        action="store_true",
+        help="Rebuild the flaky test database and rank the flakiest tests",
+    )
+    parser.add_argument(
+        "--durations",
+        default=False,
+        action="store_true",
+        help="Rebuild the duration history and show the percentiles run.py estimates from",
+    )
+    parser.add_argument(
+        "--version",
+        action="store",
+        help="Only show --durations for this Qubes version",
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        action="store",
+        help="How many days of runs either side of maintenance to compare (default 7), or of history for --flaky and --durations (default 30)",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def parse_log_timestamp(timestamp):
+    return datetime.strptime(timestamp, "%Y-%m-%d-%H:%M:%S:%f")
+
+
+class Report:
+    def __init__(self, path):
+        """
+        A single CI log from the archive. The file name is parsed straight
+        away, the log itself only when its steps are asked for.
+        """
+        self.path = path
+        self.name = os.path.basename(path)
+        match = REPORT_RE.match(self.name)
+        if not match:
+            raise ValueError(f"{self.name} is not a CI log file name")
+        self.queued = datetime.strptime(f"{match['date']}{match['time']}", "%Y-%m-%d%H%M%S%f")
+        self.commit = match["commit"]
+        self.vm = match["vm"]
+        self.snapshot = match["snapshot"]
+        version = VERSION_RE.match(self.vm)
+        self.version = version.group(1) if version else None
+        self._steps = None
+
+    def steps(self):
+        """
+        Return the steps runner.py ran, in order, as dicts of 'command',
+        'started', 'finished' and 'result'. A step with no end recorded
+        (e.g the VM was shut down under it) has 'finished' of None.
+
+        Steps that ran at the same time have their Running: lines
+        interleaved, so an end is matched to the step by the command it
+        names, or to the last step started if it names none.
+        """
+        if self._steps is not None:
+            return self._steps
+        self._steps = []
+        current = None
+        # Steps that have started but not ended, by command
+        running = {}
+        with open(self.path, "r", errors="replace") as f:
+            for line in f:
+                match = LINE_RE.search(line)
+                if not match:
+                    continue
+                message = match["message"]
+                if message.startswith("Running: "):
+                    current = {
+                        "command": message[len("Running: "):].strip(),
+                        "started": parse_log_timestamp(match["timestamp"]),
+                        "finished": None,
+                        "result": None,
+                    }
+                    self._steps.append(current)
+                    running[current["command"]] = current
+                    continue
+                for prefix, result in STEP_RESULTS.items():
+                    if message.startswith(prefix):
+                        command = message.partition(": ")[2].strip()
+                        step = running.pop(command, None) if command else current
+                        if step is not None:
+                            step["finished"] = parse_log_timestamp(match["timestamp"])
+                            step["result"] = result
+                            running.pop(step["command"], None)
+                        current = None
+                        break
+        return self._steps
+
+    def started(self):
+        """
+        When runner.py started its first step in dom0, or None if it never did.
+        """
+        steps = self.steps()
+        return steps[0]["started"] if steps else None
+
+    def finished(self):
+        """
+        When runner.py finished its last step, or None if it never did.
+        """
+        ends = [step["finished"] for step in self.steps() if step["finished"]]
+        return max(ends) if ends else None
+
+    def step_durations(self):
+        """
+        Return how many seconds each finished step took, by command.
+        """
+        return {
+            step["command"]: (step["finished"] - step["started"]).total_seconds()
+            for step in self.steps()
+            if step["finished"]
+        }
+
+    def metrics(self):
+        """
+        Return the resource samples runner.py took during the run, as dicts
+        keyed by the columns of its .metrics.csv, or [] if there are none.
+        """
+        path = f"{self.path}.metrics.csv"
+        if not os.path.exists(path):
+            return []
+        with open(path, "r", newline="") as f:
+            return list(csv.DictReader(f))
+
+    def test_results(self):
+        """
+        Return the outcome of each pytest test in the run: 'passed',
+        'failed', or 'retry_passed' if it failed and then passed when
+        runner.py retried it.
+        """
+        results = {}
+        with open(self.path, "r", errors="replace") as f:
+            for line in f:
+                match = RETRY_RE.search(line)
+                if match:
+                    if match["outcome"] == "passed":
+                        results[match["test"]] = "retry_passed"
+                    continue
+                match = PYTEST_RESULT_RE.search(line) or PYTEST_SUMMARY_RE.search(line)
+                if match and results.get(match["test"]) != "retry_passed":
+                    results[match["test"]] = "passed" if match["outcome"] == "PASSED" else "failed"
+        return results
+
+    def result(self):
+        """
+        The overall result, as far as it can be told from the log.
+        """
+        steps = self.steps()
+        if not steps:
+            return "error"
+        for step in steps:
+            if step["result"] in ("failure", "timeout", "canceled"):
+                return step["result"]
+        if steps[-1]["result"] is None:
+            return "error"
+        return "success"
+
+
+def load_reports(reports_dir, since=None, version=None):
+    """
+    Return the reports in a directory, oldest first, optionally only those
+    queued after a given datetime or for a given Qubes version.
+    """
+    reports = []
+    for name in os.listdir(reports_dir):
+        if not REPORT_RE.match(name):
+            continue
+        report = Report(os.path.join(reports_dir, name))
+        if since and report.queued < since:
+            continue
+        if version and report.version != version:
+            continue
+        reports.append(report)
+    reports.sort(key=lambda r: r.queued)
+    return reports
+
+
+def load_nightly_commits(reports_dir):
+    """
+    Return the (date, commit) pairs that nightlies.py ran, from its
+    nightly-<date>.json summaries.
+    """
+    nightly = set()
+    for name in os.listdir(reports_dir):
+        match = re.match(r"^nightly-(\d{4}-\d{2}-\d{2})\.json$", name)
+        if not match:
+            continue
+        with open(os.path.join(reports_dir, name), "r") as f:
+            try:
+                summary = json.load(f)
+            except json.JSONDecodeError:
+                continue
+        for job in summary:
+            nightly.add((match.group(1), job["commit"]))
+    return nightly
+
+
+def flaky_tests(reports):
+    """
+    Work out which tests are flaky from a set of reports.
+
+    A test 'flipped' if it failed and then passed on retry, or if it
+    failed in one run of a commit and passed (or the whole run succeeded)
+    in another run of the same commit. Returns, for each test that ever
+    failed, how many runs it was seen failing in and how many flips it had.
+    """
+    stats = {}
+    failed_on = {}
+    passed_on = {}
+    succeeded = set()
+    for report in reports:
+        results = report.test_results()
+        if report.result() == "success":
+            succeeded.add(report.commit)
+        for test, outcome in results.items():
+            if outcome == "passed":
+                passed_on.setdefault(test, set()).add(report.commit)
+                continue
+            entry = stats.setdefault(test, {"failures": 0, "flips": 0, "last_failed": None})
+            entry["failures"] += 1
+            entry["last_failed"] = report.queued.isoformat(timespec="seconds")
+            if outcome == "retry_passed":
+                entry["flips"] += 1
+            else:
+                failed_on.setdefault(test, set()).add(report.commit)
+    for test, commits in failed_on.items():
+        stats[test]["flips"] += len(commits & (passed_on.get(test, set()) | succeeded))
+    return stats
+
+
+def load_flaky_db(reports_dir, days=30, max_age=3600):
+    """
+    Return the flaky test stats for the last few days of reports, from
+    flaky.json in the reports directory if it was built recently, or
+    building it afresh otherwise.
+    """
+    db_file = os.path.join(reports_dir, "flaky.json")
+    if os.path.exists(db_file) and datetime.now().timestamp() - os.path.getmtime(db_file) < max_age:
+        with open(db_file, "r") as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                pass
+    db = {
+        "built": datetime.now().isoformat(timespec="seconds"),
+        "days": days,
+        "tests": flaky_tests(load_reports(reports_dir, since=datetime.now() - timedelta(days=days))),
+    }
+    write_json(db_file, db)
+    return db
+
+
+def write_json(path, data):
+    """
+    Replace a JSON file in one go, through a temporary file of our own, so
+    that runs rebuilding it at the same time can't corrupt each other's
+    copy. The last one to finish wins.
+    """
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), prefix=f"{os.path.basename(path)}.", suffix=".tmp", delete=False) as f:
+        json.dump(data, f, indent=4)
+    try:
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+    except OSError:
+        os.remove(f.name)
+        raise
+
+
+def flaky_ranking(db, min_flips=1):
+    """
+    The tests with at least min_flips flips, flakiest first.
+    """
+    ranked = [(test, entry) for test, entry in db["tests"].items() if entry["flips"] >= min_flips]
+    ranked.sort(key=lambda item: (item[1]["flips"], item[1]["failures"]), reverse=True)
+    return ranked
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def run_phases(report):
+    """
+    Return how many seconds each phase of a run took: 'setup' (from
+    run.py starting to look for a VM until runner.py started, so queueing,
+    revert, boot and uploads), each step that succeeded, and 'run'
+    (runner.py from start to finish) if the whole run succeeded.
+    """
+    phases = {}
+    started = report.started()
+    if not started:
+        return phases
+    phases["setup"] = (started - report.queued).total_seconds()
+    for step in report.steps():
+        if step["finished"] and step["result"] == "success":
+            phases[step["command"]] = (step["finished"] - step["started"]).total_seconds()
+    if report.result() == "success":
+        phases["run"] = (report.finished() - started).total_seconds()
+    return phases
+
+
+def load_duration_db(reports_dir, days=30, max_age=3600):
+    """
+    Return the phase durations of the last few days of runs, and of the
+    nightly updates recorded in updates.jsonl, from durations.json in the
+    reports directory if it was built recently, or building it afresh
+    otherwise.
+    """
+    db_file = os.path.join(reports_dir, "durations.json")
+    if os.path.exists(db_file) and datetime.now().timestamp() - os.path.getmtime(db_file) < max_age:
+        with open(db_file, "r") as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                pass
+    since = datetime.now() - timedelta(days=days)
+    runs = [
+        {"version": report.version, "vm": report.vm, "phases": run_phases(report)}
+        for report in load_reports(reports_dir, since=since)
+    ]
+    updates_log = os.path.join(reports_dir, "updates.jsonl")
+    if os.path.exists(updates_log):
+        with open(updates_log, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                update = json.loads(line)
+                if datetime.fromisoformat(update["time"]) < since:
+                    continue
+                version = VERSION_RE.match(update["vm"])
+                runs.append({
+                    "version": version.group(1) if version else None,
+                    "vm": update["vm"],
+                    "phases": {"updates": update["seconds"]},
+                })
+    db = {
+        "built": datetime.now().isoformat(timespec="seconds"),
+        "days": days,
+        "runs": runs,
+    }
+    write_json(db_file, db)
+    return db
+
+
+def phase_estimate(db, phase, pct, version=None, vm=None, min_samples=MIN_SAMPLES):
+    """
+    Return a percentile of how long a phase took, from the runs on the
+    same VM if there are enough of them, else the same Qubes version,
+    else all runs. Returns None if there isn't enough history at all.
+    """
+    runs = [run for run in db["runs"] if phase in run["phases"]]
+    for scope in [
+        [run for run in runs if vm and run["vm"] == vm],
+        [run for run in runs if version and run["version"] == version],
+        runs,
+    ]:
+        if len(scope) >= min_samples:
+            return percentile([run["phases"][phase] for run in scope], pct)
+    return None
+
+
+def io_profile(reports):
+    """
+    Median duration of the I/O heavy steps, and median dom0 block I/O
+    during a run, for a set of reports.
+    """
+    profile = {}
+    for command in IO_STEPS:
+        durations = [d[command] for d in (r.step_durations() for r in reports) if command in d]
+        profile[command] = median(durations)
+    io_rates = []
+    for report in reports:
+        samples = [float(row["io_kbps"]) for row in report.metrics() if row["domain"] == "dom0-proc"]
+        if samples:
+            io_rates.append(sum(samples) / len(samples))
+    profile["dom0_io_kbps"] = median(io_rates)
+    return profile
+
+
+def maintenance_impact(reports_dir, days=7):
+    """
+    For each maintenance recorded by run.py --maintain, compare the runs
+    on that VM in the days before with those in the days after.
+    """
+    log = os.path.join(reports_dir, "maintenance.jsonl")
+    if not os.path.exists(log):
+        return []
+    with open(log, "r") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+
+    reports = load_reports(reports_dir)
+    impact = []
+    for event in events:
+        when = datetime.fromisoformat(event["time"])
+        window = timedelta(days=days)
+        on_vm = [r for r in reports if r.vm == event["vm"]]
+        before = [r for r in on_vm if when - window <= r.queued < when]
+        after = [r for r in on_vm if when <= r.queued < when + window]
+        impact.append({
+            "event": event,
+            "runs_before": len(before),
+            "runs_after": len(after),
+            "before": io_profile(before),
+            "after": io_profile(after),
+        })
+    return impact
+
+
+def format_value(value, unit):
+    return "-" if value is None else f"{value:.0f}{unit}"
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.durations:
+        db = load_duration_db(args.reports, days=args.days or 30, max_age=0)
+        runs = [run for run in db["runs"] if not args.version or run["version"] == args.version]
+        print(f"Phase durations over the last {db['days']} days (minutes):")
+        for phase in sorted(set(phase for run in runs for phase in run["phases"])):
+            values = [run["phases"][phase] / 60 for run in runs if phase in run["phases"]]
+            print(
+                f"  {phase:<24} {len(values):>4} runs, p50 {percentile(values, 50):6.1f}, "
+                f"p95 {percentile(values, 95):6.1f}, p99 {percentile(values, 99):6.1f}"
+            )
+    if args.flaky:
+        db = load_flaky_db(args.reports, days=args.days or 30, max_age=0)
+        print(f"Flakiest tests over the last {db['days']} days:")
+        for test, entry in flaky_ranking(db):
+            print(f"  {entry['flips']:>3} flips, {entry['failures']:>3} failures, last {entry['last_failed']}: {test}")
+    if args.maintenance:
+        for entry in maintenance_impact(args.reports, args.days or 7):
+            event = entry["event"]
+            print(
+                f"{event['vm']} at {event['time']}: {event['before']['depth']} -> {event['after']['depth']} deltas, "
+                f"{event['before']['delta_mb']} -> {event['after']['delta_mb']} MB, took {event['seconds']}s"
+            )
+            print(f"  runs: {entry['runs_before']} before, {entry['runs_after']} after")
+            for key, unit in [(command, "s") for command in IO_STEPS] + [("dom0_io_kbps", " KB/s")]:
+                print(
+                    f"  {key}: {format_value(entry['before'][key], unit)} -> {format_value(entry['after'][key], unit)}"
+                )
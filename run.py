@@ -5,18 +5,39 @@ import certifi
 import configparser
 import json
 import logging
+import math
 import os
 import re
 import requests
 import ssl
+import sys
+import threading
 import time
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from logging.handlers import SysLogHandler
 from pyVim.connect import SmartConnect, Disconnect
 from pyVim.task import WaitForTask
 from pyVmomi import vim
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Marker files for VMs that --maintain is working on, so that CI runs leave them alone
+MAINTENANCE_DIR = os.path.join(os.path.expanduser("~"), ".sdci-maintenance")
+# Which VM each running job is on, so that it can be canceled
+JOBS_DIR = os.path.join(os.path.expanduser("~"), ".sdci-jobs")
+
+# Used until there is enough history to estimate from, and the least we
+# wait for a VM however quickly recent builds started, since the setup
+# times include however long they were queued for
+DEFAULT_VM_WAIT = 7200
+DEFAULT_SHUTDOWN_MINUTES = 110
+# Never schedule a shutdown sooner than this, however quick recent runs were
+MIN_SHUTDOWN_MINUTES = 30
+
+# The status delivery code is shared with status.py in sd-dev
+sys.path.insert(0, os.path.join(CURRENT_DIR, "sd-dev", "bin"))
+from delivery import StatusDelivery, status_context  # noqa: E402
+from ratelimit import GuestOpsLimiter, state_file_from_config  # noqa: E402
+from reports import REPORTS_DIR, REPORTS_URL, load_duration_db, load_flaky_db, phase_estimate  # noqa: E402
 
 
 def parse_args():
@@ -26,10 +47,9 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--version",
-        default=False,
         required=True,
-        action="store",
-        help="Qubes version to run on",
+        action="append",
+        help="Qubes version to run on. Can be given more than once to run the build on each version at once.",
     )
     parser.add_argument(
         "--context",
@@ -51,6 +71,20 @@ def parse_args():
         action="store_true",
         help="Whether to run dom0 and domU updates (used for nightlies)",
     )
+    parser.add_argument(
+        "--checkpoint",
+        default=False,
+        required=False,
+        action="store_true",
+        help="Take a snapshot once 'make dev' has succeeded, so that a failed run can be resumed from it",
+    )
+    parser.add_argument(
+        "--resume",
+        default=False,
+        required=False,
+        action="store_true",
+        help="Resume the commit in --context from its checkpoint, running only the remaining steps",
+    )
     parser.add_argument(
         "--save",
         default=False,
@@ -58,54 +92,480 @@ def parse_args():
         action="store_true",
         help="Whether to save a snapshot after running other tasks, for use in future runs",
     )
+    parser.add_argument(
+        "--cancel",
+        default=False,
+        required=False,
+        action="store",
+        metavar="COMMIT",
+        help="Cancel the running job for this commit on --version, and power off its VM",
+    )
+    parser.add_argument(
+        "--maintain",
+        default=False,
+        required=False,
+        action="store_true",
+        help="Remove old snapshots and consolidate the disks of idle VMs for this version",
+    )
 
     args = parser.parse_args()
+    if len(args.version) > 1 and (args.cancel or args.maintain or args.save or args.resume):
+        parser.error("only one --version can be given with --cancel, --maintain, --save or --resume")
     return args
 
 
+class BuildCanceled(Exception):
+    pass
+
+
 class CiRunner:
-    def __init__(self):
+    def __init__(self, shared=None):
         """
         Set up the CiRunner class with attributes required.
+
+        If another CiRunner is passed in as `shared`, use its config,
+        status delivery and vSphere sessions rather than connecting
+        again. engine.py does this to run many builds in one process,
+        each with its own CiRunner (and so its own VM and job state).
         """
+        self.vm = None
+        self.content = None
+        self.job = None
+        self.version = None
+        self.durations = None
+        # Set to stop this CiRunner's build at its next wait
+        self.stopping = threading.Event()
+        # Performance counter keys for disk latency, per endpoint
+        self.latency_counters = {}
+        # When each VM's snapshot chain was last measured, and how it was,
+        # by UUID
+        self.chain_cache = {}
+        # Whether builds post commit statuses to Github. bisect_ci.py turns
+        # this off, as its builds are of old commits.
+        self.statuses = True
+
+        if shared is not None:
+            self.statuses = shared.statuses
+            self.chain_cache = shared.chain_cache
+            self.logger = shared.logger
+            self.config = shared.config
+            self.config_file = shared.config_file
+            self.creds = shared.creds
+            self.file_attribute = shared.file_attribute
+            self.delivery = shared.delivery
+            # Each build still takes its own turn at the rate limiter
+            self.endpoints = [
+                dict(endpoint, limiter=self.make_limiter(endpoint["name"]))
+                for endpoint in shared.endpoints
+            ]
+            self.use_endpoint(self.endpoints[0])
+            return
+
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
-        handler = SysLogHandler(
-            facility=SysLogHandler.LOG_DAEMON,
-            address="/dev/log"
-        )
-        handler.setFormatter(logging.Formatter('ws-ci-runner: %(message)s'))
-        self.logger.addHandler(handler)
+        # Several CiRunners can live in one process (e.g in webhook.py)
+        if not self.logger.handlers:
+            handler = SysLogHandler(
+                facility=SysLogHandler.LOG_DAEMON,
+                address="/dev/log"
+            )
+            handler.setFormatter(logging.Formatter('ws-ci-runner: %(message)s'))
+            self.logger.addHandler(handler)
 
         # Read ESXi server details from config file
         self.config = configparser.ConfigParser()
         home_dir = os.path.expanduser("~")
         self.config_file = os.path.join(home_dir, ".esx.ini")
         self.config.read(self.config_file)
-        self.esxi_server = self.config.get("ESXi", "server")
-        self.username = self.config.get("ESXi", "username")
-        self.password = self.config.get("ESXi", "password")
 
+        self.creds = vim.vm.guest.NamePasswordAuthentication(
+            username=self.config.get("Qubes","username"),
+            password=self.config.get("Qubes", "password")
+        )
+        self.file_attribute = vim.vm.guest.FileManager.FileAttributes()
+        self.delivery = StatusDelivery(self.logger, os.path.join(CURRENT_DIR, "sd-dev/.sdci-ghp.txt"))
+
+        # Connect to every ESXi host or vCenter we have VMs on: the [ESXi]
+        # section, plus any sections named like [ESXi rack2]
+        self.endpoints = [
+            self.connect(section)
+            for section in self.config.sections()
+            if section == "ESXi" or section.startswith("ESXi ")
+        ]
+        if not self.endpoints:
+            raise SystemError(f"No [ESXi] section in {self.config_file}")
+        self.use_endpoint(self.endpoints[0])
+
+
+    def connect(self, section):
+        """
+        Connect to the ESXi host or vCenter described in a config section.
+        """
+        server = self.config.get(section, "server")
         ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
         ssl_context.load_verify_locations(certifi.where())
 
-        self.si = SmartConnect(
-            host=self.esxi_server,
-            user=self.username,
-            pwd=self.password,
+        si = SmartConnect(
+            host=server,
+            user=self.config.get(section, "username"),
+            pwd=self.config.get(section, "password"),
             customHeaders={"cookie": "vmware_client=VMware;"},
             sslContext=ssl_context,
         )
-        atexit.register(Disconnect, self.si)
+        atexit.register(Disconnect, si)
+        return {"name": section, "server": server, "si": si, "limiter": self.make_limiter(section)}
+
+
+    def make_limiter(self, section):
+        """
+        Guest operations calls from every run share one budget per endpoint.
+        """
+        state_file = state_file_from_config(self.config)
+        if section != "ESXi":
+            state_file = f"{state_file}.{section[len('ESXi '):]}"
+        return GuestOpsLimiter(
+            self.logger,
+            state_file,
+            f"{os.getpid()}-{id(self)}",
+            rate=self.config.getfloat("RateLimit", "rate", fallback=5.0),
+            burst=self.config.getint("RateLimit", "burst", fallback=10),
+        )
+
 
+    def use_endpoint(self, endpoint):
+        """
+        Make the endpoint a VM was found on the one we talk to.
+        """
+        self.si = endpoint["si"]
+        self.esxi_server = endpoint["server"]
         self.pm = self.si.content.guestOperationsManager.processManager
-        self.creds = vim.vm.guest.NamePasswordAuthentication(
-            username=self.config.get("Qubes","username"),
-            password=self.config.get("Qubes", "password")
+        self.limiter = endpoint["limiter"]
+
+
+    def find_vms(self, version):
+        """
+        Return (endpoint, content, VM) for every VM for a Qubes version,
+        in any datacenter or folder on any of our endpoints.
+
+        A VM seen through more than one endpoint (e.g a vCenter and one of
+        its ESXi hosts) is only returned once, from the first of them, and
+        VMs that vSphere can't currently manage are left out.
+        """
+        source_vm_name = f"Qubes_{version}"
+        found = []
+        seen = set()
+        for endpoint in self.endpoints:
+            content = endpoint["si"].RetrieveContent()
+            view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+            try:
+                for vm in view.view:
+                    if source_vm_name not in vm.name:
+                        continue
+                    # Inaccessible and orphaned VMs have no config, and can't be used anyway
+                    if vm.config is None or vm.runtime.connectionState != "connected":
+                        continue
+                    if vm.config.uuid not in seen:
+                        seen.add(vm.config.uuid)
+                        found.append((endpoint, content, vm))
+            finally:
+                view.Destroy()
+        return found
+
+
+    def host_load(self, host):
+        """
+        How busy a host is: the number of VMs running on it (i.e CI runs),
+        then the fraction of its CPU in use.
+        """
+        running = len([vm for vm in host.vm if vm.runtime.powerState == "poweredOn"])
+        stats = host.summary.quickStats
+        hardware = host.summary.hardware
+        cpu = (stats.overallCpuUsage or 0) / (hardware.cpuMhz * hardware.numCpuCores)
+        return (running, cpu)
+
+
+    def pick_vm(self, version, exclude=()):
+        """
+        Return (endpoint, content, VM) for a powered off VM for a Qubes
+        version on the least loaded host, or None if they are all in use.
+
+        VMs whose UUIDs are in `exclude` are skipped, e.g those that other
+        builds in the same process have just picked but not powered on yet.
+        """
+        free = [
+            (endpoint, content, vm)
+            for endpoint, content, vm in self.find_vms(version)
+            if vm.runtime.powerState == "poweredOff"
+            and vm.runtime.host is not None
+            and vm.config.uuid not in exclude
+            and not self.under_maintenance(vm)
+        ]
+        if not free:
+            return None
+
+        # Avoid VMs with deep snapshot chains if there are healthier ones
+        # (there is no choice to make with only one)
+        healthy = []
+        for endpoint, content, vm in free if len(free) > 1 else []:
+            health = self.recent_chain_health(vm)
+            if self.chain_is_healthy(health):
+                healthy.append((endpoint, content, vm))
+            else:
+                self.logger.debug(f"{vm.name} has an unhealthy snapshot chain ({self.describe_chain(health)})")
+        if healthy:
+            free = healthy
+
+        # Hold builds back from hosts that are already too busy to take
+        # another one without slowing down those running there
+        verdicts = {}
+        admitted = []
+        for endpoint, content, vm in free:
+            key = (endpoint["name"], vm.runtime.host.name)
+            if key not in verdicts:
+                verdicts[key] = self.admission(endpoint, content, vm.runtime.host, vm, exclude)
+            if verdicts[key] is None:
+                admitted.append((endpoint, content, vm))
+        if not admitted:
+            for (name, host_name), reason in verdicts.items():
+                self.logger.debug(f"Not starting another build on {host_name} ({name}) yet: {reason}")
+            return None
+        free = admitted
+
+        loads = {}
+        for endpoint, content, vm in free:
+            key = (endpoint["name"], vm.runtime.host.name)
+            if key not in loads:
+                loads[key] = self.host_load(vm.runtime.host)
+        return min(free, key=lambda f: loads[(f[0]["name"], f[2].runtime.host.name)])
+
+
+    def admission(self, endpoint, content, host, vm, starting=()):
+        """
+        Whether starting a VM on a host would keep the host within the
+        [Admission] limits, judging by its quickStats and those of the CI
+        VMs running there. VMs whose UUIDs are in `starting` count as
+        running, as they have been picked but may not be powered on yet.
+
+        Returns None if it would, or else why not. A host running no other
+        CI VMs always takes a build, so that limits set too low (or load
+        from other VMs on the host) delay builds rather than stopping them
+        altogether.
+
+        Off by default, as it reads the quickStats of every VM on the host,
+        one call each, every time a build looks for a VM.
+        """
+        if not self.config.getboolean("Admission", "enabled", fallback=False):
+            return None
+        running = [
+            other for other in host.vm
+            if "Qubes_" in other.name
+            and (other.runtime.powerState == "poweredOn" or other.config.uuid in starting)
+        ]
+        if not running:
+            return None
+
+        stats = host.summary.quickStats
+        hardware = host.summary.hardware
+
+        # Memory the guests have had taken back from them means the host is
+        # already overcommitted
+        reclaimed = sum(
+            (other.summary.quickStats.balloonedMemory or 0) + (other.summary.quickStats.swappedMemory or 0)
+            for other in running
         )
-        self.file_attribute = vim.vm.guest.FileManager.FileAttributes()
-        self.vm = None
-        self.content = None
+        max_reclaimed = self.config.getint("Admission", "max_reclaimed_mb", fallback=512)
+        if reclaimed > max_reclaimed:
+            return f"{reclaimed}MB of guest memory is ballooned or swapped (limit {max_reclaimed}MB)"
+
+        # Nested Qubes touches all of its memory, so count all of it, for
+        # this VM and for any picked that the host isn't running yet
+        memory_mb = hardware.memorySize / 1024 ** 2
+        wanted = vm.summary.config.memorySizeMB + sum(
+            other.summary.config.memorySizeMB for other in running if other.runtime.powerState != "poweredOn"
+        )
+        memory = ((stats.overallMemoryUsage or 0) + wanted) / memory_mb
+        max_memory = self.config.getfloat("Admission", "max_memory", fallback=0.9)
+        if memory > max_memory:
+            return f"memory would be {memory:.0%} used (limit {max_memory:.0%})"
+
+        # Expect another build to use as much CPU as those already running
+        cpu_mhz = hardware.cpuMhz * hardware.numCpuCores
+        build_mhz = sum(other.summary.quickStats.overallCpuUsage or 0 for other in running) / len(running)
+        cpu = ((stats.overallCpuUsage or 0) + build_mhz) / cpu_mhz
+        max_cpu = self.config.getfloat("Admission", "max_cpu", fallback=0.85)
+        if cpu > max_cpu:
+            return f"CPU would be {cpu:.0%} used (limit {max_cpu:.0%})"
+
+        latency = self.disk_latency(endpoint, content, host)
+        max_latency = self.config.getint("Admission", "max_disk_latency_ms", fallback=50)
+        if latency is not None and latency > max_latency:
+            return f"disk latency is {latency}ms (limit {max_latency}ms)"
+        return None
+
+
+    def disk_latency(self, endpoint, content, host):
+        """
+        The highest disk latency on a host in the last minute, in ms, from
+        the performance manager as quickStats doesn't have it. Returns None
+        if it isn't available.
+        """
+        perf = content.perfManager
+        try:
+            # The counter list is long, so only look through it once
+            counter = self.latency_counters.get(endpoint["name"])
+            if counter is None:
+                counter = next(
+                    c.key for c in perf.perfCounter
+                    if (c.groupInfo.key, c.nameInfo.key, c.rollupType) == ("disk", "maxTotalLatency", "latest")
+                )
+                self.latency_counters[endpoint["name"]] = counter
+            spec = vim.PerformanceManager.QuerySpec(
+                entity=host,
+                metricId=[vim.PerformanceManager.MetricId(counterId=counter, instance="")],
+                # Three of the 20 second real-time samples
+                intervalId=20,
+                maxSample=3,
+            )
+            samples = [
+                value
+                for result in perf.QueryPerf(querySpec=[spec])
+                for series in result.value
+                for value in series.value
+            ]
+        except Exception as e:
+            self.logger.debug(f"Could not read the disk latency of {host.name}: {e}")
+            return None
+        return max(samples) if samples else None
+
+
+    def chain_health(self, vm):
+        """
+        Measure a VM's snapshot chain: how many delta disks its disks are
+        read through, how big those deltas are, and whether vSphere says
+        its disks need consolidating.
+        """
+        layout = vm.layoutEx
+        files = {f.key: f.size for f in layout.file} if layout else {}
+        depth = 0
+        delta_bytes = 0
+        for disk in layout.disk if layout else []:
+            # The first unit in the chain is the base disk, the rest are deltas
+            deltas = disk.chain[1:]
+            depth = max(depth, len(deltas))
+            for unit in deltas:
+                delta_bytes += sum(files.get(key, 0) for key in unit.fileKey)
+        return {
+            "depth": depth,
+            "delta_mb": delta_bytes // 1024 ** 2,
+            "consolidation_needed": bool(vm.runtime.consolidationNeeded),
+        }
+
+
+    def recent_chain_health(self, vm):
+        """
+        chain_health() for picking a VM. Every waiting build looks at every
+        free VM each time it polls, so a VM's chain is only measured once
+        per poll interval, or again once it has been saved or maintained.
+        """
+        ttl = self.config.getfloat("Engine", "poll", fallback=60)
+        cached = self.chain_cache.get(vm.config.uuid)
+        if cached and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+        health = self.chain_health(vm)
+        self.chain_cache[vm.config.uuid] = (time.monotonic(), health)
+        return health
+
+
+    def chain_is_healthy(self, health):
+        max_depth = self.config.getint("Snapshots", "max_chain_depth", fallback=6)
+        return health["depth"] <= max_depth and not health["consolidation_needed"]
+
+
+    def describe_chain(self, health):
+        description = f"{health['depth']} deltas, {health['delta_mb']} MB"
+        if health["consolidation_needed"]:
+            description += ", needs consolidation"
+        return description
+
+
+    def in_maintenance_window(self):
+        """
+        Whether now is within the configured maintenance window, e.g
+        '01:00-05:00' (which may wrap past midnight). Always true if no
+        window is configured.
+        """
+        window = self.config.get("Snapshots", "maintenance_window", fallback=None)
+        if not window:
+            return True
+        start, end = [datetime.strptime(t.strip(), "%H:%M").time() for t in window.split("-")]
+        now = datetime.now().time()
+        if start <= end:
+            return start <= now < end
+        return now >= start or now < end
+
+
+    def under_maintenance(self, vm):
+        """
+        Whether maintain() has claimed a VM.
+        """
+        return os.path.exists(os.path.join(MAINTENANCE_DIR, vm.config.uuid))
+
+
+    def maintain(self, version):
+        """
+        Remove the old snapshots that --save left behind and consolidate
+        disks, on each idle VM for a Qubes version. Both merge delta disks,
+        which is slow and hammers the datastore, so this is meant to run
+        from cron in a quiet period rather than in the middle of a nightly.
+
+        Each VM's chain is measured before and after, and recorded in the
+        maintenance log in the reports directory, so that reports.py can
+        compare how CI runs on it performed before and after.
+        """
+        if not self.in_maintenance_window():
+            self.logger.debug("Outside the maintenance window, not doing any maintenance")
+            return
+
+        keep = self.config.getint("Snapshots", "keep", fallback=3)
+        os.makedirs(MAINTENANCE_DIR, exist_ok=True)
+        for endpoint, content, vm in self.find_vms(version):
+            marker = os.path.join(MAINTENANCE_DIR, vm.config.uuid)
+            # Claim the VM before checking it is free. pick_vm() skips claimed
+            # VMs, and a build that picked this one just before we claimed it
+            # waits for us before reverting it (see run_on_vm()). That leaves
+            # a few seconds, between that check and the VM powering on, in
+            # which we could both start on it, so run this in a quiet period.
+            with open(marker, "w") as m:
+                m.write(f"{os.getpid()}\n")
+            try:
+                if vm.runtime.powerState != "poweredOff":
+                    self.logger.debug(f"{vm.name} is in use, not maintaining it")
+                    continue
+                self.use_endpoint(endpoint)
+                self.content = content
+                self.vm = vm
+
+                before = self.chain_health(vm)
+                started = time.time()
+                self.remove_old_snapshots(prefix="update_", keep=keep)
+                if vm.runtime.consolidationNeeded:
+                    self.logger.debug(f"Consolidating the disks of {vm.name}")
+                    WaitForTask(vm.ConsolidateVMDisks_Task())
+                after = self.chain_health(vm)
+                self.chain_cache.pop(vm.config.uuid, None)
+                self.logger.debug(
+                    f"Maintained {vm.name}: {self.describe_chain(before)} before, {self.describe_chain(after)} after"
+                )
+                with open(os.path.join(REPORTS_DIR, "maintenance.jsonl"), "a") as f:
+                    f.write(json.dumps({
+                        "vm": vm.name,
+                        "time": datetime.now().isoformat(timespec="seconds"),
+                        "seconds": round(time.time() - started),
+                        "before": before,
+                        "after": after,
+                    }) + "\n")
+            finally:
+                os.remove(marker)
 
 
     def get_all_snapshots(self, snapshot):
@@ -148,30 +608,145 @@ class CiRunner:
                     return nested_snapshot.snapshot
         return None
 
-    def notify_github_queued(self, commit):
+    def github_status(self, commit, state, description, target_url=None, version=None):
+        """
+        Post a commit status for a build on a Qubes version, unless this
+        runner's builds don't post them.
+        """
+        if not self.statuses:
+            self.logger.debug(f"Not posting {state} commit status for {commit}")
+            return
+        self.delivery.github_status(commit, state, description, target_url, status_context(version))
+
+
+    def notify_github_queued(self, commit, version):
         """Notify GitHub of queued status early, the rest are handled by status.py"""
-        with open(os.path.join(CURRENT_DIR, "sd-dev/.sdci-ghp.txt")) as f:
-            github_token = f.read().strip()
-        headers = {
-            "Authorization": f"Bearer {github_token}",
-            "Content-Type": "application/json",
-        }
-        data = {
-            "context": "sd-ci-runner",
-            "description": "The build is queued",
-            "state": "pending",
-        }
         self.logger.debug(f"Posting queued commit status for {commit} to GitHub")
-        requests.post(
-            f"https://api.github.com/repos/freedomofpress/securedrop-workstation/statuses/{commit}",
-            json=data,
-            headers=headers,
-        )
+        description = "The build is queued"
+        setup, run = self.estimate("setup", 50, version), self.estimate("run", 50, version)
+        if setup is not None and run is not None:
+            description += f", expected to finish around {self.format_eta(setup + run)}"
+        self.github_status(commit, "pending", description, version=version)
+
+
+    def notify_github_gave_up(self, commit, version):
+        """
+        Replace the queued status of a build that gave up waiting for a
+        VM, which would otherwise stay pending for good.
+        """
+        self.github_status(commit, "error", "No VM became free to run the build", version=version)
+
+
+    def load_durations(self):
+        """
+        The durations of recent runs, per phase, loaded once per build.
+        """
+        if self.durations is None:
+            try:
+                self.durations = load_duration_db(
+                    REPORTS_DIR, days=self.config.getint("Estimates", "history_days", fallback=30)
+                )
+            except OSError as e:
+                self.logger.debug(f"Could not load the duration history: {e}")
+                self.durations = {"runs": []}
+        return self.durations
+
+
+    def estimate(self, phase, pct, version, vm=None):
+        """
+        A percentile of how many seconds a phase of a build ('setup',
+        'run', 'updates' or a step) took in recent runs on this VM or
+        version, or None if there isn't enough history.
+        """
+        return phase_estimate(self.load_durations(), phase, pct, version, vm)
+
+
+    def time_limit(self, phases, version, vm=None):
+        """
+        A time limit in seconds for some phases of a build: a high
+        percentile of how long each took recently, with a margin, or
+        None if there isn't enough history.
+        """
+        pct = self.config.getfloat("Estimates", "percentile", fallback=99)
+        margin = self.config.getfloat("Estimates", "margin", fallback=1.5)
+        estimates = [self.estimate(phase, pct, version, vm) for phase in phases]
+        if None in estimates:
+            return None
+        return sum(estimates) * margin
+
+
+    def format_eta(self, seconds):
+        eta = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+        return eta.strftime("%H:%M UTC")
+
+
+    def vm_wait(self, version):
+        """
+        How long to wait for a free VM before giving up: longer than the
+        default when builds have been taking longer than that to start.
+        """
+        limit = self.time_limit(["setup"], version)
+        if limit is None:
+            return DEFAULT_VM_WAIT
+        return max(limit, DEFAULT_VM_WAIT)
+
+
+    def shutdown_minutes(self, update=False):
+        """
+        When the VM should shut itself down in case the run gets stuck:
+        after a high percentile of how long runs (and updates, for a
+        nightly) on it took, plus time for the uploads and pre-flight
+        checks.
+        """
+        phases = ["run", "updates"] if update else ["run"]
+        limit = self.time_limit(phases, self.version, self.vm.name)
+        if limit is None:
+            return DEFAULT_SHUTDOWN_MINUTES
+        return max(math.ceil(limit / 60) + 10, MIN_SHUTDOWN_MINUTES)
+
+
+    def step_timeouts(self):
+        """
+        Timeouts in minutes for the steps runner.py runs, from a high
+        percentile of how long each took in recent runs on this VM.
+        """
+        timeouts = {}
+        steps = set(phase for run in self.load_durations()["runs"] for phase in run["phases"])
+        for step in steps - {"setup", "run", "updates"}:
+            limit = self.time_limit([step], self.version, self.vm.name)
+            if limit is not None:
+                timeouts[step] = max(math.ceil(limit / 60), 5)
+        return timeouts
+
+
+    def sleep(self, seconds):
+        """
+        Sleep, but wake up within a second and raise BuildCanceled if
+        the build is stopped in the meantime.
+        """
+        deadline = time.time() + seconds
+        while not self.stopping.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 1))
+        raise BuildCanceled("The build was stopped")
+
+
+    def guest_op(self, func, *args, **kwargs):
+        """
+        Make a guest operations call, or a file transfer through hostd,
+        once the shared rate limiter lets us.
+        """
+        self.limiter.acquire()
+        return func(*args, **kwargs)
 
 
     def run_command_in_dom0(self, command, args=False, wait=True):
         """
         Run a command in dom0 (including any qvm-run commands into sd-dev)
+
+        Returns the command's exit code if we waited for it to finish.
         """
         if args:
             program_spec = vim.vm.guest.ProcessManager.ProgramSpec(
@@ -180,15 +755,15 @@ class CiRunner:
         else:
             program_spec = vim.vm.guest.ProcessManager.ProgramSpec(programPath=command)
 
-        res = self.pm.StartProgramInGuest(self.vm, self.creds, program_spec)
+        res = self.guest_op(self.pm.StartProgramInGuest, self.vm, self.creds, program_spec)
         if res > 0:
             if wait:
-                pid_exitcode = self.pm.ListProcessesInGuest(self.vm, self.creds, [res]).pop().exitCode
+                pid_exitcode = self.guest_op(self.pm.ListProcessesInGuest, self.vm, self.creds, [res]).pop().exitCode
                 # If it's not a numeric result code, it says None on submit
                 while re.match('[^0-9]+', str(pid_exitcode)):
                     self.logger.debug("Program running, PID is %d" % res)
-                    time.sleep(5)
-                    pid_exitcode = self.pm.ListProcessesInGuest(self.vm, self.creds, [res]).pop().exitCode
+                    self.sleep(5)
+                    pid_exitcode = self.guest_op(self.pm.ListProcessesInGuest, self.vm, self.creds, [res]).pop().exitCode
                     if pid_exitcode == 0:
                         self.logger.debug("Program %d completed with success" % res)
                         break
@@ -196,16 +771,17 @@ class CiRunner:
                     elif re.match('[1-9]+', str(pid_exitcode)):
                         self.logger.debug("ERROR: Program %d completed with Failure" % res)
                         self.logger.debug("ERROR: More info on process")
-                        self.logger.debug(self.pm.ListProcessesInGuest(self.vm, self.creds, [res]))
+                        self.logger.debug(self.guest_op(self.pm.ListProcessesInGuest, self.vm, self.creds, [res]))
                         break
+                return pid_exitcode
             else:
-                time.sleep(5)
-                pid_exitcode = self.pm.ListProcessesInGuest(self.vm, self.creds, [res]).pop().exitCode
+                self.sleep(5)
+                pid_exitcode = self.guest_op(self.pm.ListProcessesInGuest, self.vm, self.creds, [res]).pop().exitCode
                 # Look for non-zero code to fail
                 if re.match("[1-9]+", str(pid_exitcode)):
                     self.logger.debug("ERROR: Program %d completed with Failure" % res)
                     self.logger.debug("ERROR: More info on process")
-                    self.logger.debug(self.pm.ListProcessesInGuest(self.vm, self.creds, [res]))
+                    self.logger.debug(self.guest_op(self.pm.ListProcessesInGuest, self.vm, self.creds, [res]))
                     raise SystemError("Error running command in dom0")
 
 
@@ -225,6 +801,7 @@ class CiRunner:
         """
         FILES_FOR_DOM0 = [
             "runner.py",
+            "preflight.py",
             "qubes.SDCIRunner",
             "qubes.SDCIRunner.policy",
         ]
@@ -232,48 +809,42 @@ class CiRunner:
             file_path = os.path.join(CURRENT_DIR, "dom0", dom0_file)
             with open(file_path, "rb") as myfile:
                 data_to_send = myfile.read()
+            self.put_file_in_dom0(f"/home/user/{dom0_file}", data_to_send)
+            self.logger.debug(f"Successfully uploaded {dom0_file} into dom0")
 
-            url = self.content.guestOperationsManager.fileManager.InitiateFileTransferToGuest(
-                self.vm,
-                self.creds,
-                f"/home/user/{dom0_file}",
-                self.file_attribute,
-                len(data_to_send),
-                True,
-            )
+        # The tests that have been flaky lately, so that runner.py can retry them
+        try:
+            flaky_db = load_flaky_db(REPORTS_DIR, days=self.config.getint("Flaky", "history_days", fallback=30))
+            self.put_file_in_dom0("/home/user/.flaky.json", json.dumps(flaky_db).encode("utf-8"))
+        except OSError as e:
+            self.logger.debug(f"Could not build the flaky test database: {e}")
 
-            # When : host argument becomes https://*:443/guestFile?
-            # Ref: https://github.com/vmware/pyvmomi/blob/master/docs/ \
-            #            vim/vm/guest/FileManager.rst
-            # Script fails in that case, saying URL has an invalid label.
-            # By having hostname in place will take take care of this.
-            url = re.sub(r"^https://\*:", "https://" + str(self.esxi_server) + ":", url)
-
-            # PUT the request
-            resp = requests.put(url, data=data_to_send)
-            if not resp.status_code == 200:
-                raise SystemError(f"Error while uploading file {dom0_file}")
-            else:
-                self.logger.debug(f"Successfully uploaded {dom0_file} into dom0")
+        # Step timeouts from how long the steps took recently, which the
+        # repo's CI YAML file can still override
+        self.put_file_in_dom0("/home/user/.timeouts.json", json.dumps(self.step_timeouts()).encode("utf-8"))
 
         # Move the RPC files into place and with appropriate perms
         commands = [
-            ("/usr/bin/chmod", "755 runner.py qubes.SDCIRunner && sudo mv qubes.SDCIRunner /etc/qubes-rpc/"),
+            ("/usr/bin/chmod", "755 runner.py preflight.py qubes.SDCIRunner && sudo mv qubes.SDCIRunner /etc/qubes-rpc/"),
             ("/usr/bin/sudo", "mv qubes.SDCIRunner.policy /etc/qubes-rpc/policy/qubes.SDCIRunner"),
             ("/usr/bin/systemctl", "restart qubes-qrexec-policy-daemon"),
             ("/usr/bin/mkdir", "-p /home/user/sd-dev/bin"),
         ]
         self.run_command_chain(commands)
 
-        # Write the JSON context to a file. Use the commit hash in the name
-        # to avoid a concurrent CI run clobbering the same file.
+        # Write the JSON context to a file. Use the commit hash and Qubes
+        # version in the name to avoid a concurrent CI run clobbering the
+        # same file.
         commit = context["commit"]
-        context_filename = f"context_{commit}.json"
+        context_filename = f"context_{commit}_{context['version']}.json"
         with open(os.path.join(CURRENT_DIR, "sd-dev", context_filename), "w") as context_file:
             json.dump(context, context_file, indent=4)
 
         FILES_FOR_SD_DEV = [
             "bin/status.py",
+            "bin/delivery.py",
+            "bin/statusd.py",
+            "bin/qubes.SDCIStatus",
             "bin/begin.py",
             ".sdci-ghp.txt",
             ".slack-webhook.txt",
@@ -284,22 +855,8 @@ class CiRunner:
             file_path = os.path.join(CURRENT_DIR, "sd-dev", sd_dev_file)
             with open(file_path, "rb") as myfile:
                 data_to_send = myfile.read()
-
-            url = self.content.guestOperationsManager.fileManager.InitiateFileTransferToGuest(
-                self.vm,
-                self.creds,
-                f"/home/user/sd-dev/{sd_dev_file}",
-                self.file_attribute,
-                len(data_to_send),
-                True,
-            )
-            url = re.sub(r"^https://\*:", "https://" + str(self.esxi_server) + ":", url)
-            # PUT the request
-            resp = requests.put(url, data=data_to_send)
-            if not resp.status_code == 200:
-                raise SystemError(f"Error while uploading file {sd_dev_file}")
-            else:
-                self.logger.debug(f"Successfully uploaded the file {sd_dev_file} into dom0")
+            self.put_file_in_dom0(f"/home/user/sd-dev/{sd_dev_file}", data_to_send)
+            self.logger.debug(f"Successfully uploaded the file {sd_dev_file} into dom0")
 
         # Now copy the files into place
         commands = [
@@ -318,17 +875,111 @@ class CiRunner:
         os.remove(os.path.join(CURRENT_DIR, "sd-dev", context_filename))
 
 
-    def get_files_from_dom0(self, source, dest):
+    def put_file_in_dom0(self, dest, data_to_send):
         """
-        Fetches a file's contents from the VM and writes it to disk.
+        Uploads some data to a file in dom0.
         """
-        fti = self.content.guestOperationsManager.fileManager.InitiateFileTransferFromGuest(self.vm, self.creds, source)
+        url = self.guest_op(
+            self.content.guestOperationsManager.fileManager.InitiateFileTransferToGuest,
+            self.vm,
+            self.creds,
+            dest,
+            self.file_attribute,
+            len(data_to_send),
+            True,
+        )
+
+        # When : host argument becomes https://*:443/guestFile?
+        # Ref: https://github.com/vmware/pyvmomi/blob/master/docs/ \
+        #            vim/vm/guest/FileManager.rst
+        # Script fails in that case, saying URL has an invalid label.
+        # By having hostname in place will take take care of this.
+        url = re.sub(r"^https://\*:", "https://" + str(self.esxi_server) + ":", url)
+
+        # PUT the request
+        resp = self.guest_op(requests.put, url, data=data_to_send)
+        if not resp.status_code == 200:
+            raise SystemError(f"Error while uploading file {dest}")
+
+
+    def read_file_from_dom0(self, source):
+        """
+        Fetches a file's contents from the VM, or None if it doesn't exist.
+        """
+        try:
+            fti = self.guest_op(
+                self.content.guestOperationsManager.fileManager.InitiateFileTransferFromGuest,
+                self.vm,
+                self.creds,
+                source,
+            )
+        except vim.fault.FileNotFound:
+            return None
         url = re.sub(r"^https://\*:", "https://" + str(self.esxi_server) + ":", fti.url)
 
-        resp = requests.get(url)
+        resp = self.guest_op(requests.get, url)
+        return resp.content
+
+
+    def get_files_from_dom0(self, source, dest):
+        """
+        Fetches a file's contents from the VM and writes it to disk.
+        """
+        content = self.read_file_from_dom0(source)
+        if content is None:
+            raise SystemError(f"File {source} does not exist in dom0")
         # Write output into file
         with open(dest, 'wb') as f:
-            f.write(resp.content)
+            f.write(content)
+
+
+    def check_updates(self):
+        """
+        Ask dom0 and each template and standalone whether they have
+        updates available, without installing anything.
+
+        Returns the names of those to update (including any that couldn't
+        be checked, to be safe), or None if the check itself failed.
+        """
+        with open(os.path.join(CURRENT_DIR, "dom0", "updatecheck.py"), "rb") as f:
+            self.put_file_in_dom0("/home/user/updatecheck.py", f.read())
+        exit_code = self.run_command_in_dom0(
+            "/usr/bin/python3",
+            "/home/user/updatecheck.py > /home/user/.updatecheck.log 2>&1",
+        )
+        result = self.read_file_from_dom0("/home/user/.updatecheck.json")
+        if exit_code != 0 or result is None:
+            return None
+        result = json.loads(result)
+        if result["unknown"]:
+            self.logger.debug(f"Could not check {', '.join(result['unknown'])} for updates, updating them anyway")
+        return result["updates"] + result["unknown"]
+
+
+    def cache_repos(self, targets, restore=False):
+        """
+        If a package cache is configured, rewrite the repositories of the
+        targets (all of dom0, the templates and standalones if None) to
+        download through it, or with restore, put them back as they were.
+        HTTPS repositories couldn't be cached otherwise, and the rewritten
+        files must not end up in a snapshot.
+
+        Used around applying updates, and for dom0 in CI runs, where
+        runner.py does the restore after installing the test dependencies.
+        """
+        if not self.config.has_option("Cache", "proxy"):
+            return
+        with open(os.path.join(CURRENT_DIR, "dom0", "cacherepos.py"), "rb") as f:
+            self.put_file_in_dom0("/home/user/cacherepos.py", f.read())
+        args = "--restore" if restore else f"--proxy {self.config.get('Cache', 'proxy')}"
+        if targets is not None:
+            args += f" --targets {','.join(targets)}"
+        exit_code = self.run_command_in_dom0(
+            "/usr/bin/python3",
+            f"/home/user/cacherepos.py {args} >> /home/user/.cacherepos.log 2>&1",
+        )
+        if exit_code != 0:
+            self.logger.debug(f"Could not {'restore' if restore else 'rewrite'} the repositories on {self.vm.name} for the package cache")
 
 
     def apply_updates(self, run_ci):
@@ -336,26 +987,73 @@ class CiRunner:
         Run updates on dom0, templates and standalone VMs.
         Then either reboot (if we are going to run CI as
         the next step) or power off the VM otherwise.
+
+        Unless [Updates] check_first is off, only the ones that have
+        updates available are updated, and if none do we don't reboot.
+        Returns whether anything was updated.
         """
-        self.logger.debug(f"Applying updates on {self.vm.name}")
-        commands = [
-            ("/usr/bin/sudo", "/usr/bin/qubesctl --show-output state.sls update.qubes-dom0"),
-            ("/usr/bin/sudo", "/usr/bin/qubesctl --show-output --skip-dom0 --templates --standalones state.sls update.qubes-vm"),
-        ]
-        self.run_command_chain(commands)
+        started = time.time()
+        targets = None
+        if self.config.getboolean("Updates", "check_first", fallback=True):
+            try:
+                targets = self.check_updates()
+            except Exception as e:
+                self.logger.debug(f"Could not check {self.vm.name} for updates: {e}")
+            if targets is None:
+                self.logger.debug(f"Update check failed on {self.vm.name}, updating everything")
+
+        commands = []
+        if targets is None or "dom0" in targets:
+            commands.append(("/usr/bin/sudo", "/usr/bin/qubesctl --show-output state.sls update.qubes-dom0"))
+        if targets is None:
+            commands.append(("/usr/bin/sudo", "/usr/bin/qubesctl --show-output --skip-dom0 --templates --standalones state.sls update.qubes-vm"))
+        elif [t for t in targets if t != "dom0"]:
+            vms = ",".join(t for t in targets if t != "dom0")
+            commands.append(("/usr/bin/sudo", f"/usr/bin/qubesctl --show-output --skip-dom0 --targets {vms} state.sls update.qubes-vm"))
+
+        if commands:
+            self.logger.debug(f"Applying updates on {self.vm.name}: {', '.join(targets) if targets is not None else 'everything'}")
+            self.cache_repos(targets)
+            try:
+                self.run_command_chain(commands)
+            finally:
+                self.cache_repos(targets, restore=True)
+        else:
+            self.logger.debug(f"No updates available on {self.vm.name}")
+
+        with open(os.path.join(REPORTS_DIR, "updates.jsonl"), "a") as f:
+            f.write(json.dumps({
+                "vm": self.vm.name,
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "seconds": round(time.time() - started),
+                "checked": targets is not None,
+                "updated": targets if targets is not None else ["everything"],
+            }) + "\n")
+
+        if not commands:
+            return False
         if run_ci:
             self.shutdown()
             self.startup()
+        return True
 
 
-    def run_ci(self, context, log_file):
+    def run_ci(self, context, log_file, checkpoint=False):
         """
         Store files on the dom0 and sd-dev VMs and then instruct
         dom0 to tell sd-dev to begin the CI execution.
 
         Finally, retrieve the log file from the CI execution and
         store it in /var/www/html/reports for viewing.
+
+        Returns the final status that the runner reported.
         """
+        # So that status.py posts to this version's status context
+        context = dict(context, version=self.version)
+        # and can say when the build should be done
+        run = self.estimate("run", 50, self.version, self.vm.name)
+        if run is not None:
+            context = dict(context, estimated_finish=self.format_eta(run))
         self.store_files_in_dom0(context)
 
         # Set the log file name that the dom0 runner.py should use. It needs to know
@@ -363,18 +1061,371 @@ class CiRunner:
         # it in the bastion to retrieve it and store it in /var/www/html/reportsA
         self.run_command_in_dom0("/usr/bin/echo", f"{log_file} | /usr/bin/tee /home/user/.logfile")
 
+        # Don't tie the VM up for a whole build that can't succeed
+        if not self.preflight(context, log_file):
+            self.shutdown()
+            return "error"
+
+        # runner.py installs the test dependencies in dom0 through the
+        # package cache, and puts the repositories back once it has
+        self.cache_repos(["dom0"])
+
+        checkpoint_watcher = None
+        done = threading.Event()
+        if checkpoint:
+            # Tell runner.py to pause after 'make dev' so that we can snapshot the VM
+            self.run_command_in_dom0("/usr/bin/touch", "/home/user/.checkpoint")
+            checkpoint_watcher = threading.Thread(
+                target=self.watch_for_checkpoint, args=(context["commit"], done), daemon=True
+            )
+            checkpoint_watcher.start()
+
         # Now execute the command on sd-dev to run the test suite
         self.logger.debug(f"Commencing the CI execution on {self.vm.name}")
         cmd = "sd-dev /usr/bin/python3 /home/user/bin/begin.py"
-        self.run_command_in_dom0("/usr/bin/qvm-run", cmd)
+        try:
+            self.run_command_in_dom0("/usr/bin/qvm-run", cmd)
+        finally:
+            if checkpoint_watcher:
+                done.set()
+                checkpoint_watcher.join()
+
+        return self.collect_results(log_file)
+
+
+    def preflight(self, context, log_file):
+        """
+        Check that dom0 and sd-dev have the disk space, network, qrexec
+        policy and files a CI run needs, in one batch, before starting it.
+
+        If any check fails, publish the results as the run's log, report
+        an error status linking to it and return False.
+        """
+        started = time.time()
+        min_free_gb = self.config.getfloat("Preflight", "min_free_gb", fallback=5)
+        exit_code = self.run_command_in_dom0(
+            "/usr/bin/python3",
+            f"/home/user/preflight.py --min-free-gb {min_free_gb} > /home/user/.preflight.log 2>&1",
+        )
+        seconds = time.time() - started
+        if exit_code == 0:
+            self.logger.debug(f"Pre-flight checks on {self.vm.name} passed in {seconds:.0f} seconds")
+            return True
+
+        output = self.read_file_from_dom0("/home/user/.preflight.log") or b"No output from the pre-flight checks\n"
+        with open(os.path.join(REPORTS_DIR, log_file), "wb") as f:
+            f.write(f"Pre-flight checks on {self.vm.name} failed after {seconds:.0f} seconds:\n".encode("utf-8"))
+            f.write(output)
+        failed = [line[len("FAILED: "):] for line in output.decode("utf-8", "replace").splitlines() if line.startswith("FAILED: ")]
+        self.logger.debug(f"Pre-flight checks on {self.vm.name} failed after {seconds:.0f} seconds: {'; '.join(failed)}")
+
+        # Github limits descriptions to 140 characters
+        description = f"Pre-flight checks failed ({seconds:.0f}s): {'; '.join(failed) or 'see log'}"[:140]
+        self.github_status(context["commit"], "error", description, f"{REPORTS_URL}/{log_file}", self.version)
+        return False
+
+
+    def collect_results(self, log_file):
+        """
+        Fetch the log file and final status of a CI run, then shut
+        down the VM to free it up for use by other runners.
+        """
+        if self.job_canceled():
+            # The cancel command fetches the log and powers the VM off
+            self.logger.debug(f"CI run on {self.vm.name} was canceled")
+            return "canceled"
 
-        # Fetch the log file
         source = f"/home/user/{log_file}"
-        dest = f"/var/www/html/reports/{log_file}"
+        dest = os.path.join(REPORTS_DIR, log_file)
         self.get_files_from_dom0(source, dest)
 
-        # Shut down the VM to free it up for use by other runners
+        # Resource samples taken during each step, if there were any
+        metrics = self.read_file_from_dom0(f"{source}.metrics.csv")
+        if metrics is not None:
+            with open(f"{dest}.metrics.csv", "wb") as f:
+                f.write(metrics)
+
+        # Where each step starts and ends in the log, for viewer.html
+        index = self.read_file_from_dom0(f"{source}.index.json")
+        if index is not None:
+            with open(f"{dest}.index.json", "wb") as f:
+                f.write(index)
+        self.publish_viewer()
+
+        status = self.read_file_from_dom0("/home/user/.sdci-done")
+        status = status.decode("utf-8").strip() if status else "error"
+        self.logger.debug(f"CI run on {self.vm.name} finished with status {status}")
+
+        undelivered = self.collect_outbox()
         self.shutdown()
+        if undelivered:
+            self.delivery.flush()
+        return status
+
+
+    def collect_outbox(self):
+        """
+        Take over whatever status.py in sd-dev couldn't deliver into our
+        own outbox, as it would be lost when the VM is next reverted.
+        Returns whether there was anything.
+        """
+        self.run_command_in_dom0(
+            "/usr/bin/qvm-run",
+            "--pass-io sd-dev 'cat /home/user/.sdci-outbox/outbox.json' > /home/user/.sdci-outbox.json 2>/dev/null",
+        )
+        outbox = self.read_file_from_dom0("/home/user/.sdci-outbox.json")
+        try:
+            events = json.loads(outbox) if outbox else []
+        except ValueError:
+            events = []
+        if events:
+            self.logger.debug(f"Taking over {len(events)} undelivered events from sd-dev on {self.vm.name}")
+            self.delivery.adopt(events)
+        return bool(events)
+
+
+    def publish_viewer(self):
+        """
+        Copy viewer.html into the reports directory, if it isn't there
+        already or has changed.
+        """
+        with open(os.path.join(CURRENT_DIR, "viewer.html"), "rb") as f:
+            viewer = f.read()
+        dest = os.path.join(REPORTS_DIR, "viewer.html")
+        try:
+            with open(dest, "rb") as f:
+                if f.read() == viewer:
+                    return
+        except OSError:
+            pass
+        tmp_path = f"{dest}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(viewer)
+        os.replace(tmp_path, dest)
+
+
+    def job_file(self, commit, version):
+        return os.path.join(JOBS_DIR, f"{commit}-{version}.json")
+
+
+    def write_job(self, path, job):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+
+
+    def start_job(self, commit, version, log_file):
+        """
+        Record which VM a job is running on, so that --cancel can find it.
+        """
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        self.job = {
+            "commit": commit,
+            "version": version,
+            "vm": self.vm.name,
+            "uuid": self.vm.config.uuid,
+            "log_file": log_file,
+            "pid": os.getpid(),
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "canceled": False,
+            "statuses": self.statuses,
+        }
+        self.write_job(self.job_file(commit, version), self.job)
+
+
+    def job_canceled(self):
+        """
+        Whether the current job has been canceled by --cancel.
+        """
+        if not self.job:
+            return False
+        try:
+            with open(self.job_file(self.job["commit"], self.job["version"]), "r") as f:
+                return json.load(f).get("canceled", False)
+        except (OSError, ValueError):
+            return False
+
+
+    def check_canceled(self):
+        """
+        Raise BuildCanceled if the build has been canceled, by --cancel
+        or by stopping this CiRunner.
+        """
+        if self.stopping.is_set() or self.job_canceled():
+            raise BuildCanceled("The build was canceled")
+
+
+    def finish_job(self):
+        if self.job:
+            try:
+                os.remove(self.job_file(self.job["commit"], self.job["version"]))
+            except FileNotFoundError:
+                pass
+            self.job = None
+
+
+    def cancel(self, commit, version):
+        """
+        Cancel a running job: tell runner.py to kill the step it is running,
+        fetch the log so far, report the build as canceled, and power off
+        the VM straight away so that queued jobs can have it.
+        """
+        job_file = self.job_file(commit, version)
+        try:
+            with open(job_file, "r") as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            raise SystemError(f"There is no running job for {commit} on Qubes {version}")
+        # e.g a bisect_ci.py build, which doesn't post commit statuses
+        if not job.get("statuses", True):
+            self.statuses = False
+
+        # Mark it canceled first, so that the job's own run.py doesn't report
+        # an error when its VM goes away
+        job["canceled"] = True
+        self.write_job(job_file, job)
+
+        for endpoint, content, vm in self.find_vms(version):
+            if vm.config.uuid == job["uuid"]:
+                self.use_endpoint(endpoint)
+                self.content = content
+                self.vm = vm
+                break
+        else:
+            raise SystemError(f"Could not find {job['vm']}, which was running {commit}")
+        self.logger.debug(f"Canceling {commit} on {self.vm.name}")
+
+        reported = False
+        log_url = None
+        if self.vm.runtime.powerState == "poweredOn":
+            try:
+                self.put_file_in_dom0("/home/user/.cancel", b"cancel\n")
+                # Give runner.py a moment to kill the step and report the status
+                deadline = time.time() + 60
+                while time.time() < deadline and self.read_file_from_dom0("/home/user/.sdci-done") is None:
+                    self.sleep(5)
+                reported = (self.read_file_from_dom0("/home/user/.sdci-done") or b"").strip() == b"canceled"
+                partial_log = self.read_file_from_dom0(f"/home/user/{job['log_file']}")
+                if partial_log is not None:
+                    with open(os.path.join(REPORTS_DIR, job["log_file"]), "wb") as f:
+                        f.write(partial_log)
+                    log_url = f"{REPORTS_URL}/viewer.html?log={job['log_file']}"
+                    index = self.read_file_from_dom0(f"/home/user/{job['log_file']}.index.json")
+                    if index is not None:
+                        with open(os.path.join(REPORTS_DIR, f"{job['log_file']}.index.json"), "wb") as f:
+                            f.write(index)
+                    self.publish_viewer()
+                self.collect_outbox()
+            except Exception as e:
+                # e.g runner.py hasn't started yet, or the VM is still booting
+                self.logger.debug(f"Could not stop runner.py on {self.vm.name}: {e}")
+            WaitForTask(self.vm.PowerOffVM_Task())
+
+        if not reported:
+            self.github_status(commit, "error", "The build was canceled by an administrator", log_url, version)
+        else:
+            # Anything we took over from sd-dev
+            self.delivery.flush()
+
+        # Normally the job's own run.py cleans up, unless it has gone
+        try:
+            os.kill(job["pid"], 0)
+        except ProcessLookupError:
+            os.remove(job_file)
+        self.logger.debug(f"Canceled {commit} and powered off {self.vm.name}")
+
+
+    def watch_for_checkpoint(self, commit, done):
+        """
+        Wait for runner.py to tell us that 'make dev' has finished,
+        then snapshot the VM (including its memory, so that the paused
+        runner carries on where it left off when reverted) and tell
+        runner.py to continue.
+        """
+        while not done.wait(15):
+            if self.read_file_from_dom0("/home/user/.checkpoint-ready") is None:
+                continue
+            try:
+                self.take_checkpoint(commit)
+            except Exception as e:
+                self.logger.debug(f"Could not take checkpoint of {self.vm.name}: {e}")
+            self.put_file_in_dom0("/home/user/.checkpoint-taken", b"continue\n")
+            return
+
+
+    def take_checkpoint(self, commit):
+        """
+        Take a snapshot of the running VM, tagged with the commit.
+        """
+        now = datetime.now()
+        checkpoint_name = f"checkpoint_{commit}_{now.strftime('%Y%m%d%H%M%S')}"
+        checkpoint_desc = f"Checkpoint of {commit} after 'make dev', taken at {now.strftime('%a, %d %B %Y %H:%M:%S')}"
+        dumpMemory = True
+        quiesce = False
+        self.logger.debug(f"Taking checkpoint of {self.vm.name} with snapshot ID {checkpoint_name}")
+        WaitForTask(self.vm.CreateSnapshot(checkpoint_name, checkpoint_desc, dumpMemory, quiesce))
+
+        # Keep snapshot chains short
+        keep = self.config.getint("Checkpoint", "keep", fallback=2)
+        self.remove_old_snapshots(prefix="checkpoint_", keep=keep)
+
+
+    def expire_checkpoints(self):
+        """
+        Remove checkpoint snapshots older than the configured TTL.
+        """
+        ttl = self.config.getint("Checkpoint", "ttl_hours", fallback=24) * 3600
+        all_snapshots = []
+        for snapshot in self.vm.snapshot.rootSnapshotList if self.vm.snapshot else []:
+            all_snapshots.extend(self.get_all_snapshots(snapshot))
+
+        for snapshot in all_snapshots:
+            if not snapshot.name.startswith("checkpoint_"):
+                continue
+            age = time.time() - snapshot.createTime.timestamp()
+            if age > ttl:
+                self.logger.debug(f"Deleting expired checkpoint: {snapshot.name}")
+                WaitForTask(snapshot.snapshot.RemoveSnapshot_Task(removeChildren=False))
+
+
+    def find_checkpoint(self, commit):
+        """
+        Return the most recent checkpoint snapshot for a commit on
+        the current VM, if there is one.
+        """
+        all_snapshots = []
+        for snapshot in self.vm.snapshot.rootSnapshotList if self.vm.snapshot else []:
+            all_snapshots.extend(self.get_all_snapshots(snapshot))
+
+        checkpoints = [s for s in all_snapshots if s.name.startswith(f"checkpoint_{commit}_")]
+        checkpoints.sort(key=lambda x: x.createTime, reverse=True)
+        return checkpoints[0] if checkpoints else None
+
+
+    def resume_ci(self, log_file):
+        """
+        Carry on a CI run on a VM that was just reverted to a checkpoint.
+
+        runner.py is still paused waiting for us after 'make dev', so
+        cancel the shutdown it had scheduled (the clock is about to jump
+        forward), give it the new log file name and wait for it to finish.
+        """
+        shutdown_minutes = self.shutdown_minutes()
+        commands = [
+            ("/usr/bin/sudo", "/usr/sbin/shutdown -c"),
+            ("/usr/bin/sudo", f"/usr/sbin/shutdown -h +{shutdown_minutes}"),
+        ]
+        self.run_command_chain(commands)
+        self.put_file_in_dom0("/home/user/.checkpoint-taken", f"resume {log_file}\n".encode("utf-8"))
+
+        start_time = time.time()
+        while time.time() - start_time < shutdown_minutes * 60:
+            if self.read_file_from_dom0("/home/user/.sdci-done") is not None:
+                break
+            self.sleep(30)
+
+        return self.collect_results(log_file)
 
 
     def remove_old_snapshots(self, prefix, keep):
@@ -387,21 +1438,17 @@ class CiRunner:
         for snapshot in self.vm.snapshot.rootSnapshotList:
             all_snapshots.extend(self.get_all_snapshots(snapshot))
 
-        # Filter snapshots that start with "update_"
-        update_snapshots = [snapshot for snapshot in all_snapshots if snapshot.name.startswith(prefix)]
+        # Filter snapshots that start with the prefix
+        matching_snapshots = [snapshot for snapshot in all_snapshots if snapshot.name.startswith(prefix)]
 
         # Sort the snapshots by creation time in descending order
-        update_snapshots.sort(key=lambda x: x.createTime, reverse=True)
+        matching_snapshots.sort(key=lambda x: x.createTime, reverse=True)
 
-        # Keep the last 3 snapshots
-        snapshots_to_keep = update_snapshots[:3]
-
-        # Delete snapshots that are not in the snapshots_to_keep list
-        for snapshot in update_snapshots[3:]:
-            if snapshot not in snapshots_to_keep:
-                self.logger.debug(f"Deleting old snapshot: {snapshot.name}")
-                task = snapshot.snapshot.RemoveSnapshot_Task(removeChildren=False)
-                WaitForTask(task)
+        # Delete all but the last N snapshots
+        for snapshot in matching_snapshots[keep:]:
+            self.logger.debug(f"Deleting old snapshot: {snapshot.name}")
+            task = snapshot.snapshot.RemoveSnapshot_Task(removeChildren=False)
+            WaitForTask(task)
 
 
     def shutdown(self):
@@ -410,10 +1457,12 @@ class CiRunner:
         """
         self.logger.debug(f"Shutting down {self.vm.name}")
         self.vm.ShutdownGuest()
-        time.sleep(30)
+        self.sleep(30)
         state = self.vm.runtime.powerState
         if state != "poweredOff":
             WaitForTask(self.vm.PowerOffVM_Task())
+        self.logger.debug(f"Run on {self.vm.name} made {self.limiter.summary()}")
+        self.limiter.reset()
 
 
     def startup(self):
@@ -429,7 +1478,7 @@ class CiRunner:
         while power_on_attempts < max_attempts:
             if self.vm.runtime.powerState == "poweredOn":
                 if self.vm.guest.toolsStatus == vim.vm.GuestInfo.ToolsStatus.toolsOk:
-                    time.sleep(60)
+                    self.sleep(60)
                     self.logger.debug(f"VM {self.vm.name} is now ready, moving on with next steps")
                     break
                 else:
@@ -437,12 +1486,36 @@ class CiRunner:
             else:
                 self.logger.debug(f"VM {self.vm.name} is not yet powered on.")
 
-            time.sleep(10)
+            self.sleep(10)
             power_on_attempts += 1
 
         if power_on_attempts == max_attempts:
             raise SystemError(f"Max attempts reached, VM {self.vm.name} did not seem to get fully booted")
 
+        self.configure_package_cache()
+
+
+    def configure_package_cache(self):
+        """
+        Point the Qubes updates proxy at the package cache on the bastion,
+        if one is configured. Templates and standalones download through
+        it. Their repositories, and dom0's (which the UpdateVM downloads
+        with), are only pointed at the cache while updates are applied,
+        see cache_repos().
+
+        This is not persistent in the AppVMs, so it needs to be
+        repeated after every boot.
+        """
+        if not self.config.has_option("Cache", "proxy"):
+            return
+        proxy = self.config.get("Cache", "proxy")
+        updates_proxy_vm = self.config.get("Cache", "updates_proxy_vm", fallback="sys-net")
+        self.logger.debug(f"Configuring {self.vm.name} to use the package cache at {proxy}")
+        commands = [
+            ("/usr/bin/qvm-run", f"-u root {updates_proxy_vm} \"echo 'Upstream http {proxy}' >> /etc/tinyproxy/tinyproxy-updates.conf && systemctl restart qubes-updates-proxy\""),
+        ]
+        self.run_command_chain(commands)
+
 
     def take_snapshot(self):
         """
@@ -469,11 +1542,18 @@ class CiRunner:
         with open(self.config_file, "w") as c:
             self.config.write(c)
 
-        # We now want to delete old snapshots to conserve space and try to help performance
-        self.remove_old_snapshots(prefix="update_", keep=3)
+        # We now want to delete old snapshots to conserve space and try to help performance.
+        # That consolidates their disks, which is slow, so if there is a maintenance
+        # window then --maintain does it then instead.
+        if self.config.has_option("Snapshots", "maintenance_window"):
+            self.logger.debug("Leaving old snapshots to be removed in the maintenance window")
+        else:
+            self.remove_old_snapshots(prefix="update_", keep=self.config.getint("Snapshots", "keep", fallback=3))
+        # Its chain has changed, so measure it again next time it is picked
+        self.chain_cache.pop(self.vm.config.uuid, None)
 
 
-    def main(self, version, context, snapshot_name=False, update=False):
+    def main(self, version, context, snapshot_name=False, update=False, checkpoint=False):
         """
         Main entry point to the script.
 
@@ -483,7 +1563,7 @@ class CiRunner:
         Then run CI (if --context passed in), update routines (if --update passed in),
         saving new snapshot (if --save passed in).
 
-        Finally, power off the VM again.
+        Finally, power off the VM again, and return the final status of the run.
 
         If we couldn't find an available VM, sleep for a while and keep trying
         (it may be that other VMs are already running a CI run).
@@ -491,84 +1571,189 @@ class CiRunner:
 
         # Used for the log file name, to get a sense of when it started.
         now = datetime.now()
-        date_name = now.strftime("%Y-%m-%d")
-        time_name = now.strftime("%H%M%S%f")
 
         # Load the context and get commit hash
         context = json.loads(context)
         commit = context["commit"]
-        self.notify_github_queued(commit)
+        self.notify_github_queued(commit, version)
 
         # Start a loop to try and find a VM to run tasks on.
         start_time = time.time()
-        # Loop until 2 hours have passed, then give up - no machines were available
-        while time.time() - start_time < 7200:
+        # Loop until we have waited longer than builds usually take to start,
+        # then give up - no machines were available
+        give_up = self.vm_wait(version)
+        while time.time() - start_time < give_up:
             self.vm = None
-            # Find source VM
-            content = self.si.RetrieveContent()
-            vm_folder = content.rootFolder.childEntity[0].vmFolder
-            source_vm_name = f"Qubes_{version}"
-
-            for vm in vm_folder.childEntity:
-                state = vm.runtime.powerState
-                if source_vm_name in vm.name and state == "poweredOff":
-                    self.vm = vm
-                    self.content = content
-                    break  # Found a suitable VM, no need to continue the loop
+            # Find a free source VM on the least loaded host
+            picked = self.pick_vm(version)
+            if picked:
+                endpoint, self.content, self.vm = picked
+                self.use_endpoint(endpoint)
 
             if self.vm:
                 # Great, the machine matches the version we want and it is off,
                 # meaning it is not running any CI
-                self.logger.debug(f"Using machine {self.vm.name} for CI")
+                return self.run_on_vm(version, context, snapshot_name, update, checkpoint, now)
+            else:
+                # Continue to the next iteration if the desired VM is not found
+                self.logger.debug(
+                    f"Couldn't find any VMs matching version {version} that are not in use, sleeping for 60 seconds"
+                )
+                self.sleep(60)
+        else:
+            self.notify_github_gave_up(commit, version)
+            raise SystemError(f"Gave up after {give_up / 60:.0f} minutes trying to find a VM to run CI on.")
 
-                # If no snapshot was specified explicitly, fetch the latest ID
-                # from the config file for this version.
-                if not snapshot_name:
-                    snapshot_name = self.config.get(self.vm.config.uuid, "snapshot")
 
-                # Restore to known clean snapshot
-                snapshot = self.get_snapshot_by_name(snapshot_name)
-                if snapshot:
-                    self.logger.debug(f"First reverting {self.vm.name} to snapshot {snapshot_name}")
-                    WaitForTask(snapshot.RevertToSnapshot_Task())
-                else:
-                    raise SystemError(
-                        f"Could not find snapshot with name {snapshot_name} for {self.vm.name}"
-                    )
+    def run_on_vm(self, version, context, snapshot_name, update, checkpoint, queued):
+        """
+        Run a build on the VM that was picked for it: revert it to the
+        snapshot, power it up, apply updates if this is a nightly, run
+        CI and return its final status.
+        """
+        commit = context["commit"]
+        date_name = queued.strftime("%Y-%m-%d")
+        time_name = queued.strftime("%H%M%S%f")
+        self.version = version
+
+        self.logger.debug(f"Using machine {self.vm.name} for CI")
+        self.expire_checkpoints()
+
+        # If no snapshot was specified explicitly, fetch the latest ID
+        # from the config file for this version.
+        if not snapshot_name:
+            snapshot_name = self.config.get(self.vm.config.uuid, "snapshot")
+
+        try:
+            # maintain() may have claimed the VM since pick_vm() looked at it
+            while self.under_maintenance(self.vm):
+                self.logger.debug(f"{self.vm.name} is being maintained, waiting for that to finish")
+                self.sleep(60)
+            # or the build may have been canceled while it waited for a VM
+            self.check_canceled()
+        except BuildCanceled:
+            self.logger.debug(f"{commit} was canceled before it started on {self.vm.name}")
+            self.github_status(commit, "error", "The build was canceled by an administrator", version=version)
+            return "canceled"
+
+        # Restore to known clean snapshot
+        snapshot = self.get_snapshot_by_name(snapshot_name)
+        if snapshot:
+            self.logger.debug(f"First reverting {self.vm.name} to snapshot {snapshot_name}")
+            WaitForTask(snapshot.RevertToSnapshot_Task())
+        else:
+            raise SystemError(
+                f"Could not find snapshot with name {snapshot_name} for {self.vm.name}"
+            )
 
-                # Use snapshot in the log file name, but make sure it has no spaces
-                snapshot_name_for_log = snapshot_name.replace(' ', '-')
+        # Use snapshot in the log file name, but make sure it has no spaces
+        snapshot_name_for_log = snapshot_name.replace(' ', '-')
+        log_file = f"{date_name}-{time_name}-{commit}-{self.vm.name}-{snapshot_name_for_log}.log.txt"
+        self.start_job(commit, version, log_file)
 
-                # Power on VM
-                self.startup()
+        try:
+            # A cancel before the VM is on finds nothing to power off, so
+            # it is up to us to stop
+            self.check_canceled()
 
-                try:
-                    # Set the machine to shutdown in just under 2 hours in case it gets stuck during CI run or during updates
-                    self.run_command_in_dom0("/usr/bin/sudo", "/usr/sbin/shutdown -h +110")
+            # Power on VM
+            self.startup()
 
-                    # If we are doing a nightly test, apply updates and reboot, reconnect
-                    if update:
-                        self.apply_updates(True)
+            # Set the machine to shutdown in case it gets stuck during CI run or during updates
+            self.run_command_in_dom0("/usr/bin/sudo", f"/usr/sbin/shutdown -h +{self.shutdown_minutes(update)}")
+
+            # If we are doing a nightly test, apply updates and reboot, reconnect
+            if update:
+                self.apply_updates(True)
+
+            self.check_canceled()
+            # Run CI. Return here, so that we never risk saving the post-CI state to snapshot
+            return self.run_ci(context, log_file, checkpoint)
+        except Exception as e:
+            if self.job_canceled():
+                # --cancel has reported it. It powered the VM off if it was
+                # on by then, otherwise we might have powered it on since.
+                if self.vm.runtime.powerState == "poweredOn":
+                    self.vm.PowerOffVM_Task()
+                return "canceled"
+            self.logger.debug(f"Error occurred during execution: {e}")
+            self.vm.PowerOffVM_Task()
+            if isinstance(e, BuildCanceled):
+                self.github_status(commit, "error", "The build was canceled by an administrator", version=version)
+                return "canceled"
+            return "error"
+        finally:
+            self.finish_job()
+
+
+    def count_vms(self, version):
+        """
+        Count the VMs that can run CI for a Qubes version.
+        """
+        return len(self.find_vms(version))
+
+
+    def resume(self, version, context):
+        """
+        Resume a CI run from the checkpoint taken for its commit after
+        'make dev' succeeded, running only the remaining steps.
 
-                    log_file = f"{date_name}-{time_name}-{commit}-{self.vm.name}-{snapshot_name_for_log}.log.txt"
+        Checkpoints live on a particular VM, so we have to wait for
+        that VM in particular to be free.
+        """
+        now = datetime.now()
+        date_name = now.strftime("%Y-%m-%d")
+        time_name = now.strftime("%H%M%S%f")
 
-                    # Run CI
-                    self.run_ci(context, log_file)
+        context = json.loads(context)
+        commit = context["commit"]
+        self.notify_github_queued(commit, version)
+        self.version = version
 
-                    # Return here, so that we never risk saving the post-CI state to snapshot
-                    return True
+        start_time = time.time()
+        give_up = self.vm_wait(version)
+        while time.time() - start_time < give_up:
+            self.vm = None
+            checkpoint = None
+            busy = False
+            for endpoint, content, vm in self.find_vms(version):
+                self.use_endpoint(endpoint)
+                self.vm = vm
+                free = vm.runtime.powerState == "poweredOff"
+                if free:
+                    self.expire_checkpoints()
+                checkpoint = self.find_checkpoint(commit)
+                if checkpoint and free:
+                    self.content = content
+                    break
+                busy = busy or checkpoint is not None
+                checkpoint = None
+                self.vm = None
+
+            if checkpoint:
+                self.logger.debug(f"Resuming {commit} on {self.vm.name} from checkpoint {checkpoint.name}")
+                # This was a snapshot of a running VM, so reverting it powers it back on
+                WaitForTask(checkpoint.snapshot.RevertToSnapshot_Task())
+                log_file = f"{date_name}-{time_name}-{commit}-{self.vm.name}-{checkpoint.name}.log.txt"
+                self.start_job(commit, version, log_file)
+                try:
+                    return self.resume_ci(log_file)
                 except Exception as e:
+                    if self.job_canceled():
+                        return "canceled"
                     self.logger.debug(f"Error occurred during execution: {e}")
                     self.vm.PowerOffVM_Task()
-                    return False
+                    return "error"
+                finally:
+                    self.finish_job()
+            elif busy:
+                self.logger.debug(f"The VM holding the checkpoint for {commit} is in use, sleeping for 60 seconds")
+                self.sleep(60)
             else:
-                # Continue to the next iteration if the desired VM is not found
-                self.logger.debug(
-                    f"Couldn't find any VMs matching version {version} that are not in use, sleeping for 60 seconds"
-                )
-                time.sleep(60)
+                raise SystemError(f"Could not find a checkpoint for {commit} on any Qubes {version} VM")
         else:
-            raise SystemError("Gave up after 1 hour trying to find a VM to run CI on.")
+            self.notify_github_gave_up(commit, version)
+            raise SystemError(f"Gave up after {give_up / 60:.0f} minutes waiting for the VM holding the checkpoint.")
 
 
     def save(self, version, snapshot_name, update):
@@ -579,14 +1764,16 @@ class CiRunner:
         needs to iterate over *each* VM that matches the version,
         not just the first one it finds a match for.
         """
-        self.content = self.si.RetrieveContent()
-        vm_folder = self.content.rootFolder.childEntity[0].vmFolder
-        source_vm_name = f"Qubes_{version}"
-
-        for vm in vm_folder.childEntity:
+        for endpoint, content, vm in self.find_vms(version):
+            if self.under_maintenance(vm):
+                self.logger.debug(f"{vm.name} is being maintained, not saving a snapshot of it")
+                continue
             state = vm.runtime.powerState
-            if source_vm_name in vm.name and state == "poweredOff":
+            if state == "poweredOff":
+                self.use_endpoint(endpoint)
+                self.content = content
                 self.vm = vm
+                self.expire_checkpoints()
                 # Fetch the latest snapshot ID from the config file for this VM
                 # if we didn't explicitly pass one in as an arg
                 if not snapshot_name:
@@ -608,8 +1795,11 @@ class CiRunner:
                 self.startup()
                 try:
                     # If we are doing a nightly test, apply updates and reboot, reconnect
-                    if update:
-                        self.apply_updates(False)
+                    if update and not self.apply_updates(False):
+                        # Nothing changed, so the current snapshot is still up to date
+                        self.logger.debug(f"Keeping the current snapshot of {self.vm.name}")
+                        self.shutdown()
+                        continue
                     self.take_snapshot()
                 except Exception as e:
                     # Don't abort, we want want to move on to the next machine
@@ -622,7 +1812,30 @@ if __name__ == "__main__":
 
     ci = CiRunner()
 
-    if args.save:
-        ci.save(args.version, args.snapshot, args.update)
+    version = args.version[0]
+    if args.cancel:
+        ci.cancel(args.cancel, version)
+    elif args.maintain:
+        ci.maintain(version)
+    elif args.save:
+        ci.save(version, args.snapshot, args.update)
     else:
-        ci.main(args.version, args.context, args.snapshot, args.update)
+        if args.resume:
+            status = ci.resume(version, args.context)
+        elif len(args.version) > 1:
+            # Run on every version at once, each build posting to its own
+            # status context. engine.py imports us, so import it here.
+            import asyncio
+            from engine import Engine, run_builds
+            statuses = asyncio.run(
+                run_builds(
+                    Engine(ci), args.version, [json.loads(args.context)], args.snapshot, args.update, args.checkpoint
+                )
+            )
+            for (commit, build_version), build_status in statuses.items():
+                print(f"{commit} on Qubes {build_version}: {build_status}")
+            status = "success" if all(s == "success" for s in statuses.values()) else "failure"
+        else:
+            status = ci.main(version, args.context, args.snapshot, args.update, args.checkpoint)
+        # Let whatever started us (e.g nightlies.py) know how the run went
+        sys.exit(0 if status == "success" else 1)
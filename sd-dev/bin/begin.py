@@ -18,6 +18,9 @@ def run():
     owner = "freedomofpress"
     repo = "securedrop-workstation"
 
+    # Install the status agent that dom0 reports commit statuses through
+    subprocess.run(["sudo", "install", "-m", "755", "/home/user/bin/qubes.SDCIStatus", "/etc/qubes-rpc/"])
+
     working_dir = "/var/lib/sdci-ci-runner"
     subprocess.run(["sudo", "mkdir", "-p", working_dir])
     subprocess.run(["sudo", "chown", "user:user", working_dir])
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import fcntl
+import json
+import os
+import time
+import uuid
+import requests
+
+GITHUB_STATUSES_URL = "https://api.github.com/repos/freedomofpress/securedrop-workstation/statuses"
+
+
+def status_context(version=None):
+    """
+    The Github status context for a build on a Qubes version, so that each
+    version a commit is tested on has a status of its own.
+    """
+    return f"sd-ci-runner/qubes-{version}" if version else "sd-ci-runner"
+
+
+class StatusDelivery:
+    def __init__(self, logger, github_token_file, slack_webhook_file=None, outbox_dir=None, timeout=10, attempts=3, backoff=2):
+        """
+        Deliver commit statuses to Github and notifications to Slack.
+
+        The HTTP session and credentials are reused for every event, each
+        request has a timeout and is retried with exponential backoff, and
+        events that still could not be delivered are kept in an outbox
+        on disk, to be sent the next time we flush it.
+        """
+        self.logger = logger
+        self.github_token_file = github_token_file
+        self.slack_webhook_file = slack_webhook_file
+        self.outbox_dir = outbox_dir or os.path.join(os.path.expanduser("~"), ".sdci-outbox")
+        self.outbox_file = os.path.join(self.outbox_dir, "outbox.json")
+        self.timeout = timeout
+        self.attempts = attempts
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.github_token = None
+        self.slack_webhook_url = None
+        os.makedirs(self.outbox_dir, exist_ok=True)
+
+    def github_status(self, commit, state, description, target_url=None, context="sd-ci-runner"):
+        """
+        Queue a Github commit status and try to deliver everything queued.
+        """
+        data = {
+            "context": context,
+            "description": description,
+            "state": state,
+        }
+        if target_url:
+            data["target_url"] = target_url
+        self.enqueue({"kind": "github", "commit": commit, "data": data})
+        return self.flush()
+
+    def slack(self, message):
+        """
+        Queue a Slack notification and try to deliver everything queued.
+        """
+        self.enqueue({"kind": "slack", "data": message})
+        return self.flush()
+
+    def enqueue(self, event):
+        """
+        Add an event to the outbox.
+
+        Github only shows the latest status for each commit and context, so
+        a 'pending' status (which is what we send for both queued and
+        running) that is still waiting to be delivered is dropped once a
+        newer status for the same commit and context comes along.
+        """
+        event["queued"] = time.time()
+        with self.locked_outbox() as events:
+            self.add(events, event)
+
+    def adopt(self, outbox):
+        """
+        Take over the events queued in another outbox (the contents of its
+        outbox.json), e.g one in a VM that is about to be reverted, keeping
+        their order.
+        """
+        with self.locked_outbox() as events:
+            for event in outbox:
+                self.add(events, event)
+
+    def add(self, events, event):
+        event.setdefault("id", uuid.uuid4().hex)
+        if event["kind"] == "github":
+            events[:] = [
+                e for e in events
+                if not (
+                    e["kind"] == "github"
+                    and e["commit"] == event["commit"]
+                    and e["data"]["context"] == event["data"]["context"]
+                    and e["data"]["state"] == "pending"
+                )
+            ]
+        events.append(event)
+
+    def flush(self):
+        """
+        Deliver queued events, in order for each destination: the Github
+        statuses of each commit, and Slack. We stop at the first event
+        for a destination that can't be delivered, so that a later status
+        never overtakes an earlier one, while the other destinations
+        carry on.
+
+        Events are sent without holding the outbox lock. Only one process
+        flushes at a time, and one that finds another already flushing
+        leaves its events to that one. Returns True if the outbox is now
+        empty.
+        """
+        flush_lock = open(f"{self.outbox_file}.flush", "w")
+        try:
+            fcntl.flock(flush_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            flush_lock.close()
+            with self.locked_outbox() as events:
+                return not events
+
+        attempted = set()
+        blocked = set()
+        try:
+            while True:
+                with self.locked_outbox() as events:
+                    for event in events:
+                        event.setdefault("id", uuid.uuid4().hex)
+                    todo = [
+                        e for e in events
+                        if e["id"] not in attempted and self.destination(e) not in blocked
+                    ]
+                    if not todo:
+                        # Still holding the outbox, so that anything queued
+                        # from now on is flushed by whoever queued it
+                        fcntl.flock(flush_lock, fcntl.LOCK_UN)
+                        flush_lock.close()
+                        if events:
+                            self.logger.debug(f"Keeping {len(events)} undelivered events in {self.outbox_file}")
+                        return not events
+                for event in todo:
+                    if self.destination(event) in blocked:
+                        continue
+                    attempted.add(event["id"])
+                    if not self.send(event):
+                        blocked.add(self.destination(event))
+                        continue
+                    with self.locked_outbox() as events:
+                        events[:] = [e for e in events if e.get("id") != event["id"]]
+        finally:
+            # Closing it releases the lock, even if sending raised, so that
+            # later flushes in this process aren't locked out for good
+            if not flush_lock.closed:
+                flush_lock.close()
+
+    def destination(self, event):
+        if event["kind"] == "github":
+            return ("github", event["commit"])
+        return (event["kind"],)
+
+    def send(self, event):
+        """
+        Send a single event, retrying with exponential backoff.
+        """
+        try:
+            self.load_credentials(event["kind"])
+        except (OSError, TypeError) as e:
+            # e.g a missing token file: try again, and keep the event, next time
+            self.logger.debug(f"Could not read the credentials to deliver {event['kind']} event: {e}")
+            return False
+
+        if event["kind"] == "github":
+            url = f"{GITHUB_STATUSES_URL}/{event['commit']}"
+            headers = {
+                "Authorization": f"Bearer {self.github_token}",
+                "Content-Type": "application/json",
+            }
+            self.logger.debug(f"Posting commit status for {event['commit']} to Github")
+        else:
+            url = self.slack_webhook_url
+            headers = {"Content-Type": "application/json"}
+            self.logger.debug("Posting build status to Slack")
+
+        for attempt in range(self.attempts):
+            try:
+                response = self.session.post(url, json=event["data"], headers=headers, timeout=self.timeout)
+                # Don't retry errors that will never succeed, e.g a bad token
+                if 400 <= response.status_code < 500 and response.status_code != 429:
+                    self.logger.debug(f"Dropping {event['kind']} event rejected with HTTP {response.status_code}")
+                    return True
+                response.raise_for_status()
+                return True
+            except requests.exceptions.RequestException as e:
+                self.logger.debug(f"Error delivering {event['kind']} event (attempt {attempt + 1}): {e}")
+                if attempt + 1 < self.attempts:
+                    time.sleep(self.backoff * 2 ** attempt)
+        return False
+
+    def load_credentials(self, kind):
+        """
+        Read the Github token or Slack webhook URL the first time it is needed.
+        """
+        if kind == "github" and self.github_token is None:
+            with open(self.github_token_file) as f:
+                self.github_token = f.read().strip()
+        elif kind != "github" and self.slack_webhook_url is None:
+            with open(self.slack_webhook_file, "r") as s:
+                self.slack_webhook_url = s.readline().strip()
+
+    def locked_outbox(self):
+        return Outbox(self.outbox_file)
+
+
+class Outbox:
+    """
+    Context manager giving exclusive access to the list of queued
+    events, which is written back to disk on exit.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = None
+        self.events = []
+
+    def __enter__(self):
+        self.lock_file = open(f"{self.path}.lock", "w")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                try:
+                    self.events = json.load(f)
+                except json.JSONDecodeError:
+                    self.events = []
+        return self.events
+
+    def __exit__(self, *exc):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.events, f)
+        os.replace(tmp_path, self.path)
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        return False
@@ -4,7 +4,7 @@ import argparse
 import json
 import logging
 import os
-import requests
+from delivery import StatusDelivery, status_context
 from logging.handlers import SysLogHandler
 
 
@@ -57,6 +57,10 @@ class Status:
                     self.commit_sha = context["commit"]
                     self.commit_author = context["author"]
                     self.reason = context["reason"]
+                    # When run.py expects the build to finish, if it could tell
+                    self.estimated_finish = context.get("estimated_finish")
+                    # The Qubes version, for the status context
+                    self.version = context.get("version")
                 except KeyError as e:
                     self.logger.debug(e)
                     raise SystemError(e)
@@ -65,10 +69,21 @@ class Status:
             self.logger.debug(e)
             raise SystemError(e)
 
+        self.delivery = StatusDelivery(
+            self.logger,
+            "/home/user/.sdci-ghp.txt",
+            "/home/user/.slack-webhook.txt",
+            "/home/user/.sdci-outbox",
+        )
+
     def commit_status(self, status, log):
         """
         Reports a Github commit status
         """
+        if self.reason == "bisect":
+            # bisect_ci.py builds old commits, whose statuses should stay as they were
+            self.logger.debug("Not posting a commit status for a bisect run")
+            return
         if status == "error":
             description = "There was a problem during the CI execution"
         elif status == "failure":
@@ -79,46 +94,39 @@ class Status:
             description = "The build is queued"
         elif status == "running":
             description = "The build is running"
+            if self.estimated_finish:
+                description += f", expected to finish around {self.estimated_finish}"
         elif status == "canceled":
             description = "The build was canceled by an administrator"
+        elif status == "timeout":
+            description = "A build step timed out"
         else:
             raise SystemError(f"Unrecognized status: {status}")
 
-        with open("/home/user/.sdci-ghp.txt") as f:
-            github_token = f.read().strip()
-        headers = {
-            "Authorization": f"Bearer {github_token}",
-            "Content-Type": "application/json",
-        }
-        data = {}
-        data["context"] = "sd-ci-runner"
-        data["description"] = description
-        if status in ["error", "failure", "success"]:
-            data["target_url"] = f"https://ws-ci-runner.securedrop.org/{log}"
+        target_url = None
+        if status in ["error", "failure", "success", "timeout", "canceled"]:
+            target_url = f"https://ws-ci-runner.securedrop.org/viewer.html?log={log}"
 
         # Github expects state 'error', 'failure', 'success' or 'pending'.
         # Override our non-standard statuses to the closest match to make the
         # API call work.
         if status == "canceled":
             status = "error"
+        if status == "timeout":
+            status = "failure"
         if status == "running":
             status = "pending"
-        data["state"] = status
 
-        self.logger.debug(f"Posting commit status for {self.commit_sha} to Github")
-        requests.post(
-            f"https://api.github.com/repos/freedomofpress/securedrop-workstation/statuses/{self.commit_sha}",
-            json=data,
-            headers=headers,
-        )
+        self.delivery.github_status(self.commit_sha, status, description, target_url, status_context(self.version))
 
     def notify_slack(self, status, log):
         """
         Notifies Slack upon build completion (whether success or failure/error)
         """
-        with open("/home/user/.slack-webhook.txt", "r") as s:
-            slack_webhook_url = s.readline().strip()
-
+        if self.reason == "bisect":
+            # bisect_ci.py sends one notification with what it found
+            self.logger.debug("Not posting to Slack for a bisect run")
+            return
         commit_url = f"https://github.com/freedomofpress/securedrop-workstation/commit/{self.commit_sha}"
         if self.reason == "nightly":
             text = "This CI run was a nightly automated test of the HEAD commit"
@@ -131,7 +139,7 @@ class Status:
             + f": <{commit_url}|{self.commit_sha} by {self.commit_author}: {self.commit_message}>"
         )
 
-        if status == "error" or status == "failure":
+        if status in ["error", "failure", "timeout"]:
             color = "danger"
         elif status == "success":
             color = "good"
@@ -146,7 +154,7 @@ class Status:
             "attachments": [
                 {
                     "color": color,
-                    "pretext": f"SDW CI job {status}",
+                    "pretext": f"SDW CI job on Qubes {self.version} {status}" if self.version else f"SDW CI job {status}",
                     "title": "Commit",
                     "title_link": commit_url,
                     "text": text,
@@ -155,33 +163,16 @@ class Status:
                         {
                             "type": "button",
                             "text": "View Log Output",
-                            "url": f"https://ws-ci-runner.securedrop.org/{log}",
+                            "url": f"https://ws-ci-runner.securedrop.org/viewer.html?log={log}",
                         }
                     ],
                 }
             ]
         }
 
-        # Convert the message to JSON
-        json_message = json.dumps(message)
-
-        # Attempt to post the message to Slack
-        try:
-            self.logger.debug("Posting build status to Slack")
-            response = requests.post(
-                slack_webhook_url,
-                data=json_message,
-                headers={"Content-Type": "application/json"},
-            )
-            response.raise_for_status()
-        except requests.exceptions.HTTPError:
-            e = "HTTP error while contacting Slack"
-            self.logger.debug(e)
-            raise SystemError(e)
-        except Exception as err:
-            e = f"Other error occurred while contacting Slack: {err}"
-            self.logger.debug(e)
-            raise SystemError(e)
+        # Undelivered notifications stay in the outbox for next time
+        if not self.delivery.slack(message):
+            self.logger.debug("Could not deliver the Slack notification yet")
 
 
 if __name__ == "__main__":
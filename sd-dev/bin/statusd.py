@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import json
+import queue
+import sys
+import threading
+from status import Status
+
+
+def deliver(status, events):
+    """
+    Deliver queued status events in the order they arrived.
+    """
+    while True:
+        event = events.get()
+        try:
+            if event is None:
+                return
+            status.commit_status(event["status"], event.get("log", ""))
+            status.notify_slack(event["status"], event.get("log", ""))
+        except Exception as e:
+            status.logger.debug(f"Error delivering status {event}: {e}")
+        finally:
+            events.task_done()
+
+
+def run():
+    """
+    Resident status agent, run as the qubes.SDCIStatus qrexec service.
+
+    runner.py in dom0 keeps one connection open to us for the whole CI run
+    and writes one JSON event per line. We acknowledge each event straight
+    away and deliver it in the background, so the runner never waits on
+    Github or Slack. When the runner closes the connection, we finish
+    delivering what is queued before exiting.
+    """
+    status = Status()
+    events = queue.Queue()
+    worker = threading.Thread(target=deliver, args=(status, events))
+    worker.start()
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            event = json.loads(line)
+            event["status"]
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            status.logger.debug(f"Ignoring malformed status event {line}: {e}")
+            print("error", flush=True)
+            continue
+        events.put(event)
+        print("ok", flush=True)
+
+    events.put(None)
+    worker.join()
+
+
+if __name__ == "__main__":
+    run()
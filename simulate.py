@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+import argparse
+import heapq
+import itertools
+from datetime import datetime, timedelta
+from reports import REPORTS_DIR, load_reports, load_nightly_commits, percentile
+
+# What run.py does, in seconds, unless overridden on the command line
+POLL_INTERVAL = 60
+GIVE_UP_AFTER = 7200
+# ShutdownGuest() followed by a 30 second sleep before powering off
+SHUTDOWN_SECONDS = 30
+
+
+def parse_args():
+    """
+    Handle CLI args.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--reports",
+        default=REPORTS_DIR,
+        action="store",
+        help="Directory of CI logs to replay",
+    )
+    parser.add_argument(
+        "--since",
+        action="store",
+        help="Only replay jobs queued on or after this date (YYYY-MM-DD)",
+    )
+    parser.add_argument(
+        "--version",
+        action="store",
+        help="Only simulate this Qubes version",
+    )
+    parser.add_argument(
+        "--vms",
+        action="append",
+        default=[],
+        metavar="VERSION=COUNT",
+        help="Number of VMs for a Qubes version. Defaults to the number seen in the reports.",
+    )
+    parser.add_argument(
+        "--revert-boot",
+        type=float,
+        action="store",
+        help="Seconds from taking a VM to runner.py starting (revert, boot, uploads). Estimated from the reports by default.",
+    )
+    parser.add_argument(
+        "--update-minutes",
+        type=float,
+        action="store",
+        help="Minutes nightly updates add to a job. Estimated from the reports by default.",
+    )
+    parser.add_argument(
+        "--load",
+        default=1.0,
+        type=float,
+        action="store",
+        help="Multiply the arrival rate by this, e.g 2 for a release day with twice the pushes",
+    )
+    parser.add_argument(
+        "--nightly-jobs",
+        default=0,
+        type=int,
+        action="store",
+        help="Extra nightly jobs to add per version each day, on top of those in the reports",
+    )
+    parser.add_argument(
+        "--nightly-at",
+        default="02:00",
+        action="store",
+        help="Time of day (HH:MM) the extra nightly jobs are queued",
+    )
+    parser.add_argument(
+        "--poll",
+        default=POLL_INTERVAL,
+        type=float,
+        action="store",
+        help="Seconds run.py sleeps between looking for a free VM",
+    )
+    parser.add_argument(
+        "--give-up",
+        default=GIVE_UP_AFTER,
+        type=float,
+        action="store",
+        help="Seconds run.py waits for a free VM before giving up",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def load_jobs(reports_dir, since=None, version=None):
+    """
+    Turn the report archive into jobs: when each was queued, which
+    version it needed, how long runner.py took, and how long it took
+    from being queued to runner.py starting (queue wait, revert, boot,
+    uploads and, for nightlies, updates).
+    """
+    nightly = load_nightly_commits(reports_dir)
+    jobs = []
+    for report in load_reports(reports_dir, since, version):
+        started, finished = report.started(), report.finished()
+        if not report.version or not started or not finished:
+            continue
+        jobs.append({
+            "version": report.version,
+            "vm": report.vm,
+            "queued": report.queued,
+            "setup": (started - report.queued).total_seconds(),
+            "runtime": (finished - started).total_seconds(),
+            "nightly": (report.queued.strftime("%Y-%m-%d"), report.commit) in nightly,
+        })
+    return jobs
+
+
+def estimate_costs(jobs):
+    """
+    Estimate the fixed cost of getting a VM ready, and what nightly
+    updates add to it. Jobs that found a VM straight away only paid the
+    fixed cost, so we take a low percentile of the setup times.
+    """
+    pushes = [job["setup"] for job in jobs if not job["nightly"]]
+    nightlies = [job["setup"] for job in jobs if job["nightly"]]
+    revert_boot = percentile(pushes or nightlies, 10)
+    update = max(percentile(nightlies, 10) - revert_boot, 0) if nightlies else 0
+    return revert_boot, update
+
+
+def add_nightlies(jobs, versions, count, at):
+    """
+    Add synthetic nightly jobs at a given time each day, lasting as long
+    as a typical job.
+    """
+    if not jobs or count <= 0:
+        return jobs
+    hour, minute = (int(part) for part in at.split(":"))
+    runtime = percentile([job["runtime"] for job in jobs], 50)
+    first = min(job["queued"] for job in jobs).date()
+    last = max(job["queued"] for job in jobs).date()
+    extra = []
+    day = first
+    while day <= last:
+        queued = datetime(day.year, day.month, day.day, hour, minute)
+        for version in versions:
+            for n in range(count):
+                extra.append({
+                    "version": version,
+                    "vm": None,
+                    "queued": queued + timedelta(seconds=n),
+                    "setup": None,
+                    "runtime": runtime,
+                    "nightly": True,
+                })
+        day += timedelta(days=1)
+    return sorted(jobs + extra, key=lambda job: job["queued"])
+
+
+class Simulation:
+    def __init__(self, jobs, vms, revert_boot, update, poll, give_up, load=1.0):
+        """
+        A discrete-event model of run.py instances competing for VMs.
+
+        Each job polls for a powered-off VM of its version every `poll`
+        seconds, as run.py does, and gives up after `give_up` seconds. A
+        VM it gets is busy for the revert and boot, nightly updates (and
+        the reboot after them), the runner.py run and the shutdown.
+        """
+        self.jobs = jobs
+        self.vms = vms
+        self.revert_boot = revert_boot
+        self.update = update
+        self.poll = poll
+        self.give_up = give_up
+        self.load = load
+
+    def run(self):
+        origin = self.jobs[0]["queued"] if self.jobs else datetime.now()
+        free = dict(self.vms)
+        busy_seconds = {version: 0 for version in self.vms}
+        events = []
+        sequence = itertools.count()
+        results = []
+
+        for job in self.jobs:
+            arrival = (job["queued"] - origin).total_seconds() / self.load
+            heapq.heappush(events, (arrival, next(sequence), "poll", {"job": job, "arrival": arrival}))
+
+        end = 0
+        while events:
+            now, _, kind, data = heapq.heappop(events)
+            end = max(end, now)
+            if kind == "release":
+                free[data] += 1
+                continue
+
+            job = data["job"]
+            version = job["version"]
+            if free.get(version, 0) > 0:
+                free[version] -= 1
+                hold = self.revert_boot + job["runtime"] + SHUTDOWN_SECONDS
+                if job["nightly"]:
+                    # Updates, then a shutdown and boot before the tests
+                    hold += self.update + SHUTDOWN_SECONDS + self.revert_boot
+                busy_seconds[version] += hold
+                heapq.heappush(events, (now + hold, next(sequence), "release", version))
+                results.append({"version": version, "wait": now - data["arrival"], "gave_up": False})
+            elif now + self.poll - data["arrival"] < self.give_up:
+                heapq.heappush(events, (now + self.poll, next(sequence), "poll", data))
+            else:
+                results.append({"version": version, "wait": now - data["arrival"], "gave_up": True})
+
+        utilisation = {
+            version: busy_seconds[version] / (count * end) if count and end else 0
+            for version, count in self.vms.items()
+        }
+        return results, utilisation
+
+
+def report(jobs, results, utilisation, vms):
+    for version in sorted(vms):
+        waits = [r["wait"] / 60 for r in results if r["version"] == version and not r["gave_up"]]
+        gave_up = len([r for r in results if r["version"] == version and r["gave_up"]])
+        observed = [job["setup"] / 60 for job in jobs if job["version"] == version and job["setup"] is not None]
+        print(f"Qubes {version} with {vms[version]} VMs:")
+        print(f"  jobs: {len(waits) + gave_up}, gave up waiting: {gave_up}")
+        print(
+            f"  queue wait (minutes): p50 {percentile(waits, 50):.1f}, "
+            f"p90 {percentile(waits, 90):.1f}, p99 {percentile(waits, 99):.1f}"
+        )
+        print(f"  VM utilisation: {utilisation[version] * 100:.0f}%")
+        if observed:
+            print(
+                f"  observed queue-to-start in the reports (minutes): p50 {percentile(observed, 50):.1f}, "
+                f"p90 {percentile(observed, 90):.1f}, p99 {percentile(observed, 99):.1f}"
+            )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    since = datetime.strptime(args.since, "%Y-%m-%d") if args.since else None
+    jobs = load_jobs(args.reports, since, args.version)
+    if not jobs:
+        raise SystemExit(f"No completed CI logs found in {args.reports}")
+
+    vms = {}
+    for job in jobs:
+        vms.setdefault(job["version"], set()).add(job["vm"])
+    vms = {version: len(names) for version, names in vms.items()}
+    for override in args.vms:
+        version, _, count = override.partition("=")
+        vms[version] = int(count)
+
+    revert_boot, update = estimate_costs(jobs)
+    if args.revert_boot is not None:
+        revert_boot = args.revert_boot
+    if args.update_minutes is not None:
+        update = args.update_minutes * 60
+    print(f"Replaying {len(jobs)} jobs from {jobs[0]['queued']:%Y-%m-%d} to {jobs[-1]['queued']:%Y-%m-%d}")
+    print(f"Revert and boot: {revert_boot / 60:.1f} minutes, nightly updates: {update / 60:.1f} minutes")
+
+    jobs = add_nightlies(jobs, list(vms), args.nightly_jobs, args.nightly_at)
+    simulation = Simulation(jobs, vms, revert_boot, update, args.poll, args.give_up, args.load)
+    results, utilisation = simulation.run()
+    report(jobs, results, utilisation, vms)
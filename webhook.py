@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import configparser
+import hashlib
+import hmac
+import json
+import logging
+import os
+import signal
+import sys
+import time
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import SysLogHandler
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The status delivery code is shared with status.py in sd-dev
+sys.path.insert(0, os.path.join(CURRENT_DIR, "sd-dev", "bin"))
+from delivery import StatusDelivery, status_context  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+REPO = "freedomofpress/securedrop-workstation"
+
+# Github caps webhook payloads at 25 MB, so anything bigger isn't from Github
+MAX_BODY = 25 * 1024 * 1024
+
+
+def parse_args():
+    """
+    Handle CLI args.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--listen",
+        default="127.0.0.1",
+        action="store",
+        help="Address to listen on (behind the HTTPS reverse proxy)",
+    )
+    parser.add_argument(
+        "--port",
+        default=5000,
+        type=int,
+        action="store",
+        help="Port to listen on",
+    )
+    parser.add_argument(
+        "--record",
+        action="store",
+        help="Directory to save incoming payloads in, so they can be replayed later",
+    )
+    parser.add_argument(
+        "--stand-in",
+        default=False,
+        action="store_true",
+        help="Don't touch any VMs, just pretend each job takes --job-seconds (for load testing)",
+    )
+    parser.add_argument(
+        "--job-seconds",
+        default=5.0,
+        type=float,
+        action="store",
+        help="How long each job takes in --stand-in mode",
+    )
+    parser.add_argument(
+        "--replay",
+        action="store",
+        help="Directory of recorded payloads to send to a running receiver at --listen:--port",
+    )
+    parser.add_argument(
+        "--rate",
+        default=10.0,
+        type=float,
+        action="store",
+        help="Payloads per second to send with --replay",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def sign(secret, body):
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+def build_context(payload):
+    """
+    Build the --context JSON that CiRunner.main() expects from a push
+    payload, or return None if there is nothing to test (e.g a branch
+    was deleted). Raises ValueError if the payload isn't a push payload.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("the payload is not a JSON object")
+    head_commit = payload.get("head_commit")
+    if payload.get("deleted") or not head_commit:
+        return None
+    try:
+        return {
+            "commit": head_commit["id"],
+            "author": head_commit["author"]["name"],
+            "message": head_commit["message"],
+            "reason": "push",
+        }
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"the head commit has no {e}")
+
+
+class StandInRunner:
+    """
+    Takes the place of CiRunner in --stand-in mode.
+    """
+
+    def __init__(self, job_seconds):
+        self.job_seconds = job_seconds
+
+    def main(self, version, context, snapshot_name=False, update=False, checkpoint=False):
+        time.sleep(self.job_seconds)
+        return "success"
+
+
+class Dispatcher:
+    def __init__(self, config, stand_in=False, job_seconds=5.0):
+        """
+        A bounded queue of CI jobs and a pool of workers draining it.
+
+        The workers hand their jobs to one engine.py Engine, so that all
+        the builds share a vSphere session per endpoint, and the engine
+        runs their blocking CiRunner calls in its own thread pool. There
+        is a worker for each build the engine runs at once ([Engine]
+        max_builds), so that is what limits how many builds run, and the
+        queue holds the rest. In --stand-in mode each worker runs a
+        StandInRunner in our thread pool instead.
+        """
+        self.workers = config.getint("Engine", "max_builds", fallback=8)
+        self.queue = asyncio.Queue(maxsize=config.getint("Webhook", "queue_size", fallback=50))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers + 2)
+        self.stand_in = stand_in
+        self.job_seconds = job_seconds
+        self.engine = None
+        self.engine_lock = asyncio.Lock()
+        self.tasks = []
+        self.stopping = False
+
+    async def new_engine(self):
+        """
+        Connect to vSphere in a thread, but create the Engine itself on the
+        event loop, as its asyncio locks belong to the loop they are made
+        on (before Python 3.10).
+        """
+        # Imported here so that --stand-in and --replay work without pyVmomi
+        from engine import Engine
+        from run import CiRunner
+        loop = asyncio.get_running_loop()
+        runner = await loop.run_in_executor(self.executor, CiRunner)
+        return Engine(runner)
+
+    def start(self):
+        for worker_id in range(self.workers):
+            self.tasks.append(asyncio.create_task(self.work(worker_id)))
+
+    def submit(self, versions, context):
+        """
+        Queue a job for each of the versions, or none of them, returning
+        False if there isn't room for them all or we are shutting down.
+        """
+        if self.stopping:
+            return False
+        if self.queue.maxsize and self.queue.maxsize - self.queue.qsize() < len(versions):
+            return False
+        for version in versions:
+            self.queue.put_nowait((version, context))
+        return True
+
+    async def work(self, worker_id):
+        loop = asyncio.get_running_loop()
+        while True:
+            version, context = await self.queue.get()
+            try:
+                if self.stand_in:
+                    runner = StandInRunner(self.job_seconds)
+                    status = await loop.run_in_executor(
+                        self.executor, runner.main, version, json.dumps(context)
+                    )
+                else:
+                    async with self.engine_lock:
+                        if self.engine is None:
+                            self.engine = await self.new_engine()
+                    # The Receiver has already posted the queued status
+                    status = await self.engine.build(version, context, notify_queued=False)
+                logger.debug(f"Job for {context['commit']} on Qubes {version} finished: {status}")
+            except Exception as e:
+                logger.debug(f"Job for {context['commit']} on Qubes {version} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def stop(self):
+        """
+        Stop taking jobs and let the builds that are running finish, so
+        that they report their real outcome rather than being canceled.
+        Builds that are still waiting for a VM are canceled, and jobs
+        still in our queue are dropped.
+        """
+        self.stopping = True
+        while not self.queue.empty():
+            version, context = self.queue.get_nowait()
+            self.queue.task_done()
+            logger.debug(f"Shutting down, dropping {context['commit']} on Qubes {version}")
+        if self.engine:
+            for (commit, version), build in list(self.engine.builds.items()):
+                if build.state == "queued":
+                    await self.engine.cancel(commit, version)
+            while self.engine.builds:
+                logger.debug(f"Shutting down, waiting for {self.engine.summary()}")
+                await asyncio.sleep(30)
+        for task in self.tasks:
+            task.cancel()
+
+
+class Receiver:
+    def __init__(self, config, dispatcher, record_dir=None):
+        """
+        Receives Github webhooks, answers them straight away, and hands
+        the resulting jobs to the dispatcher.
+        """
+        self.secret = config.get("Webhook", "secret")
+        self.dispatcher = dispatcher
+        self.record_dir = record_dir
+        self.stand_in = dispatcher.stand_in
+        self.enqueuing = set()
+        self.delivery = None
+        if not self.stand_in:
+            self.delivery = StatusDelivery(logger, os.path.join(CURRENT_DIR, "sd-dev/.sdci-ghp.txt"))
+
+    async def handle(self, reader, writer):
+        try:
+            status, message = await self.handle_request(reader)
+        except (asyncio.IncompleteReadError, ValueError) as e:
+            status, message = 400, f"Bad request: {e}"
+        body = message.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\n"
+            f"Content-Type: text/plain\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("utf-8")
+            + body
+        )
+        await writer.drain()
+        writer.close()
+
+    async def handle_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY:
+            return 413, "Payload too large"
+        body = await reader.readexactly(length)
+
+        if len(request_line) < 2 or request_line[0] != "POST" or request_line[1] != "/hook/postreceive":
+            return 404, "Not found"
+
+        signature = headers.get("x-hub-signature-256", "")
+        if not hmac.compare_digest(signature, sign(self.secret, body)):
+            logger.debug("Rejecting webhook with a bad signature")
+            return 401, "Bad signature"
+
+        event = headers.get("x-github-event", "")
+        if self.record_dir:
+            self.record(event, body)
+        if event == "ping":
+            return 200, "pong"
+        if event != "push":
+            return 202, f"Ignoring {event} event"
+
+        context = build_context(json.loads(body))
+        if not context:
+            return 202, "Nothing to build"
+
+        # Look up the Qubes versions after answering, Github only waits 10 seconds
+        task = asyncio.create_task(self.enqueue(context))
+        self.enqueuing.add(task)
+        task.add_done_callback(self.enqueuing.discard)
+        return 202, f"Accepted {context['commit']}"
+
+    async def enqueue(self, context):
+        loop = asyncio.get_running_loop()
+        try:
+            versions = await loop.run_in_executor(self.dispatcher.executor, self.ci_versions, context["commit"])
+        except Exception as e:
+            logger.debug(f"Could not read the CI YAML file for {context['commit']}: {e}")
+            return
+        if self.dispatcher.submit(versions, context):
+            state, description = "pending", "The build is queued"
+        else:
+            logger.debug(f"Job queue is full, dropping {context['commit']} on Qubes {', '.join(versions)}")
+            state, description = "error", "The build queue was full, so the build did not run"
+        if not self.delivery:
+            return
+        # One status per version, as each build reports to its own context
+        for version in versions:
+            await loop.run_in_executor(
+                self.dispatcher.executor,
+                self.delivery.github_status,
+                context["commit"],
+                state,
+                description,
+                None,
+                status_context(version),
+            )
+
+    def ci_versions(self, commit):
+        """
+        Read the Qubes versions to test a commit on from its
+        .github/workstation-ci.yml.
+        """
+        if self.stand_in:
+            return ["4.2"]
+        import requests
+        from nightlies import parse_qubes_versions
+        resp = requests.get(
+            f"https://raw.githubusercontent.com/{REPO}/{commit}/.github/workstation-ci.yml",
+            timeout=10,
+        )
+        if resp.status_code == 404:
+            logger.debug(f"The CI YAML file does not exist for {commit}")
+            return []
+        resp.raise_for_status()
+        return parse_qubes_versions(yaml.safe_load(resp.text) or {})
+
+    def record(self, event, body):
+        os.makedirs(self.record_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d%H%M%S')}-{time.monotonic_ns()}-{event}.json"
+        with open(os.path.join(self.record_dir, name), "w") as f:
+            json.dump({"event": event, "payload": json.loads(body)}, f)
+
+
+async def serve(args, config):
+    dispatcher = Dispatcher(config, args.stand_in, args.job_seconds)
+    dispatcher.start()
+    receiver = Receiver(config, dispatcher, args.record)
+    server = await asyncio.start_server(receiver.handle, args.listen, args.port)
+    logger.debug(f"Webhook receiver listening on {args.listen}:{args.port}")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    async with server:
+        await stopping.wait()
+        logger.debug("Stopping, once the builds in progress have finished")
+        server.close()
+        await dispatcher.stop()
+
+
+async def replay(args, config):
+    """
+    Send recorded payloads to a running receiver at a fixed rate, and
+    report how quickly it answered.
+    """
+    secret = config.get("Webhook", "secret")
+    paths = sorted(os.path.join(args.replay, name) for name in os.listdir(args.replay) if name.endswith(".json"))
+    latencies = []
+    statuses = {}
+
+    async def send(path):
+        with open(path, "r") as f:
+            recorded = json.load(f)
+        body = json.dumps(recorded["payload"]).encode("utf-8")
+        start = time.monotonic()
+        reader, writer = await asyncio.open_connection(args.listen, args.port)
+        writer.write(
+            f"POST /hook/postreceive HTTP/1.1\r\nHost: {args.listen}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"X-GitHub-Event: {recorded['event']}\r\nX-Hub-Signature-256: {sign(secret, body)}\r\n\r\n".encode("utf-8")
+            + body
+        )
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        await reader.read()
+        writer.close()
+        latencies.append(time.monotonic() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+
+    tasks = []
+    for path in paths:
+        tasks.append(asyncio.create_task(send(path)))
+        await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*tasks)
+
+    latencies.sort()
+    if latencies:
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000
+        print(f"Sent {len(latencies)} payloads, responses {statuses}")
+        print(f"Response time p50 {p50:.1f}ms, p99 {p99:.1f}ms")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    logger.setLevel(logging.DEBUG)
+    handler = SysLogHandler(facility=SysLogHandler.LOG_DAEMON, address="/dev/log")
+    handler.setFormatter(logging.Formatter("ws-ci-webhook: %(message)s"))
+    logger.addHandler(handler)
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.expanduser("~"), ".esx.ini"))
+
+    if args.replay:
+        asyncio.run(replay(args, config))
+    else:
+        asyncio.run(serve(args, config))